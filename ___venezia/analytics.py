@@ -0,0 +1,291 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from extensions import db
+from analytics_replica import analytics_replica
+from flavor_affinity import PRODUCTION, top_pairs
+from models import GeneralMinimum, Product, ProductCategory, Production, Stock, StockHistory, Store
+
+CACHE_SECONDS = 120  # upper bound on staleness for writes made by other workers
+
+AnalyticsQuery = namedtuple('AnalyticsQuery', ['name', 'tables', 'function'])
+
+QUERIES = {}  # name -> AnalyticsQuery
+
+
+def analytics_query(name, *tables):
+    """Register an aggregate query under `name`; `tables` are the tables whose writes invalidate it"""
+    def register(function):
+        QUERIES[name] = AnalyticsQuery(name, frozenset(tables), function)
+        return function
+    return register
+
+
+class AnalyticsCache:
+    """Process-wide cache of named aggregate query results, keyed by name, parameters and source (replica or not).
+
+    Entries expire after `ttl` seconds and are dropped as soon as a commit
+    writes to one of the tables their query reads. Results are plain rows,
+    numbers or dicts, never ORM instances, so they outlive the session that
+    loaded them. Callers must not modify what they get back.
+    """
+
+    def __init__(self, ttl=CACHE_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # (name, params) -> (result, loaded_at)
+        self.generation = 0  # bumped on every invalidation, so a load racing a commit isn't cached
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, name, **params):
+        query = QUERIES[name]
+        # Replica results are older than the primary's: never served to requests that read the primary
+        key = (name, tuple(sorted(params.items())), analytics_replica.active())
+        # The session's own uncommitted writes must neither be served stale nor cached
+        if db.session.autoflush:
+            db.session.flush()
+        if query.tables & db.session.info.get('analytics', set()):
+            return query.function(**params)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[1] <= self.ttl:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        result = query.function(**params)
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (result, time.monotonic())
+        return result
+
+    def invalidate(self, tables=None):
+        """Drop entries reading any of `tables` (all entries if None)"""
+        with self.lock:
+            self.generation += 1
+            stale = [key for key in self.entries
+                     if tables is None or QUERIES[key[0]].tables & tables]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries)
+            }
+
+
+analytics_cache = AnalyticsCache()
+
+
+def run(name, **params):
+    """Result of the named analytics query, from the cache when fresh"""
+    return analytics_cache.get(name, **params)
+
+
+def _since(days):
+    return datetime.utcnow() - timedelta(days=days)
+
+
+# -- production ------------------------------------------------------------
+
+@analytics_query('total_production', 'productions')
+def total_production():
+    return db.session.query(db.func.sum(Production.quantity)).scalar() or 0
+
+
+@analytics_query('recent_productions', 'productions')
+def recent_productions(limit=5):
+    return db.session.query(
+        Production.flavor, Production.quantity, Production.batch_number, Production.production_date
+    ).order_by(Production.production_date.desc()).limit(limit).all()
+
+
+@analytics_query('daily_production', 'productions')
+def daily_production(days=7):
+    day = db.func.date(Production.production_date)
+    return db.session.query(
+        day.label('date'),
+        db.func.sum(Production.quantity).label('total')
+    ).filter(Production.production_date >= _since(days))\
+     .group_by(day)\
+     .order_by(day)\
+     .all()
+
+
+@analytics_query('flavor_production', 'productions')
+def flavor_production(days=30):
+    return db.session.query(
+        Production.flavor,
+        db.func.sum(Production.quantity).label('total_quantity'),
+        db.func.count(Production.id).label('batch_count')
+    ).filter(
+        Production.production_date >= _since(days)
+    ).group_by(
+        Production.flavor
+    ).order_by(
+        db.desc('total_quantity')
+    ).all()
+
+
+@analytics_query('seasonal_production', 'productions')
+def seasonal_production():
+    """{flavor: {'01'..'12': kg}} over the last year"""
+    month = db.func.strftime('%m', Production.production_date)
+    rows = db.session.query(
+        Production.flavor,
+        month.label('month'),
+        db.func.sum(Production.quantity).label('quantity')
+    ).filter(
+        Production.production_date >= _since(365)
+    ).group_by(Production.flavor, month).all()
+
+    months = ['%02d' % m for m in range(1, 13)]
+    seasonal_data = {}
+    for row in rows:
+        if row.flavor not in seasonal_data:
+            seasonal_data[row.flavor] = {m: 0 for m in months}
+        seasonal_data[row.flavor][row.month] = float(row.quantity)
+    return seasonal_data
+
+
+@analytics_query('flavor_combinations', 'productions')
+def flavor_combinations(days=30, limit=10):
+    """Flavor pairs produced on the same day, most frequent first"""
+    today = datetime.utcnow().date()
+    return top_pairs(PRODUCTION, start=today - timedelta(days=days), end=today, limit=limit)
+
+
+@analytics_query('produced_flavors', 'productions')
+def produced_flavors():
+    return [row.flavor for row in db.session.query(Production.flavor).distinct().order_by(Production.flavor)]
+
+
+# -- stores and stock ------------------------------------------------------
+
+@analytics_query('stores', 'stores')
+def stores():
+    return db.session.query(Store.id, Store.name).order_by(Store.id).all()
+
+
+@analytics_query('store_count', 'stores')
+def store_count():
+    return Store.query.count()
+
+
+@analytics_query('active_flavor_count', 'products', 'product_categories')
+def active_flavor_count():
+    """Active products in the 'Sabores' category"""
+    flavor_category = ProductCategory.query.filter_by(name='Sabores').first()
+    if not flavor_category:
+        return 0
+    return Product.query.filter_by(category_id=flavor_category.id, active=True).count()
+
+
+@analytics_query('low_stock_count', 'stocks', 'general_minimums')
+def low_stock_count():
+    return Stock.query.join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)\
+        .filter(Stock.quantity <= GeneralMinimum.quantity).count()
+
+
+@analytics_query('low_stock_alerts', 'stocks', 'general_minimums', 'stores', 'products')
+def low_stock_alerts():
+    return db.session.query(
+        Store.name.label('name'),
+        Product.name.label('flavor'),
+        Stock.quantity.label('current_quantity'),
+        GeneralMinimum.quantity.label('minimum_quantity')
+    ).join(Store)\
+     .join(Product, Stock.product_id == Product.id)\
+     .join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)\
+     .filter(Stock.quantity <= GeneralMinimum.quantity)\
+     .order_by(Store.name)\
+     .all()
+
+
+@analytics_query('stock_overview', 'stocks', 'general_minimums')
+def stock_overview():
+    return db.session.query(
+        Stock.product_id,
+        db.func.sum(Stock.quantity).label('total_quantity'),
+        db.func.sum(GeneralMinimum.quantity).label('total_minimum')
+    ).join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)\
+     .group_by(Stock.product_id).all()
+
+
+@analytics_query('store_stats', 'stores', 'stocks')
+def store_stats():
+    return db.session.query(
+        Store.name,
+        db.func.count(Stock.id).label('flavors_count'),
+        db.func.sum(Stock.quantity).label('total_stock')
+    ).join(Stock).group_by(Store.id).all()
+
+
+@analytics_query('stock_daily_changes', 'stock_history')
+def stock_daily_changes(days=30, store_id=None, product_id=None):
+    query = db.session.query(
+        StockHistory.timestamp,
+        db.func.sum(StockHistory.quantity_change).label('quantity_change')
+    )
+    if store_id:
+        query = query.filter(StockHistory.store_id == store_id)
+    if product_id:
+        query = query.filter(StockHistory.product_id == product_id)
+    return query.filter(
+        StockHistory.timestamp >= _since(days)
+    ).group_by(
+        db.func.date(StockHistory.timestamp)
+    ).order_by(StockHistory.timestamp).all()
+
+
+# -- invalidation ----------------------------------------------------------
+
+def _written_tables(session):
+    return session.info.setdefault('analytics', set())
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_table_writes(session, flush_context):
+    tables = {obj.__table__.name for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+              if hasattr(obj, '__table__')}
+    if tables:
+        _written_tables(session).update(tables)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _watch_bulk_table_writes(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    name = getattr(table, 'name', None)
+    if name:
+        _written_tables(orm_execute_state.session).add(name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_table_writes(session):
+    tables = session.info.pop('analytics', None)
+    if tables:
+        analytics_cache.invalidate(tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_table_writes(session):
+    session.info.pop('analytics', None)
@@ -0,0 +1,310 @@
+import glob
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from flask import current_app, g, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.selectable import CompoundSelect, Select
+
+REFRESH_SECONDS = 60
+MAX_STALENESS_SECONDS = 600  # an older replica isn't used: reports fall back to the primary
+BACKUP_PAGES = 1024  # pages per step when the primary isn't in WAL mode
+BACKUP_SLEEP = 0.005  # pause between those steps, for writers to get the lock
+BACKUP_RESTARTS = 20  # a stepped copy restarts whenever someone writes; give up after this many
+STALENESS_CACHE_SECONDS = 5  # replication lag of a server replica is asked at most this often
+SAFE_METHODS = ('GET', 'HEAD')
+
+# Read-only report endpoints served from the replica (ANALYTICS_REPLICA_ENDPOINTS overrides)
+ANALYTICS_ENDPOINTS = frozenset({
+    'sales_data', 'stock_analytics', 'get_stock_analytics_data', 'production_analytics',
+    'efficiency_metrics', 'efficiency_dashboard', 'api_production_metrics',
+})
+
+_use_replica = ContextVar('analytics_replica', default=False)
+
+
+class ReplicaRoutingSession(Session):
+    """db.session class: inside an analytics request, SELECTs run on the replica.
+
+    Flushes, DML and textual SQL keep going to the primary, so a report that
+    happens to write still writes to the real database.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _use_replica.get() and not self._flushing and isinstance(clause, (Select, CompoundSelect)):
+            engine = analytics_replica.engine
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class AnalyticsReplica:
+    """Read-only copy of the database for reports, so long scans stay off the database checkouts write to.
+
+    ANALYTICS_REPLICA config:
+    - 'off' (default): everything runs on the primary;
+    - 'sqlite': a copy of the SQLite file (ANALYTICS_REPLICA_PATH, default
+      <database>.analytics) made with the online backup API every
+      ANALYTICS_REPLICA_REFRESH seconds by a daemon thread (0: only by
+      scripts/refresh_analytics_replica.py, e.g. from cron). In WAL mode the
+      copy is one read transaction, which never blocks writers; otherwise it
+      goes BACKUP_PAGES pages at a time so writers get in between steps;
+    - a database URI: an existing read replica (e.g. a PostgreSQL standby).
+
+    GET requests to the endpoints in ANALYTICS_ENDPOINTS are routed to it
+    while it is at most ANALYTICS_REPLICA_MAX_STALENESS seconds old, and
+    answer with X-Data-Source (replica/primary) and X-Replica-Staleness
+    (seconds, 'unknown' when a server replica can't tell).
+
+    Under the WAL profile readers already don't block checkouts, so the
+    'sqlite' copy pays off with SQLITE_PROFILE=off; with WAL, a replica on
+    another server is what takes the report load (scripts/bench_analytics_replica.py).
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mode = 'off'
+        self.engine = None
+        self.path = None
+        self.source_path = None
+        self.endpoints = ANALYTICS_ENDPOINTS
+        self.refresh_seconds = REFRESH_SECONDS
+        self.max_staleness = MAX_STALENESS_SECONDS
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.lag = (None, 0)  # (seconds, monotonic time asked) for a server replica
+        self.refreshes = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_refresh_seconds = None
+        self.replica_requests = 0
+        self.fallback_requests = 0
+
+    def init_app(self, app):
+        self.app = app
+        setting = app.config.get('ANALYTICS_REPLICA') or 'off'
+        if setting == 'off':
+            return
+        self.endpoints = frozenset(app.config.get('ANALYTICS_REPLICA_ENDPOINTS') or ANALYTICS_ENDPOINTS)
+        self.refresh_seconds = float(app.config.get('ANALYTICS_REPLICA_REFRESH', REFRESH_SECONDS))
+        self.max_staleness = float(app.config.get('ANALYTICS_REPLICA_MAX_STALENESS', MAX_STALENESS_SECONDS))
+        if setting == 'sqlite':
+            with app.app_context():
+                primary = current_app.extensions['sqlalchemy'].engine
+            if primary.dialect.name != 'sqlite' or primary.url.database in (None, '', ':memory:'):
+                print("ANALYTICS_REPLICA='sqlite' needs a SQLite database file, replica disabled")
+                return
+            self.source_path = primary.url.database
+            self.path = app.config.get('ANALYTICS_REPLICA_PATH') or f'{self.source_path}.analytics'
+            # A new connection per session: a refresh swaps the file, the next report sees it
+            self._remove_leftovers()
+            self.engine = create_engine(f'sqlite:///file:{self.path}?mode=ro&uri=true', poolclass=NullPool)
+            event.listen(self.engine, 'connect', _configure_replica)
+        else:
+            self.engine = create_engine(setting, pool_pre_ping=True)
+        self.mode = setting if setting == 'sqlite' else 'server'
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._end_request)
+
+    @property
+    def enabled(self):
+        return self.engine is not None
+
+    def active(self):
+        """Whether SELECTs of the current context go to the replica"""
+        return _use_replica.get()
+
+    # -- refresh (mode 'sqlite') ---------------------------------------------
+
+    def refresh(self):
+        """Copy the primary into the replica file; returns the seconds it took"""
+        with self.refresh_lock:
+            started = time.time()
+            partial = f'{self.path}.{os.getpid()}.tmp'
+            copy = {'remaining': None, 'restarts': 0}
+
+            def progress(status, remaining, total):
+                if copy['remaining'] is not None and remaining > copy['remaining']:
+                    copy['restarts'] += 1
+                    if copy['restarts'] > BACKUP_RESTARTS:
+                        raise RuntimeError('the database kept changing during the copy')
+                copy['remaining'] = remaining
+
+            try:
+                source = sqlite3.connect(self.source_path, timeout=30)
+                target = sqlite3.connect(partial)
+                try:
+                    wal = source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+                    source.backup(target, pages=-1 if wal else BACKUP_PAGES, progress=progress,
+                                  sleep=BACKUP_SLEEP)
+                    # Opened read-only afterwards: a WAL copy would need -wal/-shm files next to it
+                    target.execute('PRAGMA journal_mode = DELETE')
+                finally:
+                    target.close()
+                    source.close()
+                # The file's mtime is the snapshot time, shared with other processes
+                os.utime(partial, (started, started))
+                os.replace(partial, self.path)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            elapsed = time.time() - started
+            with self.lock:
+                self.refreshes += 1
+                self.last_refresh_seconds = elapsed
+                self.last_error = None
+            return elapsed
+
+    def _remove_leftovers(self):
+        # Copies of processes that died mid-refresh (<path>.<pid>.tmp)
+        for partial in glob.glob(f'{glob.escape(self.path)}.*.tmp'):
+            pid = partial[len(self.path) + 1:-len('.tmp')]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                os.remove(partial)
+            except OSError:
+                pass
+
+    def ensure_worker(self):
+        if self.mode != 'sqlite' or self.refresh_seconds <= 0:
+            return
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run_forever, name='analytics-replica', daemon=True)
+                self.thread.start()
+
+    def run_forever(self):
+        while True:
+            staleness = self.staleness()
+            # Another process may have refreshed it already
+            if staleness is None or staleness >= self.refresh_seconds:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing analytics replica: {str(e)}")
+                staleness = 0
+            time.sleep(max(1.0, self.refresh_seconds - staleness))
+
+    # -- staleness -----------------------------------------------------------
+
+    def snapshot_time(self):
+        """When the data in the replica was copied (None if unknown or there is no replica yet)"""
+        staleness = self.staleness()
+        return None if staleness is None else datetime.utcfromtimestamp(time.time() - staleness)
+
+    def staleness(self):
+        """Seconds the replica is behind the primary, None if unknown"""
+        if self.mode == 'sqlite':
+            try:
+                return max(0.0, time.time() - os.stat(self.path).st_mtime)
+            except OSError:
+                return None
+        if self.mode == 'server':
+            return self._server_lag()
+        return None
+
+    def _server_lag(self):
+        lag, asked = self.lag
+        if time.monotonic() - asked < STALENESS_CACHE_SECONDS:
+            return lag
+        lag = None
+        if self.engine.dialect.name == 'postgresql':
+            try:
+                with self.engine.connect() as connection:
+                    lag = connection.execute(text(
+                        'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+                    )).scalar()
+                lag = max(0.0, float(lag)) if lag is not None else 0.0  # NULL: not replaying, i.e. a primary
+            except Exception as e:
+                print(f"Error reading replica lag: {str(e)}")
+        self.lag = (lag, time.monotonic())
+        return lag
+
+    # -- request routing -----------------------------------------------------
+
+    def _start_request(self):
+        self.ensure_worker()
+        if request.method not in SAFE_METHODS or request.endpoint not in self.endpoints:
+            return
+        staleness = self.staleness()
+        usable = self.mode == 'server' if staleness is None else staleness <= self.max_staleness
+        with self.lock:
+            if usable:
+                self.replica_requests += 1
+            else:
+                self.fallback_requests += 1
+        if not usable:
+            g.analytics_source = ('primary', None)
+            return
+        g.analytics_source = ('replica', staleness)
+        g.analytics_replica = _use_replica.set(True)
+
+    def _finish_request(self, response):
+        source = g.get('analytics_source')
+        if source is not None:
+            response.headers['X-Data-Source'] = source[0]
+            if source[0] == 'replica':
+                response.headers['X-Replica-Staleness'] = 'unknown' if source[1] is None else f'{source[1]:.0f}'
+        return response
+
+    def _end_request(self, exc):
+        token = g.pop('analytics_replica', None)
+        if token is not None:
+            _use_replica.reset(token)
+
+    @contextmanager
+    def reading(self):
+        """Route the SELECTs of the block to the replica, outside the analytics endpoints (scripts, jobs)"""
+        token = _use_replica.set(self.enabled)
+        try:
+            yield
+        finally:
+            _use_replica.reset(token)
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        staleness = self.staleness()
+        with self.lock:
+            return {
+                'enabled': True,
+                'mode': self.mode,
+                'staleness_seconds': round(staleness, 1) if staleness is not None else None,
+                'max_staleness_seconds': self.max_staleness,
+                'refresh_seconds': self.refresh_seconds,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'last_refresh_seconds': round(self.last_refresh_seconds, 3) if self.last_refresh_seconds else None,
+                'replica_requests': self.replica_requests,
+                'fallback_requests': self.fallback_requests,
+                'endpoints': sorted(self.endpoints)
+            }
+
+
+def _configure_replica(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = ON')
+    cursor.execute('PRAGMA cache_size = -64000')
+    cursor.execute(f'PRAGMA mmap_size = {256 * 1024 * 1024}')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+
+analytics_replica = AnalyticsReplica()
@@ -1,8 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, session, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from sqlalchemy import text, inspect
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, contains_eager, selectinload
 from datetime import datetime, timedelta
 from routes.webshop import webshop
 from routes.products import products_bp
@@ -15,7 +15,7 @@ from functools import wraps
 import qrcode
 from io import BytesIO
 import re
-from sqlalchemy import or_, select, cast, String
+from sqlalchemy import or_, select
 
 print("Current working directory:", os.getcwd())
 print("Loading environment variables...")
@@ -23,16 +23,42 @@ load_dotenv(verbose=True)
 print("MERCADOPAGO_ACCESS_TOKEN present:", bool(os.getenv('MERCADOPAGO_ACCESS_TOKEN')))
 
 # Import after loading environment variables
-from mercadopago_integration import MercadoPagoIntegration, mp_integration
+from mercadopago_integration import mp_integration
 from extensions import db, migrate
 from models import (
     Provider, ProviderCategory, Store, Production, ProductionCost,
     Stock, StockHistory, GeneralMinimum, ProductCategory, Product,
     Sale, SaleItem, Ingredient, Recipe, RecipeIngredient,
     IngredientTransaction, DeliveryAddress, DeliveryOrder, DeliveryStatus, DeliveryStatusHistory,
-    ProductionOrder, ProductionOrderStatus, ProductionOrderHistory
+    ProductionOrder, ProductionOrderStatus, ProductionOrderHistory, SalesDailyRollup, FlavorPairDaily,
+    ProductionEvent, StockLedgerSnapshot
 )
-from payment_routes import payment
+from payment_routes import payment, receive_notification
+from stock_reservation import stock_engine, StockConflictError
+from batch_distribution import batch_distribution
+from replenishment import replenishment_plan, COVER_DAYS
+from stock_ledger import (
+    delete_store_ledger, reconcile as reconcile_stock_ledger, take_daily_checkpoints,
+    stock_at, stock_matrix, checkpoint_before
+)
+from stock_snapshot import stock_snapshot
+from cart_store import get_cart_store, current_cart_id, load_cart, product_cache
+from bill_of_materials import expand_cart
+from pagination import keyset_page, parse_limit, InvalidCursorError
+import customer_search  # keeps the customer search index in sync on commit
+from sales_rollup import filter_rollup, rebuild as rebuild_sales_rollup
+from flavor_affinity import rebuild as rebuild_flavor_pairs
+from payment_queue import payment_queue, notification_queue
+from sql_profiler import sql_profiler
+from db_indexes import ensure_indexes
+from sqlite_profile import sqlite_profile
+from analytics_replica import analytics_replica
+from metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from stock_forecast import depletion_forecast
+import analytics
+from recipe_costing import recipe_costs, plan_ingredient_requirements
+from ingredient_consumption import consume_ingredients, release_ingredients
+from production_metrics import batch_metrics, summarize, record_event, event_to_dict, TimelineError
 from werkzeug.exceptions import BadRequest
 
 app = Flask(__name__, static_url_path='/static', static_folder='static')
@@ -45,6 +71,13 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_recycle': 300,
 }
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['CART_STORE'] = os.environ.get('CART_STORE', 'sql')  # 'sql' (shared) or 'memory'
+app.config['PAYMENT_QUEUE'] = os.environ.get('PAYMENT_QUEUE', 'thread')  # 'thread' or 'external' worker
+app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')  # WAL + writer queue, or 'off'
+app.config['SQL_PROFILE'] = os.environ.get('SQL_PROFILE', 'auto')  # 'auto' (headers in debug), 'headers', 'stats' or 'off'
+app.config['SQL_CAPTURE_FILE'] = os.environ.get('SQL_CAPTURE_FILE')  # workload for scripts/advise_indexes.py
+app.config['ANALYTICS_REPLICA'] = os.environ.get('ANALYTICS_REPLICA', 'off')  # 'off', 'sqlite' (refreshed copy) or a replica URI
+app.config['ANALYTICS_REPLICA_REFRESH'] = float(os.environ.get('ANALYTICS_REPLICA_REFRESH', '60'))  # seconds, 0: external refresh
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=5)
 app.config['GOOGLE_MAPS_API_KEY'] = os.environ.get('GOOGLE_MAPS_API_KEY', '')  # Add Google Maps API key
 
@@ -54,6 +87,12 @@ app.config['PROPAGATE_EXCEPTIONS'] = True
 # Initialize extensions
 db.init_app(app)
 migrate.init_app(app, db)
+sqlite_profile.init_app(app)
+analytics_replica.init_app(app)
+payment_queue.init_app(app)
+notification_queue.init_app(app)
+sql_profiler.init_app(app)
+metrics.init_app(app)
 
 # Register blueprints
 app.register_blueprint(payment, url_prefix='/payment')
@@ -112,8 +151,40 @@ def init_db():
                 if 'sales_format' not in product_columns:
                     connection.execute(text("ALTER TABLE products ADD COLUMN sales_format VARCHAR(50)"))
                 connection.commit()
+
+        # stock_history.quantity_change was INTEGER: fractional kg were truncated (SQLite keeps them as REAL anyway)
+        if 'stock_history' in inspector.get_table_names() and db.engine.dialect.name == 'postgresql':
+            change_type = next(col['type'] for col in inspector.get_columns('stock_history') if col['name'] == 'quantity_change')
+            if not isinstance(change_type, db.Float):
+                with db.engine.connect() as connection:
+                    connection.execute(text("ALTER TABLE stock_history ALTER COLUMN quantity_change TYPE FLOAT"))
+                    connection.commit()
         
         db.create_all()
+
+        # Indexes declared on models after their table was created (create_all skips existing tables)
+        removed, created = ensure_indexes(db.engine)
+        if created:
+            print(f"Created indexes: {', '.join(created)} ({removed} duplicate stock rows merged)")
+
+        # Backfill the daily sales rollup the first time it exists alongside old sales
+        if not SalesDailyRollup.query.first() and Sale.query.first():
+            rebuild_sales_rollup(db.session)
+            db.session.commit()
+
+        # Opening balance of the stock ledger: log what Stock holds beyond its history
+        if not StockLedgerSnapshot.query.first() and Stock.query.first():
+            reconcile_stock_ledger(db.session, repair=True)
+            db.session.commit()
+
+        # Daily checkpoints missed while the app was down (scripts/stock_ledger_job.py takes them from cron)
+        take_daily_checkpoints(db.session)
+        db.session.commit()
+
+        # Same for the flavor pair buckets
+        if not FlavorPairDaily.query.first() and (Production.query.first() or SaleItem.query.filter(SaleItem.flavors.isnot(None)).first()):
+            rebuild_flavor_pairs(db.session)
+            db.session.commit()
         
         # Initialize production order statuses if they don't exist
         production_statuses = [
@@ -239,46 +310,16 @@ def init_db():
 
 @app.route('/')
 def index():
-    total_production = db.session.query(db.func.sum(Production.quantity)).scalar() or 0
-    total_stores = Store.query.count()
+    total_production = analytics.run('total_production')
+    total_stores = analytics.run('store_count')
     total_flavors = len(FLAVORS)
-    low_stock_count = Stock.query.join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id).filter(Stock.quantity <= GeneralMinimum.quantity).count()
-    
-    recent_productions = Production.query.order_by(Production.production_date.desc()).limit(5).all()
-    
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    daily_production = db.session.query(
-        db.func.date(Production.production_date).label('date'),
-        db.func.sum(Production.quantity).label('total')
-    ).filter(Production.production_date >= seven_days_ago)\
-     .group_by(db.func.date(Production.production_date))\
-     .order_by(db.func.date(Production.production_date))\
-     .all()
-    
-    stock_overview = db.session.query(
-        Stock.product_id,
-        db.func.sum(Stock.quantity).label('total_quantity'),
-        db.func.sum(GeneralMinimum.quantity).label('total_minimum')
-    ).join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)\
-     .group_by(Stock.product_id).all()
-    
-    store_stats = db.session.query(
-        Store.name,
-        db.func.count(Stock.id).label('flavors_count'),
-        db.func.sum(Stock.quantity).label('total_stock')
-    ).join(Stock).group_by(Store.id).all()
-    
-    low_stock_alerts = db.session.query(
-        Store.name.label('name'),
-        Product.name.label('flavor'),
-        Stock.quantity.label('current_quantity'),
-        GeneralMinimum.quantity.label('minimum_quantity')
-    ).join(Store)\
-     .join(Product, Stock.product_id == Product.id)\
-     .join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)\
-     .filter(Stock.quantity <= GeneralMinimum.quantity)\
-     .order_by(Store.name)\
-     .all()
+    low_stock_count = analytics.run('low_stock_count')
+    recent_productions = analytics.run('recent_productions', limit=5)
+    daily_production = analytics.run('daily_production', days=7)
+    stock_overview = analytics.run('stock_overview')
+    store_stats = analytics.run('store_stats')
+    low_stock_alerts = analytics.run('low_stock_alerts')
+    replenishment = replenishment_plan()
 
     return render_template('index.html',
                          total_production=total_production,
@@ -289,7 +330,8 @@ def index():
                          daily_production=daily_production,
                          stock_overview=stock_overview,
                          store_stats=store_stats,
-                         low_stock_alerts=low_stock_alerts)
+                         low_stock_alerts=low_stock_alerts,
+                         replenishment=replenishment)
 
 @app.route('/production')
 def production():
@@ -306,20 +348,9 @@ def add_production():
         
         batch_number = Production.generate_batch_number(flavor)
 
-        # Get recipe for the selected flavor by joining with Product
-        recipe = db.session.scalar(
-            db.select(Recipe)
-            .join(Recipe.product)
-            .filter(Product.name == flavor)
-            .filter(Recipe.type == 'flavor')
-        )
-        
-        production_cost = 0
-        if recipe:
-            # Calculate production cost based on quantity and recipe
-            for ingredient in recipe.ingredients:
-                ingredient_cost = ingredient.ingredient.cost_per_unit * ingredient.quantity * quantity
-                production_cost += ingredient_cost
+        # Production cost from the recipe's cached cost per kg
+        product_id = db.session.scalar(db.select(Product.id).filter(Product.name == flavor))
+        production_cost = recipe_costs.production_cost(product_id, quantity) if product_id else 0
 
         production = Production(
             flavor=flavor,
@@ -332,6 +363,8 @@ def add_production():
 
         try:
             db.session.add(production)
+            db.session.flush()
+            record_event(production, 'start', production.production_date, operator=operator)
             db.session.commit()
             flash('Producción registrada exitosamente', 'success')
             return redirect(url_for('production'))
@@ -432,9 +465,13 @@ def finish_production(production_id):
         # Update production record
         production.end_time = datetime.utcnow()
         production.success_status = 'success'
+        record_event(production, 'finish', production.end_time, operator=production.operator)
+
+        # Use up the recipe ingredients (skipped if the batch was already consumed from its order)
+        consumption = consume_ingredients(db.session, production, product.id)
         
         db.session.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'ingredient_shortages': consumption.shortages})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
@@ -497,116 +534,15 @@ def assign_batch():
         
         if not batch_number or not target_store_id or not quantity:
             return jsonify({'success': False, 'error': 'Faltan datos requeridos'})
-        
-        # Get the production record
-        production = Production.query.filter_by(batch_number=batch_number).first()
-        if not production:
-            return jsonify({'success': False, 'error': 'Número de lote inválido'})
-            
-        if production.assigned_store_id is not None:
-            return jsonify({'success': False, 'error': 'Este lote ya ha sido asignado'})
 
-        # Get source and target stores
-        main_store = Store.query.filter_by(name='Tienda Principal').first()
-        target_store = Store.query.get(target_store_id)
-        
-        if not main_store or not target_store:
-            return jsonify({'success': False, 'error': 'Tienda no encontrada'})
-            
-        # Find the product
-        product_category = ProductCategory.query.filter_by(name='Sabores').first()
-        if not product_category:
-            return jsonify({'success': False, 'error': 'No se encontró la categoría de sabores'})
-        
-        product = Product.query.filter_by(
-            name=production.flavor,
-            category_id=product_category.id
-        ).first()
-        
-        if not product:
-            return jsonify({'success': False, 'error': f'No se encontró el producto para el sabor {production.flavor}'})
-        
-        # Get source and target stock records
-        source_stock = Stock.query.filter_by(
-            store_id=main_store.id,
-            product_id=product.id
-        ).first()
-        
-        target_stock = Stock.query.filter_by(
-            store_id=target_store.id,
-            product_id=product.id
-        ).first()
-        
-        # If target store is the same as source store, we don't need to check stock
-        if main_store.id != target_store.id and (not source_stock or source_stock.quantity < quantity):
-            return jsonify({'success': False, 'error': 'Stock insuficiente en tienda principal'})
-            
-        # Update stock only if it's not a self-transfer
-        if main_store.id != target_store.id:
-            # Update source stock
-            if not source_stock:
-                source_stock = Stock(
-                    store_id=main_store.id,
-                    product_id=product.id,
-                    quantity=0
-                )
-                db.session.add(source_stock)
-            source_stock.quantity -= quantity
-        
-            # Update or create target stock
-            if target_stock:
-                target_stock.quantity += quantity
-            else:
-                target_stock = Stock(
-                    store_id=target_store.id,
-                    product_id=product.id,
-                    quantity=quantity
-                )
-                db.session.add(target_stock)
-        else:
-            # For self-transfers, update or create the stock record
-            if not source_stock:
-                source_stock = Stock(
-                    store_id=main_store.id,
-                    product_id=product.id,
-                    quantity=quantity
-                )
-                db.session.add(source_stock)
-            else:
-                source_stock.quantity += quantity
-        
-        # Create stock history records
-        if main_store.id != target_store_id:
-            source_history = StockHistory(
-                store_id=main_store.id,
-                product_id=product.id,
-                quantity_change=-quantity,
-                reason=f'Transferencia a {target_store.name} - Lote {production.batch_number}'
-            )
-            
-            target_history = StockHistory(
-                store_id=target_store_id,
-                product_id=product.id,
-                quantity_change=quantity,
-                reason=f'Transferencia desde Tienda Principal - Lote {production.batch_number}'
-            )
-            
-            db.session.add(source_history)
-            db.session.add(target_history)
-        else:
-            # For self-transfers, just record it as a production assignment
-            source_history = StockHistory(
-                store_id=main_store.id,
-                product_id=product.id,
-                quantity_change=quantity,
-                reason=f'Asignación de producción - Lote {production.batch_number}'
-            )
-            db.session.add(source_history)
-        
-        # Update production record with assignment details
-        production.assigned_store_id = target_store.id
-        production.assigned_at = datetime.utcnow()
-        
+        # Same path as the bulk distribution, with a single line
+        plan = batch_distribution.distribute([
+            {'batch_number': batch_number, 'store_id': target_store_id, 'quantity': quantity}
+        ])
+        if not plan.ok:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': plan.errors[0]['error']})
+
         try:
             db.session.commit()
             return jsonify({'success': True})
@@ -614,9 +550,76 @@ def assign_batch():
             db.session.rollback()
             return jsonify({'success': False, 'error': 'Error al guardar los cambios'})
             
+    except StockConflictError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
     except Exception as e:
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/batches/distribute', methods=['POST'])
+def distribute_batches():
+    """Apply a whole allocation plan in one transaction.
+
+    Body: {"allocations": [{"batch_number": ..., "store_id": ..., "quantity": kg}, ...],
+           "dry_run": false}. A batch may be split across several stores; a line
+    with product_id instead of a batch moves main store stock without a batch.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get('dry_run'):
+            plan = batch_distribution.check(data.get('allocations'), lock=False)
+            status = 200 if plan.ok else 400
+            return jsonify({'success': plan.ok, 'dry_run': True, 'errors': plan.errors,
+                            **(plan.summary() if plan.ok else {})}), status
+
+        plan = batch_distribution.distribute(data.get('allocations'))
+        if not plan.ok:
+            db.session.rollback()
+            return jsonify({'success': False, 'errors': plan.errors}), 400
+        db.session.commit()
+        return jsonify({'success': True, **plan.summary()})
+    except StockConflictError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'errors': [{'line': None, 'error': str(e)}]}), 409
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error distributing batches: {str(e)}")
+        return jsonify({'success': False, 'errors': [{'line': None, 'error': str(e)}]}), 500
+
+@app.route('/api/replenishment/plan')
+def get_replenishment_plan():
+    """Proposed transfers from Tienda Principal, plus production for what it can't cover"""
+    try:
+        cover_days = request.args.get('cover_days', COVER_DAYS, type=int)
+        store_id = request.args.get('store_id', type=int)
+        return jsonify(replenishment_plan(cover_days=max(cover_days, 0), store_id=store_id))
+    except Exception as e:
+        print(f"Error building replenishment plan: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/replenishment/execute', methods=['POST'])
+def execute_replenishment_plan():
+    """Recompute the plan and apply its transfers with the batch distribution engine"""
+    data = request.get_json(silent=True) or {}
+    try:
+        plan = replenishment_plan(cover_days=max(int(data.get('cover_days', COVER_DAYS)), 0), store_id=data.get('store_id'))
+        if not plan['allocations']:
+            return jsonify({'success': True, 'transfers': [], 'production': plan['production'], 'total_kg': 0})
+        distribution = batch_distribution.distribute(plan['allocations'])
+        if not distribution.ok:
+            db.session.rollback()
+            return jsonify({'success': False, 'errors': distribution.errors}), 400
+        db.session.commit()
+        return jsonify({'success': True, **distribution.summary(), 'production': plan['production']})
+    except StockConflictError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'errors': [{'line': None, 'error': str(e)}]}), 409
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error executing replenishment plan: {str(e)}")
+        return jsonify({'success': False, 'errors': [{'line': None, 'error': str(e)}]}), 500
+
 @app.route('/add_store', methods=['GET', 'POST'])
 def add_store():
     if request.method == 'POST':
@@ -634,16 +637,16 @@ def add_store():
         db.session.add(store)
         db.session.commit()
         
-        for flavor in FLAVORS:
-            main_stock = Stock.query.filter_by(
-                store_id=1,
-                product_id=1
-            ).first()
-                
+        # One stock row per flavor (uq_stocks_store_product), minimums copied from the main store
+        flavor_products = Product.query.filter(Product.name.in_(list(FLAVORS))).all()
+        main_minimums = dict(db.session.query(Stock.product_id, Stock.minimum_quantity).filter(
+            Stock.store_id == 1, Stock.product_id.in_([p.id for p in flavor_products])
+        ).all())
+        for product in flavor_products:
             stock = Stock(
                 store_id=store.id,
-                product_id=1,
-                minimum_quantity=main_stock.minimum_quantity if main_stock else 10.0
+                product_id=product.id,
+                minimum_quantity=main_minimums.get(product.id) or 10.0
             )
             db.session.add(stock)
         db.session.commit()
@@ -795,6 +798,7 @@ def edit_production(production_id):
 def delete_production(production_id):
     try:
         production = Production.query.get_or_404(production_id)
+        release_ingredients(db.session, production)
         db.session.delete(production)
         db.session.commit()
         return jsonify({'success': True})
@@ -804,8 +808,8 @@ def delete_production(production_id):
 
 @app.route('/reports')
 def reports():
-    stores = Store.query.all()
-    flavors = get_available_flavors()
+    stores = analytics.run('stores')
+    flavors = analytics.run('produced_flavors')
     
     # Get content from stock analytics and production analytics pages
     with app.test_request_context():
@@ -846,66 +850,21 @@ def sales_data():
 
         print(f"Parsed dates: start_date={start_date}, end_date={end_date}")
         
-        # Build summary query with joins
-        summary_query = db.session.query(
-            db.func.count(Sale.id).label('total_sales'),
-            db.func.sum(Sale.total_amount).label('total_amount')
-        ).filter(
-            Sale.created_at >= start_date,
-            Sale.created_at <= end_date
-        )
-
-        # Build delivery count query
-        delivery_query = db.session.query(
-            db.func.count(Sale.id).label('delivery_count')
-        ).filter(
-            Sale.created_at >= start_date,
-            Sale.created_at <= end_date,
-            Sale.is_delivery == True
-        )
-
-        # Apply filters to summary query
-        if store_id:
-            summary_query = summary_query.filter(Sale.store_id == store_id)
-            delivery_query = delivery_query.filter(Sale.store_id == store_id)
-        if payment_method:
-            summary_query = summary_query.filter(Sale.payment_method == payment_method)
-            delivery_query = delivery_query.filter(Sale.payment_method == payment_method)
-        if payment_status:
-            summary_query = summary_query.filter(Sale.payment_status == payment_status)
-            delivery_query = delivery_query.filter(Sale.payment_status == payment_status)
-
-        # Execute summary query
-        summary_result = summary_query.first()
-        delivery_result = delivery_query.first()
-        print(f"Query results: summary={summary_result}, delivery={delivery_result}")
-        
-        total_sales = summary_result.total_sales or 0
-        total_amount = float(summary_result.total_amount or 0)
-        delivery_count = delivery_result.delivery_count or 0
-        avg_sale = round(total_amount / total_sales, 2) if total_sales > 0 else 0
-
-        # Build sales by day query
-        sales_by_day_query = db.session.query(
-            cast(db.func.date(Sale.created_at), String).label('date'),
-            db.func.count(Sale.id).label('count'),
-            db.func.sum(Sale.total_amount).label('amount')
-        ).filter(
-            Sale.created_at >= start_date,
-            Sale.created_at <= end_date
+        # Summary and charts come from the daily rollup, never from a scan of sales
+        rollup_rows = filter_rollup(
+            db.session.query(
+                SalesDailyRollup.date,
+                SalesDailyRollup.payment_method,
+                SalesDailyRollup.is_delivery,
+                db.func.sum(SalesDailyRollup.sale_count).label('count'),
+                db.func.sum(SalesDailyRollup.total_amount).label('amount')
+            ),
+            start_date.date(), end_date.date(),
+            store_id=store_id, payment_method=payment_method, payment_status=payment_status
         ).group_by(
-            cast(db.func.date(Sale.created_at), String)
-        ).order_by(cast(db.func.date(Sale.created_at), String))
-
-        # Apply filters to sales by day query
-        if store_id:
-            sales_by_day_query = sales_by_day_query.filter(Sale.store_id == store_id)
-        if payment_method:
-            sales_by_day_query = sales_by_day_query.filter(Sale.payment_method == payment_method)
-        if payment_status:
-            sales_by_day_query = sales_by_day_query.filter(Sale.payment_status == payment_status)
+            SalesDailyRollup.date, SalesDailyRollup.payment_method, SalesDailyRollup.is_delivery
+        ).all()
 
-        # Execute sales by day query and format results
         sales_by_day = {}
         current_date = start_date.date()
         end_date_only = end_date.date()
@@ -917,33 +876,6 @@ def sales_data():
             }
             current_date += timedelta(days=1)
 
-        for result in sales_by_day_query.all():
-            sales_by_day[result.date] = {
-                'count': result.count,
-                'amount': float(result.amount or 0)
-            }
-
-        # Build payment methods query
-        payment_methods_query = db.session.query(
-            Sale.payment_method,
-            db.func.count(Sale.id).label('count'),
-            db.func.sum(Sale.total_amount).label('amount')
-        ).filter(
-            Sale.created_at >= start_date,
-            Sale.created_at <= end_date
-        ).group_by(
-            Sale.payment_method
-        )
-
-        # Apply filters to payment methods query
-        if store_id:
-            payment_methods_query = payment_methods_query.filter(Sale.store_id == store_id)
-        if payment_method:
-            payment_methods_query = payment_methods_query.filter(Sale.payment_method == payment_method)
-        if payment_status:
-            payment_methods_query = payment_methods_query.filter(Sale.payment_status == payment_status)
-
-        # Execute payment methods query and format results
         payment_methods = {
             'cash': {'count': 0, 'amount': 0},
             'card': {'count': 0, 'amount': 0},
@@ -951,21 +883,36 @@ def sales_data():
             'mercadopago': {'count': 0, 'amount': 0}
         }
 
-        for result in payment_methods_query.all():
+        total_sales = 0
+        total_amount = 0.0
+        delivery_count = 0
+        for result in rollup_rows:
+            count = int(result.count or 0)
+            amount = float(result.amount or 0)
+            total_sales += count
+            total_amount += amount
+            if result.is_delivery:
+                delivery_count += count
+
+            day = sales_by_day.setdefault(result.date.strftime('%Y-%m-%d'), {'count': 0, 'amount': 0})
+            day['count'] += count
+            day['amount'] += amount
+
             method = result.payment_method or 'unknown'
             if method in payment_methods:
-                payment_methods[method] = {
-                    'count': result.count,
-                    'amount': float(result.amount or 0)
-                }
+                payment_methods[method]['count'] += count
+                payment_methods[method]['amount'] += amount
+
+        avg_sale = round(total_amount / total_sales, 2) if total_sales > 0 else 0
+        print(f"Rollup results: total_sales={total_sales}, total_amount={total_amount}, delivery={delivery_count}")
 
         # Build detailed sales query with joins
         sales_query = db.session.query(Sale).options(
             joinedload(Sale.store),
             joinedload(Sale.sale_items).joinedload(SaleItem.product)
         ).filter(
-            Sale.created_at >= start_date,
-            Sale.created_at <= end_date
+            Sale.created_at >= start_date.replace(hour=0, minute=0, second=0, microsecond=0),
+            Sale.created_at < end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
         ).order_by(Sale.created_at.desc())
 
         # Apply filters to sales query
@@ -976,14 +923,27 @@ def sales_data():
         if payment_status:
             sales_query = sales_query.filter(Sale.payment_status == payment_status)
 
-        # Paginate sales query
-        sales_paginated = sales_query.paginate(page=page, per_page=per_page, error_out=False)
-        
-        print(f"Paginated sales: {sales_paginated}")
+        # Cursor mode (?cursor=, empty for the first page) seeks on (created_at, id)
+        # instead of OFFSET, so deep pages cost the same as the first one
+        cursor_mode = 'cursor' in request.args
+        if cursor_mode:
+            try:
+                page_items, next_cursor = keyset_page(
+                    sales_query.order_by(None), [Sale.created_at, Sale.id],
+                    cursor=request.args.get('cursor'), limit=parse_limit(per_page)
+                )
+            except InvalidCursorError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            # Paginate sales query; the total comes from the rollup instead of a COUNT over sales
+            sales_paginated = sales_query.paginate(page=page, per_page=per_page, error_out=False, count=False)
+            sales_paginated.total = total_sales
+            page_items = sales_paginated.items
+            print(f"Paginated sales: {sales_paginated}")
         
         # Format sales data
         sales_data = []
-        for sale in sales_paginated.items:
+        for sale in page_items:
             items_data = [{
                 'product_name': item.product.name,
                 'quantity': item.quantity,
@@ -1021,6 +981,10 @@ def sales_data():
             },
             'sales': sales_data,
             'pagination': {
+                'next_cursor': next_cursor,
+                'per_page': parse_limit(per_page),
+                'total_items': total_sales
+            } if cursor_mode else {
                 'page': page,
                 'per_page': per_page,
                 'total_pages': sales_paginated.pages,
@@ -1044,78 +1008,21 @@ def stock_analytics():
     selected_product_id = request.args.get('product_id', type=int)
     days = request.args.get('days', 30, type=int)
     
-    stores = Store.query.all()
-    from_date = datetime.utcnow() - timedelta(days=days)
-    
-    # Build query for daily changes
-    query = db.session.query(
-        StockHistory.timestamp,
-        db.func.sum(StockHistory.quantity_change).label('quantity_change')
-    )
-    
-    if selected_store_id:
-        query = query.filter(StockHistory.store_id == selected_store_id)
-    if selected_product_id:
-        query = query.filter(StockHistory.product_id == selected_product_id)
-    
-    daily_changes = query.filter(
-        StockHistory.timestamp >= from_date
-    ).group_by(
-        db.func.date(StockHistory.timestamp)
-    ).order_by(StockHistory.timestamp).all()
-    
-    # Get depletion rates
-    depletion_query = db.session.query(
-        StockHistory.store_id,
-        StockHistory.product_id,
-        Store.name.label('store_name'),
-        Product.name.label('product'),
-        db.func.avg(StockHistory.quantity_change).label('avg_change')
-    ).join(Store).join(Product).filter(
-        StockHistory.reason == 'sale'
-    )
-    
-    if selected_store_id:
-        depletion_query = depletion_query.filter(StockHistory.store_id == selected_store_id)
-    if selected_product_id:
-        depletion_query = depletion_query.filter(StockHistory.product_id == selected_product_id)
-    
-    depletion_rates = depletion_query.group_by(
-        StockHistory.store_id,
-        StockHistory.product_id
-    ).all()
-    
-    # Process depletion rates to include absolute values
-    processed_depletion_rates = []
-    for rate in depletion_rates:
-        processed_depletion_rates.append({
-            'store_id': rate.store_id,
-            'product_id': rate.product_id,
-            'store_name': rate.store_name,
-            'product': rate.product,
-            'avg_change': rate.avg_change,
-            'abs_change': abs(rate.avg_change) if rate.avg_change else 0
-        })
-    
-    # Get current stock and predictions
-    current_stock = Stock.query.all()
-    stock_predictions = []
-    for stock in current_stock:
-        depletion_rate = next(
-            (r.avg_change for r in depletion_rates 
-             if r.store_id == stock.store_id and r.product_id == stock.product_id),
-            0
-        )
-        if depletion_rate < 0:
-            days_until_empty = abs(stock.quantity / depletion_rate) if depletion_rate else float('inf')
-            stock_predictions.append({
-                'store_id': stock.store_id,
-                'store_name': stock.store.name,
-                'product': stock.product.name,
-                'current_quantity': stock.quantity,
-                'days_until_empty': days_until_empty,
-                'predicted_date': datetime.utcnow() + timedelta(days=days_until_empty)
-            })
+    stores = analytics.run('stores')
+    daily_changes = analytics.run('stock_daily_changes', days=days,
+                                  store_id=selected_store_id, product_id=selected_product_id)
+    
+    # Depletion forecast: smoothed daily sales with weekday seasonality for every pair at once
+    forecast = depletion_forecast(selected_store_id, selected_product_id, days=days)
+    processed_depletion_rates = [{
+        'store_id': f['store_id'],
+        'product_id': f['product_id'],
+        'store_name': f['store_name'],
+        'product': f['product'],
+        'avg_change': -f['daily_rate'],
+        'abs_change': f['daily_rate']
+    } for f in forecast]
+    stock_predictions = [f for f in forecast if f['predicted_date'] is not None]
     
     return render_template('stock_analytics.html',
                          stores=stores,
@@ -1124,78 +1031,16 @@ def stock_analytics():
                          days=days,
                          daily_changes=daily_changes,
                          depletion_rates=processed_depletion_rates,
-                         stock_predictions=sorted(stock_predictions, key=lambda x: x['days_until_empty'])[:10],
+                         stock_predictions=stock_predictions[:10],
                          products=Product.query.filter_by(track_stock=True).all())
 
 @app.route('/production_analytics')
 def production_analytics():
     days = request.args.get('days', 30, type=int)
-    from_date = datetime.utcnow() - timedelta(days=days)
-    
-    flavor_production = db.session.query(
-        Production.flavor,
-        db.func.sum(Production.quantity).label('total_quantity'),
-        db.func.count(Production.id).label('batch_count')
-    ).filter(
-        Production.production_date >= from_date
-    ).group_by(
-        Production.flavor
-    ).order_by(
-        db.desc('total_quantity')
-    ).all()
-    
-    seasonal_production = db.session.query(
-        Production.flavor,
-        db.func.strftime('%m', Production.production_date).label('month'),
-        db.func.sum(Production.quantity).label('quantity')
-    ).filter(
-        Production.production_date >= datetime.utcnow() - timedelta(days=365)
-    ).group_by(
-        Production.flavor,
-        db.func.strftime('%m', Production.production_date)
-    ).all()
-    
-    months = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
-    seasonal_data = {}
-    for prod in seasonal_production:
-        if prod.flavor not in seasonal_data:
-            seasonal_data[prod.flavor] = {m: 0 for m in months}
-        seasonal_data[prod.flavor][prod.month] = float(prod.quantity)
-    
-    daily_production = db.session.query(
-        db.func.date(Production.production_date).label('date'),
-        db.func.sum(Production.quantity).label('quantity')
-    ).filter(
-        Production.production_date >= from_date
-    ).group_by(
-        db.func.date(Production.production_date)
-    ).order_by(db.func.date(Production.production_date)).all()
-    
-    productions_by_date = db.session.query(
-        db.func.date(Production.production_date).label('date'),
-        Production.flavor
-    ).filter(
-        Production.production_date >= from_date
-    ).order_by(db.func.date(Production.production_date)).all()
-    
-    date_flavors = {}
-    for prod in productions_by_date:
-        if prod.date not in date_flavors:
-            date_flavors[prod.date] = []
-        date_flavors[prod.date].append(prod.flavor)
-    
-    flavor_combinations = {}
-    for date, flavors in date_flavors.items():
-        for i in range(len(flavors)):
-            for j in range(i + 1, len(flavors)):
-                combo = tuple(sorted([flavors[i], flavors[j]]))
-                flavor_combinations[combo] = flavor_combinations.get(combo, 0) + 1
-    
-    top_combinations = sorted(
-        [{'flavors': list(k), 'count': v} for k, v in flavor_combinations.items()],
-        key=lambda x: x['count'],
-        reverse=True
-    )[:10]
+    flavor_production = analytics.run('flavor_production', days=days)
+    seasonal_data = analytics.run('seasonal_production')
+    daily_production = analytics.run('daily_production', days=days)
+    top_combinations = analytics.run('flavor_combinations', days=days, limit=10)
     
     return render_template('production_analytics.html',
                          days=days,
@@ -1209,52 +1054,32 @@ def efficiency_metrics():
     days = request.args.get('days', 30, type=int)
     from_date = datetime.utcnow() - timedelta(days=days)
     
-    production_times = db.session.query(
-        Production.flavor,
-        db.func.avg(db.func.strftime('%s', Production.end_time) - 
-                   db.func.strftime('%s', Production.start_time)).label('avg_time'),
-        db.func.count(Production.id).label('batch_count'),
-        db.func.avg(Production.quantity).label('avg_quantity')
-    ).filter(
-        Production.start_time >= from_date,
-        Production.end_time.isnot(None)
-    ).group_by(
-        Production.flavor
-    ).all()
-    
-    quality_metrics = db.session.query(
-        Production.flavor,
-        db.func.avg(Production.quality_score).label('avg_quality'),
-        db.func.sum(Production.waste_quantity).label('total_waste'),
-        db.func.avg(Production.waste_quantity).label('avg_waste')
-    ).filter(
-        Production.production_date >= from_date
-    ).group_by(
-        Production.flavor
-    ).all()
-    
-    cost_analysis = db.session.query(
-        Production.flavor,
-        db.func.avg(Production.cost).label('avg_cost'),
-        db.func.sum(Production.cost).label('total_cost'),
-        db.func.sum(Production.quantity).label('total_quantity')
-    ).filter(
-        Production.production_date >= from_date,
-        Production.cost.isnot(None)
-    ).group_by(
-        Production.flavor
-    ).all()
-    
-    cost_metrics = []
-    for cost in cost_analysis:
-        if cost.total_quantity and cost.total_quantity > 0:
-            cost_per_kg = cost.total_cost / cost.total_quantity
-            cost_metrics.append({
-                'flavor': cost.flavor,
-                'avg_cost': cost.avg_cost,
-                'total_cost': cost.total_cost,
-                'cost_per_kg': cost_per_kg
-            })
+    # One pass over the batch timelines, grouped per flavor and per day
+    batches = batch_metrics(days)
+    by_flavor = summarize(batches, ('flavor',))
+    
+    production_times = [{
+        'flavor': m['flavor'],
+        'avg_time': m['avg_cycle_hours'],
+        'batch_count': m['batches'],
+        'avg_quantity': m['kg'] / m['batches'],
+        'kg_per_hour': m['kg_per_hour']
+    } for m in by_flavor]
+    
+    quality_metrics = [{
+        'flavor': m['flavor'],
+        'avg_quality': m['avg_quality'],
+        'total_waste': m['waste_kg'],
+        'avg_waste': m['waste_kg'] / m['batches'],
+        'waste_pct': m['waste_pct']
+    } for m in by_flavor]
+    
+    cost_metrics = [{
+        'flavor': m['flavor'],
+        'avg_cost': m['cost'] / m['batches'],
+        'total_cost': m['cost'],
+        'cost_per_kg': m['cost_per_kg']
+    } for m in by_flavor if m['cost_per_kg']]
     
     ingredient_costs = db.session.query(
         ProductionCost.ingredient,
@@ -1268,19 +1093,11 @@ def efficiency_metrics():
         db.desc('total_cost')
     ).all()
     
-    daily_efficiency = db.session.query(
-        db.func.date(Production.production_date).label('date'),
-        db.func.avg(Production.quantity / (
-            db.func.strftime('%s', Production.end_time) - 
-            db.func.strftime('%s', Production.start_time) / 3600
-        )).label('kg_per_hour')
-    ).filter(
-        Production.production_date >= from_date,
-        Production.start_time.isnot(None),
-        Production.end_time.isnot(None)
-    ).group_by(
-        db.func.date(Production.production_date)
-    ).order_by(db.func.date(Production.production_date)).all()
+    daily_efficiency = [{
+        'date': m['day'],
+        'kg_per_hour': m['kg_per_hour'],
+        'waste_kg': m['waste_kg']
+    } for m in summarize(batches, ('day',)) if m['day']]
     
     return render_template('efficiency_metrics.html',
                          days=days,
@@ -1292,36 +1109,68 @@ def efficiency_metrics():
 
 @app.route('/efficiency_dashboard')
 def efficiency_dashboard():
-    productions = Production.query.filter(
-        Production.end_time.isnot(None)
-    ).order_by(Production.end_time.desc()).all()
-    
-    total_productions = len(productions)
-    success_rate = len([p for p in productions if p.success_status == 'success']) / total_productions if total_productions > 0 else 0
-    avg_quality = sum(p.quality_score or 0 for p in productions) / total_productions if total_productions > 0 else 0
-    total_cost = sum(p.production_cost or 0 for p in productions)
-    total_resource = sum(p.resource_usage or 0 for p in productions)
+    productions = batch_metrics(finished_only=True)
+    summary = summarize(productions, ())
+    totals = summary[0] if summary else {}
     
     production_times = [
         {
             'batch': p.batch_number,
-            'time': p.production_time,
-            'efficiency': p.efficiency_score,
-            'quality': p.quality_score
+            'time': round(p.cycle_hours, 2),
+            'efficiency': round(p.kg_per_hour, 2) if p.kg_per_hour else None,
+            'quality': p.quality
         }
-        for p in productions if p.production_time
+        for p in productions if p.cycle_hours
     ]
     
     return render_template(
         'efficiency_dashboard.html',
         productions=productions,
-        success_rate=success_rate,
-        avg_quality=avg_quality,
-        total_cost=total_cost,
-        total_resource=total_resource,
+        success_rate=totals.get('success_rate', 0),
+        avg_quality=totals.get('avg_quality'),
+        total_cost=totals.get('cost', 0),
+        total_waste=totals.get('waste_kg', 0),
+        kg_per_hour=totals.get('kg_per_hour'),
         production_times=production_times
     )
 
+@app.route('/api/production_metrics')
+def api_production_metrics():
+    """Throughput (kg/h), cycle time and waste per flavor and day, for capacity planning"""
+    days = request.args.get('days', 30, type=int)
+    group_by = tuple(f for f in request.args.get('group_by', 'flavor,day').split(',') if f)
+    if not set(group_by) <= {'flavor', 'day'}:
+        return jsonify({'error': 'group_by admite flavor y/o day'}), 400
+    return jsonify({'days': days, 'group_by': list(group_by), 'metrics': summarize(batch_metrics(days), group_by)})
+
+@app.route('/api/productions/<int:production_id>/events', methods=['GET', 'POST'])
+def production_events(production_id):
+    production = Production.query.get_or_404(production_id)
+    if request.method == 'GET':
+        events = production.events.order_by(ProductionEvent.occurred_at, ProductionEvent.id).all()
+        return jsonify({'production_id': production_id, 'events': [event_to_dict(e) for e in events]})
+    
+    try:
+        data = request.get_json() or {}
+        if data.get('type') in ('start', 'finish'):
+            return jsonify({'success': False, 'error': 'El inicio y fin se registran al crear y finalizar la producción'}), 400
+        event = record_event(
+            production,
+            data.get('type'),
+            quantity=float(data['quantity']) if data.get('quantity') is not None else None,
+            score=float(data['score']) if data.get('score') is not None else None,
+            operator=data.get('operator'),
+            notes=data.get('notes')
+        )
+        db.session.commit()
+        return jsonify({'success': True, 'event': event_to_dict(event)}), 201
+    except (TimelineError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/products')
 def products():
     # Get all categories and organize products by category
@@ -1474,19 +1323,20 @@ def get_flavors():
         if not flavors_category:
             return jsonify({'error': 'Categoría de sabores no encontrada'}), 404
 
-        # Get all products in the flavors category with their stock
-        products = db.session.query(Product, Stock)\
-            .join(Stock, and_(Stock.product_id == Product.id, Stock.store_id == store_id))\
-            .filter(Product.category_id == flavors_category.id)\
-            .all()
+        # Get all products in the flavors category with their stock (from the snapshot)
+        products = Product.query.filter(Product.category_id == flavors_category.id).all()
+        levels = stock_snapshot.store(store_id)
 
         flavors_data = []
-        for product, stock in products:
+        for product in products:
+            level = levels.get(product.id)
+            if level is None:
+                continue
             flavor_data = {
                 'id': product.id,
                 'name': product.name,
-                'quantity': stock.quantity if stock else 0,
-                'status': 'Bajo stock' if stock and stock.quantity < 5 else 'OK'
+                'quantity': level.quantity,
+                'status': 'Bajo stock' if level.quantity < 5 else 'OK'
             }
             flavors_data.append(flavor_data)
 
@@ -1505,10 +1355,9 @@ def add_to_cart():
         quantity = data.get('quantity', 1)
         flavors = data.get('flavors', [])  # New field for flavors
         
-        product = Product.query.get_or_404(product_id)
-        
-        if not 'cart' in session:
-            session['cart'] = []
+        product = product_cache.get(product_id) if product_id is not None else None
+        if not product:
+            return jsonify({'success': False, 'error': 'Producto no encontrado'}), 404
         
         # Check if product requires flavors (potes)
         if product.sales_format and 'KG' in product.sales_format.upper() and not flavors:
@@ -1522,25 +1371,23 @@ def add_to_cart():
                 'error': f'Este producto permite máximo {product.max_flavors} sabores'
             }), 400
         
-        cart_item = {
-            'product_id': product_id,
-            'quantity': quantity,
-            'unit_price': float(product.price),
-            'total_price': float(product.price * quantity),
+        # Only the new line is written; the cart itself lives server side
+        cart_id = current_cart_id('pos', create=True)
+        store = get_cart_store()
+        store.add_line(cart_id, 'pos', product.id, quantity, float(product.price), {
             'name': product.name,
             'flavors': flavors
-        }
-        
-        session['cart'].append(cart_item)
-        session.modified = True
+        })
         
         return jsonify({
             'success': True,
             'message': 'Producto agregado al carrito',
-            'cart': session['cart']
+            'cart_id': cart_id,
+            'cart': store.load(cart_id)
         })
         
     except Exception as e:
+        db.session.rollback()
         print(f"Error adding to cart: {str(e)}")
         return jsonify({
             'success': False,
@@ -1550,20 +1397,19 @@ def add_to_cart():
 @app.route('/api/get_cart')
 def get_cart():
     try:
-        cart = session.get('cart', [])
-        total = sum(float(item['total_price']) for item in cart)
+        cart = load_cart('pos')
+        total = cart.total
         
         cart_html = ''
         for idx, item in enumerate(cart):
-            product = Product.query.get(item['product_id'])
-            if not product:
+            if not item.get('name'):
                 continue
                 
             cart_html += f'''
-            <div class="cart-item mb-2" data-index="{idx}" tabindex="0">
+            <div class="cart-item mb-2" data-index="{idx}" data-line-id="{item['line_id']}" tabindex="0">
                 <div class="d-flex justify-content-between align-items-center">
                     <div>
-                        <strong>{product.name}</strong>
+                        <strong>{item['name']}</strong>
                         {f"<br><small>Sabores: {', '.join(item['flavors'])}</small>" if item.get('flavors') else ""}
                         <div><small>{item['quantity']} x ${item['unit_price']}</small></div>
                     </div>
@@ -1581,6 +1427,7 @@ def get_cart():
         
         return jsonify({
             'status': 'success',
+            'cart_id': cart.cart_id,
             'cart_html': cart_html,
             'total': f"${total:.2f}"
         })
@@ -1592,18 +1439,27 @@ def get_cart():
             'message': str(e)
         }), 500
 
+def _resolve_cart_line(cart_id, data):
+    """Line id from the request: explicit line_id, or the position sent by older clients"""
+    if data.get('line_id') is not None:
+        return int(data['line_id'])
+    if data.get('index') is None:
+        return None
+    return get_cart_store().line_id_at(cart_id, int(data['index']))
+
 @app.route('/api/cart/update_item', methods=['POST'])
 def cart_update_item():
-    """Update cart item quantity by index with delta or direct quantity."""
+    """Update cart item quantity by line id (or index) with delta or direct quantity."""
     try:
         data = request.get_json() or {}
-        index = int(data.get('index'))
         delta = data.get('delta')
         quantity = data.get('quantity')
-        cart = session.get('cart', [])
-        if index < 0 or index >= len(cart):
+        cart_id = current_cart_id('pos')
+        line_id = _resolve_cart_line(cart_id, data) if cart_id else None
+        line = get_cart_store().get_line(cart_id, line_id) if line_id is not None else None
+        if line is None:
             return jsonify({'status': 'error', 'message': 'Ítem inválido'}), 400
-        current_qty = int(cart[index].get('quantity', 1))
+        current_qty = int(line.get('quantity', 1))
         if delta is not None:
             try:
                 current_qty += int(delta)
@@ -1614,46 +1470,41 @@ def cart_update_item():
                 current_qty = int(quantity)
             except Exception:
                 return jsonify({'status': 'error', 'message': 'Cantidad inválida'}), 400
-        if current_qty <= 0:
-            cart.pop(index)
-        else:
-            cart[index]['quantity'] = current_qty
-            cart[index]['total_price'] = float(cart[index]['unit_price']) * current_qty
-        session['cart'] = cart
-        session.modified = True
+        get_cart_store().set_quantity(cart_id, 'pos', line_id, current_qty)
         # return updated cart
         return get_cart()
     except Exception as e:
+        db.session.rollback()
         print(f"Error updating cart item: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/api/cart/remove_item', methods=['POST'])
 def cart_remove_item():
-    """Remove cart item by index."""
+    """Remove cart item by line id (or index)."""
     try:
         data = request.get_json() or {}
-        index = int(data.get('index'))
-        cart = session.get('cart', [])
-        if index < 0 or index >= len(cart):
+        cart_id = current_cart_id('pos')
+        line_id = _resolve_cart_line(cart_id, data) if cart_id else None
+        if line_id is None or not get_cart_store().remove_line(cart_id, 'pos', line_id):
             return jsonify({'status': 'error', 'message': 'Ítem inválido'}), 400
-        cart.pop(index)
-        session['cart'] = cart
-        session.modified = True
         return get_cart()
     except Exception as e:
+        db.session.rollback()
         print(f"Error removing cart item: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/api/clear_cart', methods=['POST'])
 def clear_cart():
     try:
-        session.pop('cart', None)
-        session.modified = True
+        cart_id = current_cart_id('pos')
+        if cart_id:
+            get_cart_store().clear(cart_id)
         return jsonify({
             'status': 'success',
             'message': 'Carrito limpiado'
         })
     except Exception as e:
+        db.session.rollback()
         print(f"Error clearing cart: {str(e)}")
         return jsonify({
             'status': 'error',
@@ -1670,9 +1521,9 @@ def process_sale():
             print("Error: No data provided")
             return jsonify({'error': 'No data provided'}), 400
 
-        # Get cart from session
-        cart = session.get('cart', [])
-        print("Cart from session:", cart)
+        # Get cart from the server-side cart store
+        cart = load_cart('pos')
+        print("Cart from store:", cart)
         
         if not cart:
             print("Error: Cart is empty")
@@ -1738,69 +1589,28 @@ def process_sale():
         db.session.add(sale)
         db.session.flush()  # Get sale.id without committing
 
-        # Process sale items with stock validation
-        stock_errors = []
-        for item in cart:
-            try:
-                print(f"Checking stock for product {item['product_id']}")
-                # Validate stock availability
-                stock = Stock.query.filter_by(store_id=store_id, product_id=item['product_id']).with_for_update().first()
-                
-                if not stock:
-                    error_msg = f"Product {item['product_id']} not found in stock"
-                    print(f"Error: {error_msg}")
-                    stock_errors.append(error_msg)
-                    continue
-                
-                print(f"Current stock quantity: {stock.quantity}, Requested quantity: {float(item['quantity'])}")
-                if stock.quantity is None or stock.quantity < float(item['quantity']):
-                    product = Product.query.get(item['product_id'])
-                    error_msg = f"No hay stock suficiente de {product.name}"
-                    print(f"Error: {error_msg}")
-                    stock_errors.append(error_msg)
-                    continue
-
-                # Create sale item
-                sale_item = SaleItem(
-                    sale_id=sale.id,
-                    product_id=item['product_id'],
-                    quantity=float(item['quantity']),
-                    unit_price=float(item['unit_price']),
-                    total_price=float(item['total_price'])
-                )
-                
-                # Set flavors if present
-                if 'flavors' in item and item['flavors']:
-                    sale_item.set_flavors_list(item['flavors'])
-                
-                db.session.add(sale_item)
-
-                # Update stock
-                stock.quantity = stock.quantity - float(item['quantity'])
-                print(f"Updated stock quantity: {stock.quantity}")
-                
-                # Create stock history entry
-                stock_history = StockHistory(
-                    store_id=store_id,
-                    product_id=item['product_id'],
-                    quantity_change=-float(item['quantity']),
-                    reason=f'Venta #{sale.id}'
-                )
-                db.session.add(stock_history)
-
-            except Exception as e:
-                error_msg = f"Error processing product {item['product_id']}: {str(e)}"
-                print(f"Exception: {error_msg}")
-                stock_errors.append(error_msg)
+        # Expand potes into flavor kg + envases and decrement stock in one pass
+        bom = expand_cart(cart)
+        if bom.errors:
+            db.session.rollback()
+            return jsonify({'error': 'Stock validation failed', 'details': bom.errors}), 400
+        try:
+            reservation = stock_engine.reserve(store_id, bom.lines, reason=f'Venta #{sale.id}')
+        except StockConflictError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 409
 
         # If there were any stock errors, rollback and return error
-        if stock_errors:
-            print(f"Stock validation failed: {stock_errors}")
+        if not reservation.ok:
+            print(f"Stock validation failed: {reservation.error_messages}")
             db.session.rollback()
             return jsonify({
                 'error': 'Stock validation failed',
-                'details': stock_errors
+                'details': reservation.error_messages,
+                'shortfalls': reservation.shortfalls
             }), 400
+
+        stock_engine.insert_sale_items(sale.id, cart)
         
         # Handle delivery if needed
         if is_delivery and delivery_data:
@@ -1868,33 +1678,20 @@ def process_sale():
                 db.session.rollback()
                 return jsonify({'error': f'Error processing delivery: {str(e)}'}), 500
         
-        # Create MercadoPago payment link
-        mp = MercadoPagoIntegration()
-        if mp.is_configured:
-            try:
-                success, response = mp.create_preference(sale)
-                if success:
-                    # Update sale with MercadoPago info
-                    sale.mp_payment_link = response.get('payment_link')
-                    sale.mp_qr_link = response.get('qr_code')
-                    sale.mp_preference_id = response.get('id')
-                    sale.mp_status = 'pending'
-                    sale.mp_created_at = datetime.now()
-                    sale.mp_payment_type = payment_method
-                    sale.mp_payment_method = payment_method
-                else:
-                    print(f"Warning: MercadoPago preference creation failed: {response}")
-            except Exception as e:
-                print(f"Warning: Error creating MercadoPago preference: {str(e)}")
+        # MercadoPago link is created by the payment queue once the sale is committed
+        payment_link_pending = payment_method != 'cash' and mp_integration.is_configured
+        if payment_link_pending:
+            sale.mp_status = 'pending'
+            sale.mp_payment_type = payment_method
+            sale.mp_payment_method = payment_method
+            payment_queue.enqueue(db.session, sale.id)
 
         # Prepare receipt payload before clearing cart
         receipt_items = []
+        product_names = bom.names
         for item in cart:
-            product = Product.query.get(item['product_id'])
-            if not product:
-                continue
             receipt_items.append({
-                'name': product.name,
+                'name': product_names.get(int(item['product_id'])),
                 'quantity': int(item.get('quantity', 1)),
                 'unit_price': float(item.get('unit_price', 0)),
                 'total_price': float(item.get('total_price', 0)),
@@ -1910,19 +1707,19 @@ def process_sale():
             'items': receipt_items
         }
 
+        # Clear the cart in the same transaction as the sale
+        get_cart_store().clear(cart.cart_id, commit=False)
+
         # Commit all changes
         db.session.commit()
-
-        # Clear the cart
-        session.pop('cart', None)
-        session.modified = True
         
         return jsonify({
             'status': 'success',
             'message': 'Venta procesada correctamente',
             'sale_id': sale.id,
-            'qr_link': sale.mp_qr_link if hasattr(sale, 'mp_qr_link') else None,
-            'payment_link': sale.mp_payment_link if hasattr(sale, 'mp_payment_link') else None,
+            'qr_link': None,
+            'payment_link': None,
+            'payment_link_pending': payment_link_pending,
             'receipt': receipt_payload
         })
         
@@ -1950,6 +1747,20 @@ def select_store():
     next_page = request.args.get('next_page', 'index')
     return render_template('select_store.html', stores=stores, next_page=next_page)
 
+def _save_payment_status(sale_id, **fields):
+    """Store the status MercadoPago reported for a sale, from a GET request.
+
+    GETs run in deferred read transactions under the SQLite profile; a write
+    there fails with 'database is locked' once another connection commits
+    after the first read. So this writes in a transaction of its own.
+    """
+    with sqlite_profile.write_intent():
+        sale = db.session.get(Sale, sale_id)
+        for name, value in fields.items():
+            setattr(sale, name, value)
+        sale.mp_last_updated = datetime.now()
+        db.session.commit()
+
 @app.route('/api/payment_status/<int:sale_id>', methods=['GET'])
 def api_payment_status(sale_id):
     try:
@@ -1957,27 +1768,34 @@ def api_payment_status(sale_id):
         # Fast path
         if sale.mp_status == 'approved' or sale.payment_status == 'approved':
             return jsonify({'status': 'approved'})
+        link = payment_queue.status(sale_id)
+        if link is not None and link['status'] != 'done':
+            # Preference not created yet: no payment can exist, don't ask MP
+            payment_queue.ensure_worker()
+            return jsonify({
+                'status': 'pending',
+                'link_status': link['status'],
+                'link_error': link['last_error'] if link['status'] == 'failed' else None
+            })
+        links = {'payment_link': link['payment_link'], 'qr_link': link['qr_link']} if link else {}
         if mp_integration.is_configured:
+            payment_id = sale.mp_payment_id
+            # No transaction left open while MercadoPago answers
+            db.session.rollback()
             # Prefer direct payment id if available
-            if sale.mp_payment_id:
-                success, status = mp_integration.get_payment_status(sale.mp_payment_id)
+            if payment_id:
+                success, status = mp_integration.get_payment_status(payment_id)
                 if success:
-                    sale.mp_status = status
-                    sale.payment_status = status
-                    sale.mp_last_updated = datetime.now()
-                    db.session.commit()
-                    return jsonify({'status': status})
+                    _save_payment_status(sale_id, mp_status=status, payment_status=status)
+                    return jsonify({'status': status, **links})
             # Fallback to external_reference search (sale id)
-            success, result = mp_integration.get_status_by_external_reference(str(sale.id))
+            success, result = mp_integration.get_status_by_external_reference(str(sale_id))
             if success:
-                sale.mp_payment_id = result.get('payment_id')
-                sale.mp_status = result.get('status')
-                sale.payment_status = result.get('status')
-                sale.mp_last_updated = datetime.now()
-                db.session.commit()
-                return jsonify({'status': result.get('status')})
-            return jsonify({'status': 'unknown'})
-        return jsonify({'status': sale.mp_status or 'pending'})
+                _save_payment_status(sale_id, mp_payment_id=result.get('payment_id'),
+                                     mp_status=result.get('status'), payment_status=result.get('status'))
+                return jsonify({'status': result.get('status'), **links})
+            return jsonify({'status': 'unknown', **links})
+        return jsonify({'status': sale.mp_status or 'pending', **links})
     except Exception as e:
         print(f"Error in api_payment_status: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -2353,41 +2171,18 @@ def mass_edit_minimum_stock(store_id):
 
 @app.route('/dashboard')
 def dashboard():
-    # Get total production
-    total_production = db.session.query(db.func.sum(Production.quantity)).scalar() or 0
-    
-    # Get total active stores
-    total_stores = Store.query.count()
-    
-    # Get total active flavors (products in Sabores category)
-    flavor_category = ProductCategory.query.filter_by(name='Sabores').first()
-    total_flavors = Product.query.filter_by(
-        category_id=flavor_category.id if flavor_category else None,
-        active=True
-    ).count() if flavor_category else 0
-    
-    # Get low stock count
-    low_stock_count = Stock.query.join(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id).filter(Stock.quantity <= GeneralMinimum.quantity).count()
-    
     return render_template('dashboard.html',
-                         total_production=total_production,
-                         total_stores=total_stores,
-                         total_flavors=total_flavors,
-                          low_stock_count=low_stock_count,
-                          stores=Store.query.all())
+                         total_production=analytics.run('total_production'),
+                         total_stores=analytics.run('store_count'),
+                         total_flavors=analytics.run('active_flavor_count'),
+                         low_stock_count=analytics.run('low_stock_count'),
+                         stores=analytics.run('stores'))
 
 @app.route('/api/production_data')
 def production_data():
     # Get last 7 days of production data
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    daily_production = db.session.query(
-        db.func.date(Production.production_date).label('date'),
-        db.func.sum(Production.quantity).label('total')
-    ).filter(
-        Production.production_date >= seven_days_ago
-    ).group_by(
-        db.func.date(Production.production_date)
-    ).order_by(db.func.date(Production.production_date)).all()
+    daily_production = analytics.run('daily_production', days=7)
     
     # Format data for Chart.js
     labels = []
@@ -2475,7 +2270,8 @@ def search_customer():
     if not query:
         return jsonify([])
     
-    results = DeliveryAddress.search(query)
+    limit = request.args.get('limit', 20, type=int)
+    results = DeliveryAddress.search(query, limit=max(1, min(limit, 100)))
     customers = []
     
     for addr, score in results:
@@ -2574,14 +2370,24 @@ def edit_store(store_id):
 
 @app.route('/deliveries')
 def deliveries():
-    # Get all delivery orders with their related data
-    deliveries = (DeliveryOrder.query
-                 .join(Sale)
-                 .join(Store)
-                 .join(DeliveryAddress)
-                 .join(DeliveryStatus)
-                 .order_by(DeliveryOrder.created_at.desc())
-                 .all())
+    # Delivery orders with their related data, newest first, one page at a time
+    query = (DeliveryOrder.query
+             .join(Sale)
+             .join(Store)
+             .join(DeliveryAddress)
+             .join(DeliveryStatus)
+             .options(contains_eager(DeliveryOrder.sale).contains_eager(Sale.store),
+                      contains_eager(DeliveryOrder.address),
+                      contains_eager(DeliveryOrder.current_status),
+                      selectinload(DeliveryOrder.status_history)))
+    try:
+        deliveries, next_cursor = keyset_page(
+            query, [DeliveryOrder.created_at, DeliveryOrder.id],
+            cursor=request.args.get('cursor'), limit=parse_limit(request.args.get('limit'))
+        )
+    except InvalidCursorError:
+        return redirect(url_for('deliveries'))
+    total_deliveries = query.order_by(None).count() if request.args.get('include_total') else None
     
     # Get all stores and statuses for filters
     stores = Store.query.all()
@@ -2589,6 +2395,8 @@ def deliveries():
     
     return render_template('deliveries.html',
                          deliveries=deliveries,
+                         next_cursor=next_cursor,
+                         total_deliveries=total_deliveries,
                          stores=stores,
                          delivery_statuses=delivery_statuses,
                          google_maps_api_key=app.config['GOOGLE_MAPS_API_KEY'])
@@ -2733,23 +2541,8 @@ def send_payment(delivery_id):
 
 @app.route('/webhook/mercadopago', methods=['POST'])
 def mercadopago_webhook():
-    try:
-        data = request.json
-        
-        if data["type"] == "payment":
-            payment_id = data["data"]["id"]
-            payment = mp_integration.mp.payment().get(payment_id)
-            
-            delivery_id = int(payment["response"]["external_reference"])
-            delivery = DeliveryOrder.query.get(delivery_id)
-            
-            if delivery:
-                delivery.mp_status = payment["response"]["status"]
-                db.session.commit()
-        
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    # Same queued ingestion as /payment/webhook
+    return receive_notification()
 
 @app.route('/delete_store/<int:store_id>', methods=['POST'])
 def delete_store(store_id):
@@ -2765,8 +2558,8 @@ def delete_store(store_id):
         # Delete related stock records
         Stock.query.filter_by(store_id=store_id).delete()
         
-        # Delete related stock history
-        StockHistory.query.filter_by(store_id=store_id).delete()
+        # Delete related stock history and its snapshots
+        delete_store_ledger(db.session, store_id)
         
         # Delete the store
         db.session.delete(store)
@@ -2892,34 +2685,149 @@ def stock_data():
     store_id = request.args.get('store_id', type=int)
     flavor = request.args.get('flavor')
     
-    # Start with a base query joining Stock, Product, Store, and GeneralMinimum
-    query = db.session.query(Stock, Product, Store, GeneralMinimum)\
-        .join(Product, Stock.product_id == Product.id)\
-        .join(Store, Stock.store_id == Store.id)\
-        .outerjoin(GeneralMinimum, Stock.product_id == GeneralMinimum.product_id)
-    
-    # Apply filters
-    if store_id:
-        query = query.filter(Stock.store_id == store_id)
+    # Stock levels come from the per-store snapshot; products, stores and minimums are small tables
+    stores = Store.query.filter(Store.id == store_id).all() if store_id else Store.query.order_by(Store.id).all()
+    products_query = Product.query
     if flavor:
-        query = query.filter(Product.name == flavor)
+        products_query = products_query.filter(Product.name == flavor)
+    products = products_query.order_by(Product.id).all()
+    minimums = {m.product_id: m.quantity for m in GeneralMinimum.query.all()}
     
-    # Execute query and format results
+    # Format results
     result = []
-    for stock, product, store, min_stock in query.all():
-        min_quantity = min_stock.quantity if min_stock else 0
-        result.append({
-            'store': store.name,
-            'store_id': store.id,
-            'product_id': product.id,
-            'flavor': product.name,
-            'current_quantity': float("%.2f" % (stock.quantity or 0)),
-            'minimum_quantity': float("%.2f" % min_quantity),
-            'status': 'Bajo stock' if (stock.quantity or 0) <= min_quantity else 'OK'
-        })
+    for store in stores:
+        levels = stock_snapshot.store(store.id)
+        for product in products:
+            level = levels.get(product.id)
+            if level is None:
+                continue
+            min_quantity = minimums.get(product.id) or 0
+            result.append({
+                'store': store.name,
+                'store_id': store.id,
+                'product_id': product.id,
+                'flavor': product.name,
+                'current_quantity': float("%.2f" % level.quantity),
+                'minimum_quantity': float("%.2f" % min_quantity),
+                'status': 'Bajo stock' if level.quantity <= min_quantity else 'OK'
+            })
     
     return jsonify(result)
 
+def parse_stock_instant(value):
+    """UTC instant from an ISO timestamp; a bare date means the end of that day"""
+    if not value:
+        return datetime.utcnow()
+    if len(value) == 10:
+        return datetime.combine(datetime.strptime(value, '%Y-%m-%d').date() + timedelta(days=1), datetime.min.time())
+    return datetime.fromisoformat(value.replace('Z', '')).replace(tzinfo=None)
+
+def parse_id_list(name):
+    """?name=1&name=2 or ?name=1,2 as a list of ints (None when absent)"""
+    values = [part for value in request.args.getlist(name) for part in value.split(',') if part.strip()]
+    return [int(value) for value in values] if values else None
+
+@app.route('/api/stock/as_of')
+def stock_as_of():
+    """Stock of a store (optionally some products) at a past instant, from the stock ledger"""
+    try:
+        store_id = request.args.get('store_id', type=int)
+        if not store_id:
+            return jsonify({'error': 'store_id es requerido'}), 400
+        at = parse_stock_instant(request.args.get('at') or request.args.get('date'))
+        product_ids = parse_id_list('product_id')
+    except ValueError as e:
+        return jsonify({'error': f'Parámetro inválido: {str(e)}'}), 400
+
+    quantities = stock_at(db.session, store_id, at, product_ids)
+    checkpoint = checkpoint_before(db.session, at)
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(list(quantities))).all()) if quantities else {}
+    return jsonify({
+        'store_id': store_id,
+        'at': at.isoformat(),
+        'checkpoint': checkpoint.isoformat() if checkpoint else None,
+        'stock': [{'product_id': product_id, 'product': names.get(product_id), 'quantity': quantity}
+                  for product_id, quantity in sorted(quantities.items())]
+    })
+
+@app.route('/api/stock/matrix')
+def stock_matrix_as_of():
+    """Stock of every store x product at a past instant (?date=YYYY-MM-DD is the end of that day)"""
+    try:
+        at = parse_stock_instant(request.args.get('at') or request.args.get('date'))
+        store_ids = parse_id_list('store_id')
+        product_ids = parse_id_list('product_id')
+    except ValueError as e:
+        return jsonify({'error': f'Parámetro inválido: {str(e)}'}), 400
+
+    quantities = stock_matrix(db.session, at, store_ids, product_ids)
+    store_index = sorted({store_id for store_id, _ in quantities})
+    product_index = sorted({product_id for _, product_id in quantities})
+    store_names = dict(db.session.query(Store.id, Store.name).all())
+    product_names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(product_index)).all()) if product_index else {}
+    return jsonify({
+        'at': at.isoformat(),
+        'stores': [{'id': store_id, 'name': store_names.get(store_id)} for store_id in store_index],
+        'products': [{'id': product_id, 'name': product_names.get(product_id)} for product_id in product_index],
+        # quantities[i][j]: store i, product j (null where the store never had the product)
+        'quantities': [[quantities.get((store_id, product_id)) for product_id in product_index] for store_id in store_index]
+    })
+
+@app.route('/api/stock_snapshot/stats')
+def stock_snapshot_stats():
+    """Hit/miss counters of the in-memory stock snapshot"""
+    return jsonify(stock_snapshot.stats())
+
+@app.route('/api/sql_profile/stats')
+def sql_profile_stats():
+    """Queries, DB time and repeated statements (N+1) per endpoint; ?reset=1 clears them"""
+    stats = sql_profiler.stats()
+    if request.args.get('reset') == '1':
+        sql_profiler.reset()
+    return jsonify(stats)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape: latency histograms, errors, DB and outbound time, caches and queues"""
+    body = metrics.render(
+        sql=sql_profiler.stats() if sql_profiler.enabled else None,
+        caches={
+            'stock_snapshot': stock_snapshot.stats(),
+            'product': product_cache.stats(),
+            'analytics': analytics.analytics_cache.stats()
+        },
+        queues={
+            'payment_links': payment_queue.stats(),
+            'notifications': notification_queue.stats()
+        },
+        writers=sqlite_profile.writers.stats() if sqlite_profile.enabled else None,
+        replica=analytics_replica.stats() if analytics_replica.enabled else None
+    )
+    return Response(body, content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/metrics/latency')
+def metrics_latency():
+    """p50/p95/p99 latency per endpoint since this worker started"""
+    return jsonify(metrics.latency_summary())
+
+@app.route('/api/sqlite_profile/stats')
+def sqlite_profile_stats():
+    """Pragmas in effect and writer queue counters (waits, timeouts) of the SQLite profile"""
+    return jsonify(sqlite_profile.stats())
+
+@app.route('/api/analytics_replica/stats')
+def analytics_replica_stats():
+    """Staleness, refreshes and requests served by the analytics replica"""
+    return jsonify(analytics_replica.stats())
+
+@app.route('/api/payment_queue/stats')
+def payment_queue_stats():
+    """Job counts per state of the MercadoPago preference and notification queues"""
+    return jsonify({
+        'payment_links': payment_queue.stats(),
+        'notifications': notification_queue.stats()
+    })
+
 @app.route('/debug_sales')
 def debug_sales():
     try:
@@ -3016,10 +2924,8 @@ def recipes():
             ri.ingredient.current_stock >= ri.quantity 
             for ri in recipe.ingredients
         )
-        recipe.total_cost = sum(
-            ri.quantity * ri.ingredient.cost_per_unit 
-            for ri in recipe.ingredients
-        )
+        costing = recipe_costs.recipe(recipe.id)
+        recipe.total_cost = costing.cost_per_kg if costing else 0
     return render_template('recipes.html', recipes=recipes_list)
 
 @app.route('/ingredient_transactions')
@@ -3097,77 +3003,20 @@ def get_stock_analytics_data():
     selected_product_id = request.args.get('product_id', type=int)
     days = request.args.get('days', 30, type=int)
     
-    from_date = datetime.utcnow() - timedelta(days=days)
-    
-    # Build query for daily changes
-    query = db.session.query(
-        StockHistory.timestamp,
-        db.func.sum(StockHistory.quantity_change).label('quantity_change')
-    )
-    
-    if selected_store_id:
-        query = query.filter(StockHistory.store_id == selected_store_id)
-    if selected_product_id:
-        query = query.filter(StockHistory.product_id == selected_product_id)
-    
-    daily_changes = query.filter(
-        StockHistory.timestamp >= from_date
-    ).group_by(
-        db.func.date(StockHistory.timestamp)
-    ).order_by(StockHistory.timestamp).all()
-    
-    # Get depletion rates
-    depletion_query = db.session.query(
-        StockHistory.store_id,
-        StockHistory.product_id,
-        Store.name.label('store_name'),
-        Product.name.label('product'),
-        db.func.avg(StockHistory.quantity_change).label('avg_change')
-    ).join(Store).join(Product).filter(
-        StockHistory.reason == 'sale'
-    )
-    
-    if selected_store_id:
-        depletion_query = depletion_query.filter(StockHistory.store_id == selected_store_id)
-    if selected_product_id:
-        depletion_query = depletion_query.filter(StockHistory.product_id == selected_product_id)
-    
-    depletion_rates = depletion_query.group_by(
-        StockHistory.store_id,
-        StockHistory.product_id
-    ).all()
-    
-    # Process depletion rates to include absolute values
-    processed_depletion_rates = []
-    for rate in depletion_rates:
-        processed_depletion_rates.append({
-            'store_id': rate.store_id,
-            'product_id': rate.product_id,
-            'store_name': rate.store_name,
-            'product': rate.product,
-            'avg_change': rate.avg_change,
-            'abs_change': abs(rate.avg_change) if rate.avg_change else 0
-        })
-    
-    # Get current stock and predictions
-    current_stock = Stock.query.all()
-    stock_predictions = []
-    for stock in current_stock:
-        depletion_rate = next(
-            (r.avg_change for r in depletion_rates 
-             if r.store_id == stock.store_id and r.product_id == stock.product_id),
-            0
-        )
-        if depletion_rate < 0:
-            days_until_empty = abs(stock.quantity / depletion_rate) if depletion_rate else float('inf')
-            stock_predictions.append({
-                'store_id': stock.store_id,
-                'store_name': stock.store.name,
-                'product': stock.product.name,
-                'current_quantity': stock.quantity,
-                'days_until_empty': days_until_empty,
-                'predicted_date': datetime.utcnow() + timedelta(days=days_until_empty)
-            })
+    daily_changes = analytics.run('stock_daily_changes', days=days,
+                                  store_id=selected_store_id, product_id=selected_product_id)
+    
+    # Depletion forecast: smoothed daily sales with weekday seasonality for every pair at once
+    forecast = depletion_forecast(selected_store_id, selected_product_id, days=days)
+    processed_depletion_rates = [{
+        'store_id': f['store_id'],
+        'product_id': f['product_id'],
+        'store_name': f['store_name'],
+        'product': f['product'],
+        'avg_change': -f['daily_rate'],
+        'abs_change': f['daily_rate']
+    } for f in forecast]
+    stock_predictions = [f for f in forecast if f['predicted_date'] is not None]
     
     # Format daily changes for chart
     formatted_daily_changes = [
@@ -3181,7 +3030,7 @@ def get_stock_analytics_data():
     return jsonify({
         'daily_changes': formatted_daily_changes,
         'depletion_rates': processed_depletion_rates,
-        'stock_predictions': sorted(stock_predictions, key=lambda x: x['days_until_empty'])[:10]
+        'stock_predictions': stock_predictions[:10]
     })
 
 @app.route('/production-orders')
@@ -3205,9 +3054,20 @@ def list_production_orders():
         if product_id:
             query = query.filter(ProductionOrder.product_id == product_id)
             
-        # Order by priority (high to low) and created date (newest first)
-        orders = query.order_by(ProductionOrder.priority.desc(), 
-                              ProductionOrder.created_at.desc()).all()
+        # Cursor mode (?cursor=, empty for the first page): newest first, seek on (created_at, id)
+        cursor_mode = 'cursor' in request.args
+        if cursor_mode:
+            try:
+                orders, next_cursor = keyset_page(
+                    query, [ProductionOrder.created_at, ProductionOrder.id],
+                    cursor=request.args.get('cursor'), limit=parse_limit(request.args.get('limit'))
+                )
+            except InvalidCursorError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            # Order by priority (high to low) and created date (newest first)
+            orders = query.order_by(ProductionOrder.priority.desc(), 
+                                  ProductionOrder.created_at.desc()).all()
         
         order_list = []
         for order in orders:
@@ -3232,6 +3092,12 @@ def list_production_orders():
                 app.logger.error(f'Error processing order {order.id}: {str(order_error)}')
                 continue
         
+        if cursor_mode:
+            return jsonify({
+                'orders': order_list,
+                'next_cursor': next_cursor,
+                'total': query.order_by(None).count() if request.args.get('include_total') else None
+            }), 200
         return jsonify(order_list), 200
     except Exception as e:
         app.logger.error(f'Error in list_production_orders: {str(e)}')
@@ -3360,6 +3226,7 @@ def update_production_order_status(order_id):
             
         old_status_id = order.status_id
         new_status_id = data['status_id']
+        ingredient_shortages = []
             
         # Update order status
         order.status_id = new_status_id
@@ -3379,6 +3246,7 @@ def update_production_order_status(order_id):
             if production:
                 # Only delete if it hasn't been assigned to a store yet
                 if not production.assigned_store_id:
+                    release_ingredients(db.session, production)
                     db.session.delete(production)
                 order.production_id = None
         
@@ -3398,11 +3266,19 @@ def update_production_order_status(order_id):
                 production_date=datetime.utcnow(),
                 operator='Sistema',  # or get from session if you have user authentication
                 notes=f'Creado automáticamente desde orden de producción #{order.order_number}',
-                production_cost=0  # Set initial cost to 0
+                production_cost=recipe_costs.production_cost(product.id, order.quantity)
             )
             
             db.session.add(production)
             db.session.flush()  # This will assign the ID to the production object
+
+            # The batch started when the order went "En Proceso" (2)
+            started = db.session.query(db.func.max(ProductionOrderHistory.created_at)).filter(
+                ProductionOrderHistory.order_id == order.id,
+                ProductionOrderHistory.status_id == 2
+            ).scalar()
+            record_event(production, 'start', started or production.production_date, operator='Sistema')
+            ingredient_shortages = consume_ingredients(db.session, production, product.id).shortages
             
             # Link the production to the order
             order.production_id = production.id
@@ -3410,12 +3286,31 @@ def update_production_order_status(order_id):
         db.session.commit()
         
         return jsonify({
-            'message': 'Production order status updated successfully'
+            'message': 'Production order status updated successfully',
+            'ingredient_shortages': ingredient_shortages
         }), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/production_orders/ingredient_plan', methods=['GET'])
+def production_orders_ingredient_plan():
+    """Aggregated ingredient requirements of all open orders versus stock"""
+    try:
+        return jsonify(plan_ingredient_requirements())
+    except Exception as e:
+        print(f"Error planning ingredients: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/recipes/costs', methods=['GET'])
+def recipe_cost_list():
+    return jsonify({'recipes': [{
+        'recipe_id': r.recipe_id,
+        'product_id': r.product_id,
+        'name': r.name,
+        'cost_per_kg': r.cost_per_kg
+    } for r in sorted(recipe_costs.all(), key=lambda r: r.name)]})
+
 @app.route('/api/production_orders/<int:order_id>', methods=['DELETE'])
 def delete_production_order(order_id):
     try:
@@ -3648,6 +3543,9 @@ if __name__ == '__main__':
         try:
             # Initialize database and create tables
             init_db()
+            # Pick up payment links and notifications left pending by a previous run
+            payment_queue.ensure_worker()
+            notification_queue.ensure_worker()
             app.run(debug=True)
         except Exception as e:
             print(f"Error initializing database: {e}")
@@ -0,0 +1,316 @@
+from datetime import datetime
+from sqlalchemy import bindparam, insert, update
+from extensions import db
+from models import Product, ProductCategory, Production, Stock, StockHistory, Store
+from stock_reservation import StockConflictError
+from stock_snapshot import stage_deltas
+
+MAIN_STORE_NAME = 'Tienda Principal'
+FLAVOR_CATEGORY_NAME = 'Sabores'
+EPSILON = 1e-6  # kg, float slack when comparing sums
+
+
+class DistributionPlan:
+    """A validated allocation plan: which kg of which batch (or product) go to which store"""
+
+    def __init__(self, main_store=None):
+        self.main_store = main_store
+        self.lines = []  # dicts: line, production (None for plain transfers), product_id, product, store, quantity
+        self.source_rows = {}  # product_id -> (stock_id, quantity) in the main store
+        self.target_rows = {}  # (store_id, product_id) -> stock_id
+        self.errors = []  # {'line': index or None, 'error': message}
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def error(self, line, message):
+        self.errors.append({'line': line, 'error': message})
+
+    @property
+    def transfers(self):
+        """kg leaving the main store per (store_id, product_id), self-assignments excluded"""
+        moved = {}
+        for line in self.lines:
+            if line['store'].id != self.main_store.id:
+                key = (line['store'].id, line['product_id'])
+                moved[key] = moved.get(key, 0) + line['quantity']
+        return moved
+
+    @property
+    def outgoing(self):
+        """kg leaving the main store per product"""
+        demand = {}
+        for (store_id, product_id), quantity in self.transfers.items():
+            demand[product_id] = demand.get(product_id, 0) + quantity
+        return demand
+
+    def assignments(self):
+        """production_id -> store that receives the largest share of the batch"""
+        shares = {}
+        for line in self.lines:
+            if line['production'] is None:
+                continue
+            per_store = shares.setdefault(line['production'].id, {})
+            per_store[line['store'].id] = per_store.get(line['store'].id, 0) + line['quantity']
+        # max() keeps the first store of the plan on ties
+        return {production_id: max(per_store, key=per_store.get) for production_id, per_store in shares.items()}
+
+    def summary(self):
+        batches = {}
+        transfers = []
+        for line in self.lines:
+            if line['production'] is None:
+                transfers.append({'product_id': line['product_id'], 'product': line['product'],
+                                  'store_id': line['store'].id, 'store': line['store'].name,
+                                  'quantity': line['quantity']})
+                continue
+            batch = batches.setdefault(line['production'].batch_number, {
+                'batch_number': line['production'].batch_number,
+                'flavor': line['production'].flavor,
+                'quantity': line['production'].quantity,
+                'stores': []
+            })
+            batch['stores'].append({'store_id': line['store'].id, 'store': line['store'].name,
+                                    'quantity': line['quantity']})
+        return {
+            'batches': list(batches.values()),
+            'transfers': transfers,
+            'total_kg': round(sum(line['quantity'] for line in self.lines), 3),
+            'transferred_kg': round(sum(self.outgoing.values()), 3)
+        }
+
+
+class BatchDistributionEngine:
+    """Applies a whole allocation plan (many batches x many stores) in one transaction.
+
+    The plan is validated up front with one query per table: batches, stores,
+    flavor products and the main store stock. The main store is then
+    decremented with a conditional bulk UPDATE, the target stores are
+    incremented (or their stock rows inserted) in bulk and all history rows go
+    in one INSERT. Nothing is written if any line is invalid.
+
+    A line names a batch (batch_number or production_id), whose flavor is
+    moved and which gets assigned, or just a product_id for a plain transfer
+    of main store stock (what the replenishment plan emits when no batch
+    covers a shortfall).
+    """
+
+    def __init__(self, session=None):
+        self.session = session or db.session
+
+    @staticmethod
+    def parse(allocations, plan):
+        """Normalize the raw lines: {batch_number | production_id | product_id, store_id, quantity}"""
+        parsed = []
+        for idx, raw in enumerate(allocations or []):
+            if not isinstance(raw, dict):
+                plan.error(idx, 'Línea inválida')
+                continue
+            try:
+                store_id = int(raw.get('store_id'))
+                quantity = float(raw.get('quantity'))
+                production_id = int(raw['production_id']) if raw.get('production_id') else None
+                product_id = int(raw['product_id']) if raw.get('product_id') else None
+            except (TypeError, ValueError):
+                plan.error(idx, 'Tienda, lote o cantidad inválida')
+                continue
+            batch_number = raw.get('batch_number')
+            if not (batch_number or production_id or product_id):
+                plan.error(idx, 'Falta el número de lote')
+            elif quantity <= 0:
+                plan.error(idx, 'La cantidad debe ser mayor a 0')
+            else:
+                parsed.append({'line': idx, 'batch_number': batch_number, 'production_id': production_id,
+                               'product_id': product_id, 'store_id': store_id, 'quantity': round(quantity, 3)})
+        if not parsed and not plan.errors:
+            plan.error(None, 'No hay asignaciones')
+        return parsed
+
+    def _productions(self, parsed):
+        batch_numbers = {line['batch_number'] for line in parsed if line['batch_number']}
+        production_ids = {line['production_id'] for line in parsed
+                          if line['production_id'] and not line['batch_number']}
+        if not batch_numbers and not production_ids:
+            return {}, {}
+        productions = self.session.query(Production).filter(db.or_(
+            Production.batch_number.in_(batch_numbers),
+            Production.id.in_(production_ids)
+        )).all()
+        by_number = {p.batch_number: p for p in productions}
+        by_id = {p.id: p for p in productions}
+        return by_number, by_id
+
+    def check(self, allocations, lock=True):
+        """Validate every line and the total availability without writing anything"""
+        plan = DistributionPlan()
+        parsed = self.parse(allocations, plan)
+        if not parsed:
+            return plan
+
+        plan.main_store = self.session.query(Store).filter_by(name=MAIN_STORE_NAME).first()
+        category = self.session.query(ProductCategory).filter_by(name=FLAVOR_CATEGORY_NAME).first()
+        if plan.main_store is None:
+            plan.error(None, 'Tienda no encontrada')
+        if category is None:
+            plan.error(None, 'No se encontró la categoría de sabores')
+        if not plan.ok:
+            return plan
+
+        stores = {store.id: store for store in
+                  self.session.query(Store).filter(Store.id.in_({line['store_id'] for line in parsed})).all()}
+        by_number, by_id = self._productions(parsed)
+        flavors = {p.flavor for p in by_number.values()} | {p.flavor for p in by_id.values()}
+        products = dict(self.session.query(Product.name, Product.id).filter(
+            Product.category_id == category.id,
+            Product.name.in_(flavors)
+        ).all()) if flavors else {}
+        plain_ids = {line['product_id'] for line in parsed if not (line['batch_number'] or line['production_id'])}
+        names = dict(self.session.query(Product.id, Product.name).filter(
+            Product.id.in_(plain_ids)
+        ).all()) if plain_ids else {}
+        names.update({product_id: flavor for flavor, product_id in products.items()})
+
+        allocated = {}  # production_id -> kg in this plan
+        for line in parsed:
+            idx = line['line']
+            store = stores.get(line['store_id'])
+            if not (line['batch_number'] or line['production_id']):
+                if line['product_id'] not in names:
+                    plan.error(idx, 'Producto no encontrado')
+                elif store is None:
+                    plan.error(idx, 'Tienda no encontrada')
+                elif store.id == plan.main_store.id:
+                    plan.error(idx, 'No se puede transferir a la tienda principal')
+                else:
+                    plan.lines.append({'line': idx, 'production': None, 'product_id': line['product_id'],
+                                       'product': names[line['product_id']], 'store': store,
+                                       'quantity': line['quantity']})
+                continue
+
+            if line['batch_number']:
+                production = by_number.get(line['batch_number'])
+            else:
+                production = by_id.get(line['production_id'])
+            if production is None:
+                plan.error(idx, 'Número de lote inválido')
+            elif production.end_time is None:
+                plan.error(idx, f'El lote {production.batch_number} no está finalizado')
+            elif production.assigned_store_id is not None:
+                plan.error(idx, f'El lote {production.batch_number} ya ha sido asignado')
+            elif store is None:
+                plan.error(idx, 'Tienda no encontrada')
+            elif production.flavor not in products:
+                plan.error(idx, f'No se encontró el producto para el sabor {production.flavor}')
+            else:
+                allocated[production.id] = allocated.get(production.id, 0) + line['quantity']
+                if allocated[production.id] > production.quantity + EPSILON:
+                    plan.error(idx, f'Se asignan {allocated[production.id]:.2f} kg del lote '
+                                    f'{production.batch_number}, que tiene {production.quantity:.2f} kg')
+                plan.lines.append({'line': idx, 'production': production, 'product_id': products[production.flavor],
+                                   'product': production.flavor, 'store': store, 'quantity': line['quantity']})
+        if not plan.ok:
+            return plan
+
+        outgoing = plan.outgoing
+        if outgoing:
+            query = self.session.query(Stock.product_id, Stock.id, Stock.quantity).filter(
+                Stock.store_id == plan.main_store.id,
+                Stock.product_id.in_(list(outgoing))
+            )
+            if lock:
+                query = query.with_for_update(of=Stock)
+            plan.source_rows = {row.product_id: (row.id, row.quantity) for row in query.all()}
+            for product_id, quantity in outgoing.items():
+                available = plan.source_rows.get(product_id, (None, 0))[1] or 0
+                if available + EPSILON < quantity:
+                    plan.error(None, f'Stock insuficiente en tienda principal de {names[product_id]}: '
+                                     f'se asignan {quantity:.2f} kg, hay {available:.2f} kg')
+
+            targets = plan.transfers
+            rows = self.session.query(Stock.store_id, Stock.product_id, Stock.id).filter(
+                Stock.store_id.in_({store_id for store_id, _ in targets}),
+                Stock.product_id.in_({product_id for _, product_id in targets})
+            ).all()
+            plan.target_rows = {(row.store_id, row.product_id): row.id for row in rows
+                                if (row.store_id, row.product_id) in targets}
+        return plan
+
+    def apply(self, plan):
+        """Write a validated plan; the caller commits (or rolls back on StockConflictError)"""
+        now = datetime.utcnow()
+        stocks = Stock.__table__
+        outgoing = plan.outgoing
+        transfers = plan.transfers
+
+        if outgoing:
+            decrement = update(stocks).where(
+                stocks.c.id == bindparam('stock_id'),
+                stocks.c.quantity >= bindparam('delta')
+            ).values(quantity=stocks.c.quantity - bindparam('delta'), updated_at=now)
+            params = [{'stock_id': plan.source_rows[product_id][0], 'delta': quantity}
+                      for product_id, quantity in outgoing.items()]
+            updated = self.session.execute(decrement.execution_options(stock_snapshot_staged=True), params)
+            if updated.rowcount != len(params):
+                raise StockConflictError('El stock de la tienda principal cambió, intente nuevamente')
+            stage_deltas(self.session, plan.main_store.id, {product_id: -quantity for product_id, quantity in outgoing.items()})
+
+            existing = [{'stock_id': plan.target_rows[key], 'delta': quantity}
+                        for key, quantity in transfers.items() if key in plan.target_rows]
+            if existing:
+                increment = update(stocks).where(stocks.c.id == bindparam('stock_id'))\
+                    .values(quantity=stocks.c.quantity + bindparam('delta'), updated_at=now)
+                self.session.execute(increment.execution_options(stock_snapshot_staged=True), existing)
+            missing = [{'store_id': store_id, 'product_id': product_id, 'quantity': quantity,
+                        'minimum_quantity': 0, 'created_at': now, 'updated_at': now}
+                       for (store_id, product_id), quantity in transfers.items() if (store_id, product_id) not in plan.target_rows]
+            if missing:
+                self.session.execute(insert(stocks).execution_options(stock_snapshot_staged=True), missing)
+            per_store = {}
+            for (store_id, product_id), quantity in transfers.items():
+                per_store.setdefault(store_id, {})[product_id] = quantity
+            for store_id, deltas in per_store.items():
+                stage_deltas(self.session, store_id, deltas)
+
+            history = []
+            for line in plan.lines:
+                if line['store'].id == plan.main_store.id:
+                    continue  # the batch is already in the main store since it was finished
+                if line['production'] is None:
+                    outgoing_reason = f"Reposición a {line['store'].name}"
+                    incoming_reason = f'Reposición desde {plan.main_store.name}'
+                else:
+                    batch_number = line['production'].batch_number
+                    outgoing_reason = f"Transferencia a {line['store'].name} - Lote {batch_number}"
+                    incoming_reason = f'Transferencia desde {plan.main_store.name} - Lote {batch_number}'
+                history.append({'store_id': plan.main_store.id, 'product_id': line['product_id'],
+                                'quantity_change': -line['quantity'], 'timestamp': now, 'reason': outgoing_reason})
+                history.append({'store_id': line['store'].id, 'product_id': line['product_id'],
+                                'quantity_change': line['quantity'], 'timestamp': now, 'reason': incoming_reason})
+            self.session.execute(insert(StockHistory.__table__), history)
+
+        productions = Production.__table__
+        assign = update(productions).where(
+            productions.c.id == bindparam('production_id'),
+            productions.c.assigned_store_id.is_(None)
+        ).values(assigned_store_id=bindparam('target_store_id'), assigned_at=now)
+        params = [{'production_id': production_id, 'target_store_id': store_id}
+                  for production_id, store_id in plan.assignments().items()]
+        if params:
+            assigned = self.session.execute(assign, params)
+            if assigned.rowcount != len(params):
+                raise StockConflictError('Un lote fue asignado por otro usuario, intente nuevamente')
+        for line in plan.lines:
+            if line['production'] is not None:
+                self.session.expire(line['production'], ['assigned_store_id', 'assigned_at'])
+        return plan
+
+    def distribute(self, allocations):
+        """check() then apply() if the plan is valid; returns the plan"""
+        plan = self.check(allocations)
+        if plan.ok:
+            self.apply(plan)
+        return plan
+
+
+batch_distribution = BatchDistributionEngine()
@@ -0,0 +1,107 @@
+from sqlalchemy import or_
+from models import Product
+
+# Sales format -> kilograms of ice cream and packaging product consumed per unit
+FORMAT_TABLE = {
+    '1/4 KG': {'weight_kg': 0.25, 'packaging': 'Envase 1/4 KG'},
+    '1/2 KG': {'weight_kg': 0.5, 'packaging': 'Envase 1/2 KG'},
+    '1 KG': {'weight_kg': 1.0, 'packaging': 'Envase 1 KG'},
+}
+PACKAGING_NAMES = [spec['packaging'] for spec in FORMAT_TABLE.values()]
+
+
+class BillOfMaterials:
+    """Per-product stock deductions for a cart"""
+
+    def __init__(self):
+        self.deductions = {}  # product_id -> quantity (kg for flavors, units otherwise)
+        self.kinds = {}  # product_id -> 'flavor' | 'packaging' | 'product'
+        self.cart_lines = {}  # product_id -> indexes of the cart lines that consume it
+        self.names = {}  # product_id -> name, for every product involved
+        self.errors = []
+
+    def add(self, product_id, quantity, kind, line_index):
+        self.deductions[product_id] = round(self.deductions.get(product_id, 0) + quantity, 2)
+        self.kinds.setdefault(product_id, kind)
+        lines = self.cart_lines.setdefault(product_id, [])
+        if line_index not in lines:
+            lines.append(line_index)
+
+    @property
+    def lines(self):
+        """Deductions in the format accepted by StockReservationEngine"""
+        return [
+            {'product_id': product_id, 'quantity': quantity, 'cart_lines': self.cart_lines[product_id]}
+            for product_id, quantity in self.deductions.items()
+        ]
+
+
+def _flavor_ref(flavor):
+    """Normalize a cart flavor entry ({'id':..}, id or name) to an int id or a name"""
+    if isinstance(flavor, dict):
+        flavor = flavor.get('id', flavor.get('name'))
+    if isinstance(flavor, int):
+        return flavor
+    flavor = str(flavor).strip()
+    return int(flavor) if flavor.isdigit() else flavor
+
+
+def expand_cart(cart, deduct_products=True):
+    """Expand POS or webshop cart lines into per-product stock deductions.
+
+    Potes (formats in FORMAT_TABLE) with flavors consume their weight split
+    evenly across the chosen flavors plus one packaging unit each; any other
+    stock-tracked product consumes itself, unless deduct_products=False (the
+    webshop only deducts flavors and envases). All products referenced by the
+    cart are resolved with a single query.
+    """
+    bom = BillOfMaterials()
+    product_ids = set()
+    flavor_names = set()
+    parsed = []
+    for item in cart:
+        flavors = [_flavor_ref(f) for f in (item.get('flavors') or [])]
+        product_ids.add(int(item['product_id']))
+        for ref in flavors:
+            if isinstance(ref, int):
+                product_ids.add(ref)
+            else:
+                flavor_names.add(ref)
+        parsed.append((int(item['product_id']), float(item.get('quantity', 1) or 1), flavors))
+
+    products = Product.query.filter(or_(
+        Product.id.in_(product_ids),
+        Product.name.in_(flavor_names | set(PACKAGING_NAMES))
+    )).all()
+    by_id = {p.id: p for p in products}
+    id_by_name = {p.name: p.id for p in products}
+    bom.names = {p.id: p.name for p in products}
+
+    for idx, (product_id, quantity, flavors) in enumerate(parsed):
+        product = by_id.get(product_id)
+        if not product:
+            bom.errors.append(f'Producto {product_id} no encontrado')
+            continue
+        spec = FORMAT_TABLE.get(product.sales_format)
+        if spec and flavors:
+            flavor_ids = []
+            for ref in flavors:
+                flavor_id = ref if isinstance(ref, int) else id_by_name.get(ref)
+                if flavor_id is None or flavor_id not in by_id:
+                    bom.errors.append(f'Sabor {ref} no encontrado')
+                    continue
+                flavor_ids.append(flavor_id)
+            if not flavor_ids:
+                continue
+            total_weight = spec['weight_kg'] * quantity
+            per_flavor = round(total_weight / len(flavor_ids), 2)
+            # Ajuste de redondeo: la diferencia va al primer sabor
+            remainder = round(total_weight - per_flavor * len(flavor_ids), 2)
+            for pos, flavor_id in enumerate(flavor_ids):
+                bom.add(flavor_id, per_flavor + (remainder if pos == 0 else 0), 'flavor', idx)
+            packaging_id = id_by_name.get(spec['packaging'])
+            if packaging_id:
+                bom.add(packaging_id, quantity, 'packaging', idx)
+        elif deduct_products and product.track_stock is not False:
+            bom.add(product_id, quantity, 'product', idx)
+    return bom
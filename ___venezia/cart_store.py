@@ -0,0 +1,350 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, request, session
+from sqlalchemy import delete, event, insert, update
+from sqlalchemy.orm import Session
+from extensions import db
+from models import Cart, CartLine, Product
+
+CART_TTL = {
+    'pos': timedelta(hours=12),
+    'webshop': timedelta(days=3),
+}
+SESSION_KEYS = {'pos': 'cart_id', 'webshop': 'webshop_cart_id'}
+EVICT_EVERY_SECONDS = 600
+PRODUCT_CACHE_SECONDS = 120
+
+ProductInfo = namedtuple('ProductInfo', ['id', 'name', 'price', 'sales_format', 'max_flavors', 'track_stock', 'active'])
+
+
+def new_cart_id():
+    return secrets.token_urlsafe(6)
+
+
+def make_line(line_id, product_id, quantity, unit_price, data):
+    """Cart line as the POS and webshop code use it (both price key spellings)"""
+    item = dict(data or {})
+    item.update({
+        'line_id': line_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'price': unit_price,
+        'total_price': unit_price * quantity,
+    })
+    return item
+
+
+class CartView(list):
+    """The lines of a cart, in insertion order"""
+
+    def __init__(self, cart_id, lines):
+        super().__init__(lines)
+        self.cart_id = cart_id
+
+    @property
+    def total(self):
+        return sum(float(item['total_price']) for item in self)
+
+
+class SQLCartStore:
+    """Carts kept in the carts/cart_lines tables; every line change is one statement.
+
+    Any terminal or worker that knows the cart id sees the same cart. Expired
+    carts are evicted opportunistically on writes.
+    """
+
+    def __init__(self):
+        self.last_eviction = 0
+
+    def _touch(self, cart_id, kind):
+        now = datetime.utcnow()
+        result = db.session.execute(update(Cart).where(Cart.id == cart_id).values(
+            updated_at=now, expires_at=now + CART_TTL[kind]
+        ))
+        if result.rowcount == 0:
+            db.session.execute(insert(Cart).values(
+                id=cart_id, kind=kind, created_at=now, updated_at=now, expires_at=now + CART_TTL[kind]
+            ))
+
+    def _maybe_evict(self):
+        if time.monotonic() - self.last_eviction > EVICT_EVERY_SECONDS:
+            self.last_eviction = time.monotonic()
+            self.evict_expired(commit=False)
+
+    def load(self, cart_id):
+        rows = db.session.query(
+            CartLine.id, CartLine.product_id, CartLine.quantity, CartLine.unit_price, CartLine.data
+        ).join(Cart, Cart.id == CartLine.cart_id).filter(
+            CartLine.cart_id == cart_id,
+            Cart.expires_at > datetime.utcnow()
+        ).order_by(CartLine.id).all()
+        return CartView(cart_id, [
+            make_line(row.id, row.product_id, row.quantity, row.unit_price, json.loads(row.data) if row.data else {})
+            for row in rows
+        ])
+
+    def count(self, cart_id):
+        return db.session.query(db.func.count(CartLine.id)).join(Cart, Cart.id == CartLine.cart_id).filter(
+            CartLine.cart_id == cart_id, Cart.expires_at > datetime.utcnow()
+        ).scalar() or 0
+
+    def get_line(self, cart_id, line_id):
+        row = db.session.query(
+            CartLine.id, CartLine.product_id, CartLine.quantity, CartLine.unit_price, CartLine.data
+        ).filter(CartLine.id == line_id, CartLine.cart_id == cart_id).first()
+        if row is None:
+            return None
+        return make_line(row.id, row.product_id, row.quantity, row.unit_price, json.loads(row.data) if row.data else {})
+
+    def line_id_at(self, cart_id, index):
+        if index is None or index < 0:
+            return None
+        return db.session.query(CartLine.id).filter(CartLine.cart_id == cart_id)\
+            .order_by(CartLine.id).offset(index).limit(1).scalar()
+
+    def add_line(self, cart_id, kind, product_id, quantity, unit_price, data):
+        self._touch(cart_id, kind)
+        result = db.session.execute(insert(CartLine).values(
+            cart_id=cart_id, product_id=product_id, quantity=quantity,
+            unit_price=unit_price, data=json.dumps(data)
+        ))
+        self._maybe_evict()
+        db.session.commit()
+        return result.inserted_primary_key[0]
+
+    def set_quantity(self, cart_id, kind, line_id, quantity):
+        """Set a line quantity; quantity <= 0 removes the line"""
+        if quantity <= 0:
+            return self.remove_line(cart_id, kind, line_id)
+        self._touch(cart_id, kind)
+        result = db.session.execute(update(CartLine).where(
+            CartLine.id == line_id, CartLine.cart_id == cart_id
+        ).values(quantity=quantity))
+        db.session.commit()
+        return result.rowcount > 0
+
+    def update_data(self, cart_id, kind, line_id, data):
+        self._touch(cart_id, kind)
+        result = db.session.execute(update(CartLine).where(
+            CartLine.id == line_id, CartLine.cart_id == cart_id
+        ).values(data=json.dumps(data)))
+        db.session.commit()
+        return result.rowcount > 0
+
+    def remove_line(self, cart_id, kind, line_id):
+        self._touch(cart_id, kind)
+        result = db.session.execute(delete(CartLine).where(
+            CartLine.id == line_id, CartLine.cart_id == cart_id
+        ))
+        db.session.commit()
+        return result.rowcount > 0
+
+    def clear(self, cart_id, commit=True):
+        db.session.execute(delete(CartLine).where(CartLine.cart_id == cart_id))
+        db.session.execute(delete(Cart).where(Cart.id == cart_id))
+        if commit:
+            db.session.commit()
+
+    def evict_expired(self, commit=True):
+        expired = db.session.query(Cart.id).filter(Cart.expires_at <= datetime.utcnow())
+        db.session.execute(delete(CartLine).where(CartLine.cart_id.in_(expired.scalar_subquery())))
+        result = db.session.execute(delete(Cart).where(Cart.expires_at <= datetime.utcnow()))
+        if commit:
+            db.session.commit()
+        return result.rowcount
+
+
+class MemoryCartStore:
+    """Process-local carts with TTL, for development and single-worker setups"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.carts = {}  # cart_id -> {'kind', 'expires_at', 'lines': OrderedDict(line_id -> line)}
+        self.next_line_id = 1
+
+    def _cart(self, cart_id, kind=None):
+        cart = self.carts.get(cart_id)
+        if cart and cart['expires_at'] <= datetime.utcnow():
+            del self.carts[cart_id]
+            cart = None
+        if cart is None and kind:
+            cart = self.carts[cart_id] = {'kind': kind, 'lines': OrderedDict()}
+        if cart is not None and kind:
+            cart['expires_at'] = datetime.utcnow() + CART_TTL[kind]
+        return cart
+
+    def load(self, cart_id):
+        with self.lock:
+            cart = self._cart(cart_id)
+            lines = cart['lines'].values() if cart else []
+            return CartView(cart_id, [make_line(*line) for line in lines])
+
+    def count(self, cart_id):
+        with self.lock:
+            cart = self._cart(cart_id)
+            return len(cart['lines']) if cart else 0
+
+    def get_line(self, cart_id, line_id):
+        with self.lock:
+            cart = self._cart(cart_id)
+            line = cart['lines'].get(line_id) if cart else None
+            return make_line(*line) if line else None
+
+    def line_id_at(self, cart_id, index):
+        with self.lock:
+            cart = self._cart(cart_id)
+            if not cart or index is None or index < 0 or index >= len(cart['lines']):
+                return None
+            return list(cart['lines'])[index]
+
+    def add_line(self, cart_id, kind, product_id, quantity, unit_price, data):
+        with self.lock:
+            cart = self._cart(cart_id, kind)
+            line_id = self.next_line_id
+            self.next_line_id += 1
+            cart['lines'][line_id] = (line_id, product_id, quantity, unit_price, dict(data))
+            return line_id
+
+    def set_quantity(self, cart_id, kind, line_id, quantity):
+        if quantity <= 0:
+            return self.remove_line(cart_id, kind, line_id)
+        with self.lock:
+            cart = self._cart(cart_id, kind)
+            line = cart['lines'].get(line_id)
+            if line is None:
+                return False
+            cart['lines'][line_id] = (line[0], line[1], quantity, line[3], line[4])
+            return True
+
+    def update_data(self, cart_id, kind, line_id, data):
+        with self.lock:
+            cart = self._cart(cart_id, kind)
+            line = cart['lines'].get(line_id)
+            if line is None:
+                return False
+            cart['lines'][line_id] = (line[0], line[1], line[2], line[3], dict(data))
+            return True
+
+    def remove_line(self, cart_id, kind, line_id):
+        with self.lock:
+            cart = self._cart(cart_id, kind)
+            return cart['lines'].pop(line_id, None) is not None
+
+    def clear(self, cart_id, commit=True):
+        with self.lock:
+            self.carts.pop(cart_id, None)
+
+    def evict_expired(self, commit=True):
+        with self.lock:
+            now = datetime.utcnow()
+            expired = [cart_id for cart_id, cart in self.carts.items() if cart['expires_at'] <= now]
+            for cart_id in expired:
+                del self.carts[cart_id]
+            return len(expired)
+
+
+_stores = {'sql': SQLCartStore(), 'memory': MemoryCartStore()}
+
+
+def get_cart_store():
+    """Backend selected by the CART_STORE config value ('sql' by default)"""
+    return _stores[current_app.config.get('CART_STORE', 'sql')]
+
+
+def current_cart_id(kind, create=False):
+    """Cart id for this request: X-Cart-Id header (shared carts across terminals) or the session"""
+    cart_id = request.headers.get('X-Cart-Id') or session.get(SESSION_KEYS[kind])
+    if not cart_id and create:
+        cart_id = new_cart_id()
+    if cart_id and session.get(SESSION_KEYS[kind]) != cart_id:
+        session[SESSION_KEYS[kind]] = cart_id
+    return cart_id
+
+
+def load_cart(kind):
+    cart_id = current_cart_id(kind)
+    if not cart_id:
+        return CartView(None, [])
+    return get_cart_store().load(cart_id)
+
+
+class ProductCache:
+    """Short-lived cache of the product fields carts need, invalidated on product commits"""
+
+    def __init__(self, ttl=PRODUCT_CACHE_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # product_id -> (ProductInfo, loaded_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, product_ids):
+        ids = {int(pid) for pid in product_ids}
+        now = time.monotonic()
+        result = {}
+        with self.lock:
+            for pid in ids:
+                entry = self.entries.get(pid)
+                if entry and now - entry[1] <= self.ttl:
+                    result[pid] = entry[0]
+            self.hits += len(result)
+            self.misses += len(ids) - len(result)
+        missing = ids - set(result)
+        if missing:
+            rows = db.session.query(
+                Product.id, Product.name, Product.price, Product.sales_format,
+                Product.max_flavors, Product.track_stock, Product.active
+            ).filter(Product.id.in_(missing)).all()
+            with self.lock:
+                for row in rows:
+                    info = ProductInfo(*row)
+                    self.entries[row.id] = (info, now)
+                    result[row.id] = info
+        return result
+
+    def get(self, product_id):
+        return self.get_many([product_id]).get(int(product_id))
+
+    def invalidate(self, product_ids=None):
+        with self.lock:
+            if product_ids is None:
+                self.entries.clear()
+            for pid in product_ids or ():
+                self.entries.pop(pid, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'entries': len(self.entries)
+            }
+
+
+product_cache = ProductCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_product_changes(session, flush_context):
+    changed = {obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, Product)}
+    if changed:
+        session.info.setdefault('product_cache', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_product_changes(session):
+    changed = session.info.pop('product_cache', None)
+    if changed:
+        product_cache.invalidate(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_product_changes(session):
+    session.info.pop('product_cache', None)
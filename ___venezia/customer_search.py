@@ -0,0 +1,172 @@
+import threading
+import time
+import unicodedata
+from collections import Counter
+from fuzzywuzzy import fuzz
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from extensions import db
+from models import DeliveryAddress
+
+MIN_PHONE_DIGITS = 3  # shorter digit runs (e.g. a street number) are not treated as a phone
+MAX_CANDIDATES = 300  # rows that go through fuzzy scoring after the trigram filter
+REFRESH_SECONDS = 30  # catch up with rows written by other workers
+
+
+def normalize(text):
+    """Lowercase and strip accents so 'Pérez' and 'perez' index the same"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+def digits(text):
+    return ''.join(filter(str.isdigit, text or ''))
+
+
+def trigrams(text):
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class CustomerSearchIndex:
+    """In-memory phone-suffix and trigram index over delivery addresses.
+
+    Built with one query on first use and kept in sync by session events on
+    commit (plus a periodic updated_at catch-up for writes from other
+    processes). A search narrows the address book to a few hundred
+    candidates before running the fuzzy scoring of DeliveryAddress.match_score.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = {}  # id -> (name, address, landmark, phone digits)
+        self.by_suffix = {}  # phone suffix -> set(ids)
+        self.by_gram = {}  # trigram -> set(ids)
+        self.loaded = False
+        self.watermark = None
+        self.refreshed_at = 0
+
+    # -- maintenance -------------------------------------------------------
+
+    def _remove(self, address_id):
+        entry = self.entries.pop(address_id, None)
+        if not entry:
+            return
+        name, address, landmark, phone = entry
+        for i in range(len(phone) - MIN_PHONE_DIGITS + 1):
+            self.by_suffix.get(phone[i:], set()).discard(address_id)
+        for gram in trigrams(f'{name} {address} {landmark}'):
+            self.by_gram.get(gram, set()).discard(address_id)
+
+    def _add(self, address_id, customer_name, phone, address, landmark):
+        self._remove(address_id)
+        entry = (normalize(customer_name), normalize(address), normalize(landmark), digits(phone))
+        self.entries[address_id] = entry
+        name, address, landmark, phone = entry
+        for i in range(len(phone) - MIN_PHONE_DIGITS + 1):
+            self.by_suffix.setdefault(phone[i:], set()).add(address_id)
+        for gram in trigrams(f'{name} {address} {landmark}'):
+            self.by_gram.setdefault(gram, set()).add(address_id)
+
+    def _load(self, since=None):
+        query = db.session.query(
+            DeliveryAddress.id, DeliveryAddress.customer_name, DeliveryAddress.phone,
+            DeliveryAddress.address, DeliveryAddress.landmark, DeliveryAddress.updated_at
+        )
+        if since is not None:
+            query = query.filter(DeliveryAddress.updated_at > since)
+        for row in query.all():
+            self._add(row.id, row.customer_name, row.phone, row.address, row.landmark)
+            if row.updated_at and (self.watermark is None or row.updated_at > self.watermark):
+                self.watermark = row.updated_at
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                self._load()
+                self.loaded = True
+                self.refreshed_at = time.monotonic()
+            elif time.monotonic() - self.refreshed_at > REFRESH_SECONDS:
+                self._load(since=self.watermark)
+                self.refreshed_at = time.monotonic()
+
+    def apply(self, upserts, deleted_ids):
+        """Apply committed changes; a no-op until the index has been built"""
+        with self.lock:
+            if not self.loaded:
+                return
+            for values in upserts:
+                self._add(*values)
+            for address_id in deleted_ids:
+                self._remove(address_id)
+
+    def reset(self):
+        with self.lock:
+            self.entries, self.by_suffix, self.by_gram = {}, {}, {}
+            self.loaded = False
+            self.watermark = None
+
+    # -- search ------------------------------------------------------------
+
+    def _score(self, address_id, query, clean_query):
+        name, address, landmark, phone = self.entries[address_id]
+        if len(clean_query) >= MIN_PHONE_DIGITS and phone.endswith(clean_query):
+            return 100
+        scores = [fuzz.partial_ratio(query, name), fuzz.partial_ratio(query, address)]
+        if landmark:
+            scores.append(fuzz.partial_ratio(query, landmark))
+        return max(scores)
+
+    def search_ids(self, query, min_score=60, limit=20):
+        """Top `limit` (address_id, score) pairs for a query, best first"""
+        self.ensure_loaded()
+        normalized = normalize(query)
+        clean_query = digits(query)
+        with self.lock:
+            candidates = set(self.by_suffix.get(clean_query, ())) if len(clean_query) >= MIN_PHONE_DIGITS else set()
+            grams = trigrams(normalized)
+            if grams:
+                hits = Counter()
+                for gram in grams:
+                    hits.update(self.by_gram.get(gram, ()))
+                candidates.update(address_id for address_id, _ in hits.most_common(MAX_CANDIDATES))
+            elif not candidates:
+                candidates = set(self.entries)
+
+            results = []
+            for address_id in candidates:
+                score = self._score(address_id, normalized, clean_query)
+                if score >= min_score:
+                    results.append((address_id, score))
+        results.sort(key=lambda x: (-x[1], x[0]))
+        return results[:limit] if limit else results
+
+
+customer_index = CustomerSearchIndex()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_address_changes(session, flush_context):
+    pending = session.info.setdefault('customer_index', {'upserts': {}, 'deleted': set()})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, DeliveryAddress) and obj.id is not None:
+            pending['upserts'][obj.id] = (obj.id, obj.customer_name, obj.phone, obj.address, obj.landmark)
+    for obj in session.deleted:
+        if isinstance(obj, DeliveryAddress):
+            pending['upserts'].pop(obj.id, None)
+            pending['deleted'].add(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_address_changes(session):
+    pending = session.info.pop('customer_index', None)
+    if pending and (pending['upserts'] or pending['deleted']):
+        customer_index.apply(pending['upserts'].values(), pending['deleted'])
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_address_changes(session):
+    session.info.pop('customer_index', None)
@@ -0,0 +1,69 @@
+from sqlalchemy import func, inspect, select
+from extensions import db
+from models import Stock
+
+
+def duplicate_stocks(session):
+    """Stock rows beyond the first for the same store and product"""
+    counts = select(func.count(Stock.id).label('rows')).group_by(Stock.store_id, Stock.product_id).subquery()
+    return session.scalar(select(func.coalesce(func.sum(counts.c.rows - 1), 0)))
+
+
+def merge_duplicate_stocks(session):
+    """Fold repeated (store_id, product_id) stock rows into the oldest one, before uq_stocks_store_product exists.
+
+    Quantities are added up and the highest minimum is kept; stock_history is
+    per store and product, so the ledger is unaffected. Returns the rows removed.
+    """
+    duplicates = session.execute(
+        select(Stock.store_id, Stock.product_id, func.min(Stock.id), func.sum(Stock.quantity),
+               func.max(Stock.minimum_quantity))
+        .group_by(Stock.store_id, Stock.product_id)
+        .having(func.count(Stock.id) > 1)
+    ).all()
+    removed = 0
+    for store_id, product_id, keep_id, quantity, minimum in duplicates:
+        kept = session.get(Stock, keep_id)
+        kept.quantity = quantity or 0
+        kept.minimum_quantity = minimum or 0
+        removed += Stock.query.filter(
+            Stock.store_id == store_id, Stock.product_id == product_id, Stock.id != keep_id
+        ).delete(synchronize_session=False)
+    return removed
+
+
+def missing_indexes(engine):
+    """Indexes declared on the models that the database doesn't have yet (create_all skips existing tables)"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def ensure_indexes(engine, dry_run=False):
+    """Migration for declared indexes: merges duplicate stocks, then creates what's missing.
+
+    Returns (duplicate stock rows removed, names of the indexes created);
+    with dry_run nothing changes and the counts are what would be done.
+    """
+    missing = missing_indexes(engine)
+    removed = 0
+    if any(index.name == 'uq_stocks_store_product' for index in missing):
+        if dry_run:
+            return duplicate_stocks(db.session), [index.name for index in missing]
+        removed = merge_duplicate_stocks(db.session)
+        db.session.commit()
+    elif dry_run:
+        return 0, [index.name for index in missing]
+    for index in missing:
+        index.create(bind=engine)
+    # Fresh statistics, or the planner may keep ignoring the new indexes
+    with engine.begin() as connection:
+        for table in sorted({index.table.name for index in missing}):
+            connection.exec_driver_sql(f'ANALYZE "{table}"')
+    return removed, [index.name for index in missing]
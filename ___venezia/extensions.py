@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from analytics_replica import ReplicaRoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ReplicaRoutingSession})
 migrate = Migrate()
@@ -0,0 +1,217 @@
+import json
+from datetime import datetime, timedelta
+from itertools import combinations, combinations_with_replacement
+from sqlalchemy import event, func, insert, inspect as sa_inspect, or_, select, update
+from sqlalchemy.orm import Session
+from bill_of_materials import _flavor_ref
+from extensions import db
+from models import FlavorPairDaily, Product, Production, SaleItem
+
+PRODUCTION = 'production'  # two batches produced on the same day
+SALE = 'sale'  # two flavors chosen in the same sale item
+
+
+# -- pair counting ---------------------------------------------------------
+
+def production_pairs(flavor_counts):
+    """Batch pairs of one day from {flavor: batches}, same-flavor pairs included"""
+    pairs = {}
+    for a, b in combinations_with_replacement(sorted(flavor_counts), 2):
+        n = flavor_counts[a] * flavor_counts[b] if a != b else flavor_counts[a] * (flavor_counts[a] - 1) // 2
+        if n:
+            pairs[(a, b)] = n
+    return pairs
+
+
+def sale_item_pairs(flavor_names, quantity=1):
+    """Distinct flavor pairs of one sale item, weighted by the item quantity"""
+    return {pair: int(quantity or 1) for pair in combinations(sorted(set(flavor_names)), 2)}
+
+
+def _add(deltas, source, day, pairs, sign=1):
+    for (a, b), n in pairs.items():
+        key = (source, day, a, b)
+        deltas[key] = deltas.get(key, 0) + sign * n
+
+
+def apply_deltas(connection, deltas):
+    """Upsert pair count deltas into flavor_pair_daily: one UPDATE per key, INSERT when missing"""
+    table = FlavorPairDaily.__table__
+    for (source, day, a, b), n in deltas.items():
+        if not n:
+            continue
+        match = (
+            (table.c.source == source) &
+            (table.c.date == day) &
+            (table.c.flavor_a == a) &
+            (table.c.flavor_b == b)
+        )
+        result = connection.execute(update(table).where(match).values(count=table.c.count + n))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(source=source, date=day, flavor_a=a, flavor_b=b, count=n))
+
+
+# -- productions -----------------------------------------------------------
+
+def _production_before(production):
+    """(day, flavor) the production had before this flush, or None if unchanged"""
+    state = sa_inspect(production)
+    values = {}
+    changed = False
+    for attr in ('flavor', 'production_date'):
+        history = state.attrs[attr].history
+        if history.deleted:
+            values[attr] = history.deleted[0]
+            changed = True
+        else:
+            values[attr] = getattr(production, attr)
+    if not changed or values['production_date'] is None:
+        return None
+    return values['production_date'].date(), values['flavor']
+
+
+def _production_deltas(session, deltas):
+    # Batches added (+1) and removed (-1) per (day, flavor) in this flush
+    moved = {}
+
+    def move(day_flavor, sign):
+        if day_flavor is not None:
+            moved[day_flavor] = moved.get(day_flavor, 0) + sign
+
+    for obj in session.new:
+        if isinstance(obj, Production) and obj.production_date is not None:
+            move((obj.production_date.date(), obj.flavor), 1)
+    for obj in session.dirty:
+        if isinstance(obj, Production) and obj not in session.deleted:
+            before = _production_before(obj)
+            if before is not None:
+                move(before, -1)
+                move((obj.production_date.date(), obj.flavor), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Production):
+            before = _production_before(obj)
+            if before is None and obj.production_date is not None:
+                before = obj.production_date.date(), obj.flavor
+            move(before, -1)
+
+    days = {day for (day, flavor), n in moved.items() if n}
+    if not days:
+        return
+
+    # The flush already wrote the new state: count it, then undo the moves to get the old one
+    day = func.date(Production.production_date)
+    rows = session.connection().execute(
+        select(day, Production.flavor, func.count(Production.id)).where(or_(*[
+            (Production.production_date >= datetime.combine(d, datetime.min.time())) &
+            (Production.production_date < datetime.combine(d + timedelta(days=1), datetime.min.time()))
+            for d in days
+        ])).group_by(day, Production.flavor)
+    ).all()
+    after = {d: {} for d in days}
+    for row_day, flavor, count in rows:
+        after[_parse_day(row_day)][flavor] = count
+    for d in days:
+        before = dict(after[d])
+        for (moved_day, flavor), n in moved.items():
+            if moved_day == d:
+                before[flavor] = before.get(flavor, 0) - n
+        _add(deltas, PRODUCTION, d, production_pairs(after[d]))
+        _add(deltas, PRODUCTION, d, production_pairs(before), -1)
+
+
+# -- sales -----------------------------------------------------------------
+
+def _resolve_flavors(connection, items):
+    """Flavor names of each (flavors json, ...) item; ids are looked up in one query"""
+    refs = [[_flavor_ref(f) for f in (json.loads(flavors) if isinstance(flavors, str) else flavors or [])]
+            for flavors in items]
+    ids = {ref for item in refs for ref in item if isinstance(ref, int)}
+    names = dict(connection.execute(select(Product.id, Product.name).where(Product.id.in_(ids))).all()) if ids else {}
+    resolved = [[names.get(ref) if isinstance(ref, int) else ref for ref in item] for item in refs]
+    return [[name for name in item if name] for item in resolved]
+
+
+def _sale_deltas(connection, deltas, items, sign=1):
+    """items: (created_at, flavors json or list, quantity)"""
+    items = [item for item in items if item[1]]
+    if not items:
+        return
+    names = _resolve_flavors(connection, [flavors for _, flavors, _ in items])
+    for (created_at, _, quantity), flavor_names in zip(items, names):
+        day = (created_at or datetime.utcnow()).date()
+        _add(deltas, SALE, day, sale_item_pairs(flavor_names, quantity), sign)
+
+
+def record_sale_items(session, rows):
+    """Count the pairs of sale items inserted in bulk (rows as passed to insert(SaleItem))"""
+    deltas = {}
+    _sale_deltas(session.connection(), deltas, [
+        (row.get('created_at'), row.get('flavors'), row.get('quantity')) for row in rows
+    ])
+    apply_deltas(session.connection(), deltas)
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_flavor_pairs(session, flush_context):
+    # Runs inside the flush transaction, so a rollback also discards the pair counts
+    deltas = {}
+    _production_deltas(session, deltas)
+    _sale_deltas(session.connection(), deltas, [
+        (obj.created_at, obj.flavors, obj.quantity) for obj in session.new if isinstance(obj, SaleItem)
+    ])
+    _sale_deltas(session.connection(), deltas, [
+        (obj.created_at, obj.flavors, obj.quantity) for obj in session.deleted if isinstance(obj, SaleItem)
+    ], -1)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+# -- queries ---------------------------------------------------------------
+
+def top_pairs(source=PRODUCTION, start=None, end=None, limit=10, flavor=None):
+    """Most frequent flavor pairs between two dates (inclusive) from the daily buckets.
+
+    With `flavor`, only pairs containing it: the flavors most often chosen
+    or produced together with it.
+    """
+    total = func.sum(FlavorPairDaily.count).label('count')
+    query = db.session.query(FlavorPairDaily.flavor_a, FlavorPairDaily.flavor_b, total)\
+        .filter(FlavorPairDaily.source == source)
+    if start:
+        query = query.filter(FlavorPairDaily.date >= start)
+    if end:
+        query = query.filter(FlavorPairDaily.date <= end)
+    if flavor:
+        query = query.filter(or_(FlavorPairDaily.flavor_a == flavor, FlavorPairDaily.flavor_b == flavor))
+    rows = query.group_by(FlavorPairDaily.flavor_a, FlavorPairDaily.flavor_b)\
+        .having(total > 0)\
+        .order_by(total.desc(), FlavorPairDaily.flavor_a, FlavorPairDaily.flavor_b)\
+        .limit(limit).all()
+    return [{'flavors': [row.flavor_a, row.flavor_b], 'count': int(row.count)} for row in rows]
+
+
+def rebuild(session):
+    """Recompute flavor_pair_daily from productions and sale items (backfill / repair)"""
+    deltas = {}
+    day = func.date(Production.production_date)
+    days = {}
+    for row_day, flavor, count in session.query(day, Production.flavor, func.count(Production.id))\
+            .filter(Production.production_date.isnot(None)).group_by(day, Production.flavor):
+        days.setdefault(_parse_day(row_day), {})[flavor] = count
+    for d, flavor_counts in days.items():
+        _add(deltas, PRODUCTION, d, production_pairs(flavor_counts))
+
+    items = session.query(SaleItem.created_at, SaleItem.flavors, SaleItem.quantity)\
+        .filter(SaleItem.flavors.isnot(None)).all()
+    _sale_deltas(session.connection(), deltas, items)
+
+    session.execute(FlavorPairDaily.__table__.delete())
+    rows = [{'source': source, 'date': d, 'flavor_a': a, 'flavor_b': b, 'count': n}
+            for (source, d, a, b), n in deltas.items() if n]
+    if rows:
+        session.execute(insert(FlavorPairDaily.__table__), rows)
+    return len(rows)
+
+
+def _parse_day(value):
+    return value if not isinstance(value, str) else datetime.strptime(value, '%Y-%m-%d').date()
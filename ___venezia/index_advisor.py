@@ -0,0 +1,190 @@
+import json
+import re
+import time
+from collections import namedtuple
+from sql_profiler import summary
+
+MIN_ROWS = 1000  # scans of smaller tables aren't worth an index
+SKIP = re.compile(r'^\s*(PRAGMA|SAVEPOINT|RELEASE|ROLLBACK|BEGIN|COMMIT|INSERT|CREATE|DROP|ALTER)\b', re.I)
+
+Finding = namedtuple('Finding', ['table', 'kind', 'detail', 'rows', 'suggestion'])
+
+# EXPLAIN QUERY PLAN details (SQLite >= 3.36)
+_SCAN = re.compile(r'^SCAN (\w+)(?: USING (COVERING )?INDEX (\w+))?$')
+_AUTOMATIC = re.compile(r'^SEARCH (\w+) USING AUTOMATIC (?:COVERING |PARTIAL )*INDEX \(([^)]*)\)')
+_TEMP_BTREE = re.compile(r'^USE TEMP B-TREE FOR ORDER BY')
+_ALIAS = re.compile(r'\b(\w+) AS (\w+)\b')
+_ORDER_BY = re.compile(r'\bORDER BY (.+?)(?:\bLIMIT\b|\bOFFSET\b|$)', re.I | re.S)
+_FROM_SUBQUERY = re.compile(r'^\s*SELECT\b.*?\bFROM\s*\(', re.I | re.S)
+
+
+def load_workload(*paths):
+    """Distinct statements from SQL_CAPTURE_FILE captures: [{statement, parameters, endpoints, ...}]"""
+    workload = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as capture:
+            for line in capture:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                known = workload.get(entry['fingerprint'])
+                if known is None:
+                    entry['endpoints'] = {entry.pop('endpoint', None)} - {None}
+                    workload[entry['fingerprint']] = entry
+                elif entry.get('endpoint'):
+                    known['endpoints'].add(entry['endpoint'])
+    return [entry for entry in workload.values() if not SKIP.match(entry['statement'])]
+
+
+def _parameters(parameters):
+    return tuple(parameters) if isinstance(parameters, list) else parameters
+
+
+def explain(connection, statement, parameters):
+    """EXPLAIN QUERY PLAN detail lines of a statement"""
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', _parameters(parameters)).all()
+    return [row[-1] for row in rows]
+
+
+def _columns(statement, alias):
+    """(equality, range, order) columns the statement compares to values or sorts by, for `alias`.
+
+    Join conditions (column = column) are left out: they only need an index on
+    the inner side of a join, which the plan reports as an automatic index.
+    """
+    name = re.escape(alias)
+    value = r"(?:\?|'|-?\d|\(|NULL\b|NOT\b)"
+    equality = re.findall(rf'\b{name}\.(\w+)\s*(?:=|\bIN\b|\bIS\b)\s*{value}', statement, re.I)
+    equality += re.findall(rf'\?\s*=\s*{name}\.(\w+)', statement)
+    ranges = re.findall(rf'\b{name}\.(\w+)\s*(?:>=|<=|>|<|\bBETWEEN\b)\s*{value}', statement, re.I)
+    order = []
+    match = _ORDER_BY.search(statement)
+    if match:
+        order = re.findall(rf'\b{name}\.(\w+)', match.group(1))
+
+    def unique(columns, taken=()):
+        seen = list(taken)
+        return [c for c in columns if not (c in seen or seen.append(c))]
+
+    equality = unique(equality)
+    ranges = unique(ranges, equality)
+    order = unique(order, equality + ranges)
+    return equality, ranges, order
+
+
+def suggest_columns(statement, alias):
+    """Index columns for a scanned table: equality columns, then one range column or the sort"""
+    equality, ranges, order = _columns(statement, alias)
+    columns = equality + (ranges[:1] if ranges else order)
+    return [c for c in columns if c != 'id'] or None
+
+
+class IndexAdvisor:
+    """Replays captured statements through EXPLAIN QUERY PLAN and reports what runs without an index.
+
+    Reported, for tables of MIN_ROWS rows or more: full table scans, automatic
+    indexes (SQLite builds a throwaway index on every execution) and sorts in
+    a temporary b-tree before a LIMIT. A suggestion that an existing index already covers is
+    reported as such: the planner chose not to use it. SQLite only.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.row_counts = {}
+        self.tables = set(connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).scalars())
+        self.indexes = {}  # table -> {index name: [columns]}
+
+    def rows(self, table):
+        if table not in self.row_counts:
+            self.row_counts[table] = self.connection.exec_driver_sql(f'SELECT COUNT(*) FROM "{table}"').scalar()
+        return self.row_counts[table]
+
+    def existing(self, table):
+        if table not in self.indexes:
+            self.indexes[table] = {
+                name: [row[2] for row in self.connection.exec_driver_sql(f'PRAGMA index_info("{name}")')]
+                for _, name, *_ in self.connection.exec_driver_sql(f'PRAGMA index_list("{table}")')
+            }
+        return self.indexes[table]
+
+    def suggestion(self, table, columns):
+        if not columns:
+            return None
+        for name, indexed in self.existing(table).items():
+            if indexed[:len(columns)] == columns:
+                return f'already covered by {name} ({", ".join(indexed)})'
+        return f"CREATE INDEX ix_{table}_{'_'.join(columns)} ON {table} ({', '.join(columns)})"
+
+    def findings(self, statement, plan):
+        aliases = {alias: table for table, alias in _ALIAS.findall(statement) if table in self.tables}
+        aliases.update({table: table for table in self.tables})
+        found = []
+        for detail in plan:
+            match = _SCAN.match(detail)
+            if match and match.group(1) in aliases:
+                table = aliases[match.group(1)]
+                if self.rows(table) >= MIN_ROWS:
+                    columns = suggest_columns(statement, match.group(1))
+                    index = match.group(3)
+                    if index and columns and self.existing(table).get(index, [])[:len(columns)] == columns:
+                        continue  # walks the index in the order the query asks for (ORDER BY ... LIMIT)
+                    kind = 'index scan' if index else 'full scan'
+                    found.append(Finding(table, kind, detail, self.rows(table), self.suggestion(table, columns)))
+                continue
+            match = _AUTOMATIC.match(detail)
+            if match and match.group(1) in aliases:
+                table = aliases[match.group(1)]
+                if self.rows(table) >= MIN_ROWS:
+                    columns = [c.split('=')[0].strip() for c in match.group(2).split(' AND ')]
+                    found.append(Finding(table, 'automatic index', detail, self.rows(table),
+                                         self.suggestion(table, columns)))
+                continue
+            # A sort an index could avoid: the first rows of a table, not a whole result or a subquery
+            if _TEMP_BTREE.match(detail) and ' LIMIT ' in statement and not _FROM_SUBQUERY.match(statement):
+                large = [t for t in set(aliases.values()) if re.search(rf'\b{t}\b', statement) and self.rows(t) >= MIN_ROWS]
+                if large:
+                    found.append(Finding(None, 'sort', detail, max(self.rows(t) for t in large), None))
+        return found
+
+    def analyze(self, workload):
+        """[(entry, plan, findings)] for every statement, the ones with findings first"""
+        report = []
+        for entry in workload:
+            try:
+                plan = explain(self.connection, entry['statement'], entry['parameters'])
+            except Exception as e:
+                report.append((entry, [f'error: {e}'], []))
+                continue
+            report.append((entry, plan, self.findings(entry['statement'], plan)))
+        report.sort(key=lambda item: -max([f.rows or 0 for f in item[2]] + [-1]))
+        return report
+
+    def time(self, entry, repeat=5):
+        """Best of `repeat` runs of a captured SELECT, in ms (None for other statements)"""
+        if not entry['statement'].lstrip().upper().startswith(('SELECT', 'WITH')):
+            return None
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            self.connection.exec_driver_sql(entry['statement'], _parameters(entry['parameters'])).all()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+
+def format_report(report, only_findings=True):
+    lines = []
+    for entry, plan, findings in report:
+        if only_findings and not findings:
+            continue
+        endpoints = ', '.join(sorted(entry.get('endpoints') or [])) or '-'
+        lines.append(f'{summary(entry["fingerprint"])}')
+        lines.append(f'    endpoints: {endpoints}')
+        for finding in findings:
+            rows = f' ({finding.rows} rows)' if finding.rows is not None else ''
+            lines.append(f'    {finding.kind}: {finding.detail}{rows}')
+            if finding.suggestion:
+                lines.append(f'        suggest: {finding.suggestion}')
+    return '\n'.join(lines)
@@ -0,0 +1,120 @@
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import case, insert, select, update
+from models import Ingredient, IngredientTransaction, ProductionCost
+from recipe_costing import recipe_costs
+
+SYSTEM_USER_ID = 1  # same placeholder user as the manual ingredient transactions
+
+Consumption = namedtuple('Consumption', ['lines', 'total_cost', 'shortages'])
+NO_CONSUMPTION = Consumption([], 0, [])
+
+
+def _set_stock_delta(session, deltas):
+    """One UPDATE for all ingredients: current_stock += delta (CASE on id)"""
+    table = Ingredient.__table__
+    session.execute(
+        update(table)
+        .where(table.c.id.in_(list(deltas)))
+        .values(current_stock=table.c.current_stock + case(deltas, value=table.c.id, else_=0))
+        .execution_options(ingredient_stock_only=True)
+    )
+
+
+def already_consumed(session, production_id):
+    return session.execute(
+        select(IngredientTransaction.id).where(
+            IngredientTransaction.production_id == production_id,
+            IngredientTransaction.transaction_type == 'usage'
+        ).limit(1)
+    ).first() is not None
+
+
+def consume_ingredients(session, production, product_id, user_id=SYSTEM_USER_ID):
+    """Use up the recipe ingredients of a completed batch; the caller commits.
+
+    The recipe (from the cached roll-up) is scaled to the batch kg. Usage
+    transactions and cost rows go in one bulk insert each and stock is
+    decremented with a single UPDATE. A batch is consumed at most once, so
+    completing it from a production order and from finish_production
+    doesn't count it twice. Stock may go negative: the batch was made, the
+    shortage is returned so it can be reported.
+    """
+    recipe = recipe_costs.for_product(product_id)
+    if recipe is None or not recipe.lines or already_consumed(session, production.id):
+        return NO_CONSUMPTION
+
+    now = datetime.utcnow()
+    kg = float(production.quantity or 0)
+    usage = {ingredient_id: round(per_kg * kg, 4) for ingredient_id, per_kg in recipe.lines}
+    lines = []
+    for ingredient_id, quantity in usage.items():
+        name, unit_cost = recipe.ingredients[ingredient_id]
+        lines.append({
+            'ingredient_id': ingredient_id,
+            'ingredient': name,
+            'quantity': quantity,
+            'unit_cost': unit_cost,
+            'total_cost': round(quantity * unit_cost, 2)
+        })
+
+    session.execute(insert(IngredientTransaction.__table__), [{
+        'ingredient_id': line['ingredient_id'],
+        'production_id': production.id,
+        'user_id': user_id,
+        'quantity': line['quantity'],
+        'transaction_type': 'usage',
+        'unit_cost': line['unit_cost'],
+        'timestamp': now,
+        'notes': f'Producción - Lote {production.batch_number}'
+    } for line in lines])
+    session.execute(insert(ProductionCost.__table__), [{
+        'production_id': production.id,
+        'ingredient': line['ingredient'],
+        'quantity': line['quantity'],
+        'unit_cost': line['unit_cost'],
+        'total_cost': line['total_cost'],
+        'date': now
+    } for line in lines])
+    _set_stock_delta(session, {ingredient_id: -quantity for ingredient_id, quantity in usage.items()})
+
+    shortages = [{'ingredient_id': row.id, 'name': row.name, 'current_stock': row.current_stock}
+                 for row in session.execute(
+                     select(Ingredient.id, Ingredient.name, Ingredient.current_stock)
+                     .where(Ingredient.id.in_(list(usage)), Ingredient.current_stock < 0)
+                 )]
+    total_cost = round(sum(line['total_cost'] for line in lines), 2)
+    production.production_cost = total_cost
+    return Consumption(lines, total_cost, shortages)
+
+
+def release_ingredients(session, production, user_id=SYSTEM_USER_ID):
+    """Give back what a batch consumed before it is deleted; the caller commits"""
+    usages = session.execute(
+        select(IngredientTransaction.id, IngredientTransaction.ingredient_id, IngredientTransaction.quantity,
+               IngredientTransaction.unit_cost).where(
+            IngredientTransaction.production_id == production.id,
+            IngredientTransaction.transaction_type == 'usage'
+        )
+    ).all()
+    if usages:
+        now = datetime.utcnow()
+        returned = {}
+        for row in usages:
+            returned[row.ingredient_id] = returned.get(row.ingredient_id, 0) + float(row.quantity or 0)
+        session.execute(insert(IngredientTransaction.__table__), [{
+            'ingredient_id': ingredient_id,
+            'user_id': user_id,
+            'quantity': quantity,
+            'transaction_type': 'adjustment',
+            'timestamp': now,
+            'notes': f'Devolución - Lote {production.batch_number} eliminado'
+        } for ingredient_id, quantity in returned.items()])
+        _set_stock_delta(session, returned)
+        # Keep the usage history, detached from the batch that no longer exists
+        session.execute(
+            update(IngredientTransaction.__table__)
+            .where(IngredientTransaction.__table__.c.id.in_([row.id for row in usages]))
+            .values(production_id=None)
+        )
+    session.execute(ProductionCost.__table__.delete().where(ProductionCost.__table__.c.production_id == production.id))
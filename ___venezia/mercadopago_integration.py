@@ -1,7 +1,41 @@
 import os
+import time
 import mercadopago
 from datetime import datetime, timedelta
-from models import DeliveryOrder, Sale, db
+from mercadopago.config import RequestOptions
+from mercadopago.http import HttpClient
+from models import DeliveryOrder, DeliveryStatus, Sale, db
+from metrics import metrics
+
+MP_API_URL = 'https://api.mercadopago.com'
+PAID_DELIVERY_STATUS_ID = 2  # "En Preparación": where a delivery goes once its payment is approved
+
+
+class TimedHttpClient(HttpClient):
+    """SDK http client that reports every API call to /metrics"""
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = super().request(method, url, maxretries=maxretries, **kwargs)
+            ok = result.get('status', 0) < 500
+            return result
+        finally:
+            metrics.observe_outbound('mercadopago', time.perf_counter() - started, ok)
+
+
+class RebasedHttpClient(TimedHttpClient):
+    """SDK http client pointed at another API host (e.g. scripts/mp_stub_server.py)"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        if url.startswith(MP_API_URL):
+            url = self.base_url + url[len(MP_API_URL):]
+        return super().request(method, url, maxretries=maxretries, **kwargs)
+
 
 class MercadoPagoIntegration:
     def __init__(self):
@@ -12,88 +46,116 @@ class MercadoPagoIntegration:
             self.is_configured = False
         else:
             self.is_configured = True
-        self.mp = mercadopago.SDK(access_token)
+        # Short timeout and no SDK-level retries: the payment queue retries with backoff
+        options = RequestOptions(
+            connection_timeout=float(os.environ.get('MERCADOPAGO_TIMEOUT', '10')),
+            max_retries=0
+        )
+        base_url = os.environ.get('MERCADOPAGO_API_BASE_URL')
+        http_client = RebasedHttpClient(base_url) if base_url else TimedHttpClient()
+        self.mp = mercadopago.SDK(access_token, http_client=http_client, request_options=options)
+
+    def build_preference_data(self, order_or_sale):
+        """Preference payload for a delivery order or sale (no API call, no DB writes)"""
+        # Determine if this is a delivery order or direct sale
+        if hasattr(order_or_sale, 'sale'):
+            # It's a delivery order
+            sale = order_or_sale.sale
+            title = f"Pedido de Helado #{order_or_sale.id}"
+            description = f"Pedido para {order_or_sale.address.customer_name}"
+            external_ref = str(order_or_sale.id)
+            success_url = f"{os.environ.get('BASE_URL')}/delivery/payment/success"
+            failure_url = f"{os.environ.get('BASE_URL')}/delivery/payment/failure"
+            pending_url = f"{os.environ.get('BASE_URL')}/delivery/payment/pending"
+        else:
+            # It's a direct sale
+            sale = order_or_sale
+            title = f"Venta #{sale.id}"
+            description = "Venta en tienda"
+            external_ref = str(sale.id)
+            success_url = f"{os.environ.get('BASE_URL')}/payment/success"
+            failure_url = f"{os.environ.get('BASE_URL')}/payment/failure"
+            pending_url = f"{os.environ.get('BASE_URL')}/payment/pending"
         
-    def create_preference(self, order_or_sale):
-        """Create a MercadoPago preference for a delivery order or sale"""
+        # Create the preference data
+        preference_data = {
+            "items": [
+                {
+                    "title": title,
+                    "quantity": 1,
+                    "currency_id": "ARS",  # Argentine Peso
+                    "unit_price": float(sale.total_amount),
+                    "description": description
+                }
+            ],
+            "external_reference": external_ref,
+            "notification_url": os.environ.get('MERCADOPAGO_WEBHOOK_URL'),
+            "back_urls": {
+                "success": success_url,
+                "failure": failure_url,
+                "pending": pending_url
+            },
+            "payment_methods": {
+                "excluded_payment_types": [{"id": "ticket"}],  # Exclude payment types that don't support QR
+                "installments": 1  # No installments for food orders
+            },
+            "statement_descriptor": "Venezia Helados",
+            "expires": True,
+            "expiration_date_to": (datetime.now() + timedelta(hours=24)).isoformat()
+        }
+        
+        return preference_data
+
+    def request_preference(self, preference_data):
+        """Call the preferences API; returns (success, response_data or error message)"""
         if not self.is_configured:
             return False, "MercadoPago is not configured. Please set MERCADOPAGO_ACCESS_TOKEN."
-            
+
         try:
-            # Determine if this is a delivery order or direct sale
-            if hasattr(order_or_sale, 'sale'):
-                # It's a delivery order
-                sale = order_or_sale.sale
-                title = f"Pedido de Helado #{order_or_sale.id}"
-                description = f"Pedido para {order_or_sale.address.customer_name}"
-                external_ref = str(order_or_sale.id)
-                success_url = f"{os.environ.get('BASE_URL')}/delivery/payment/success"
-                failure_url = f"{os.environ.get('BASE_URL')}/delivery/payment/failure"
-                pending_url = f"{os.environ.get('BASE_URL')}/delivery/payment/pending"
-            else:
-                # It's a direct sale
-                sale = order_or_sale
-                title = f"Venta #{sale.id}"
-                description = "Venta en tienda"
-                external_ref = str(sale.id)
-                success_url = f"{os.environ.get('BASE_URL')}/payment/success"
-                failure_url = f"{os.environ.get('BASE_URL')}/payment/failure"
-                pending_url = f"{os.environ.get('BASE_URL')}/payment/pending"
-            
-            # Create the preference data
-            preference_data = {
-                "items": [
-                    {
-                        "title": title,
-                        "quantity": 1,
-                        "currency_id": "ARS",  # Argentine Peso
-                        "unit_price": float(sale.total_amount),
-                        "description": description
-                    }
-                ],
-                "external_reference": external_ref,
-                "notification_url": os.environ.get('MERCADOPAGO_WEBHOOK_URL'),
-                "back_urls": {
-                    "success": success_url,
-                    "failure": failure_url,
-                    "pending": pending_url
-                },
-                "payment_methods": {
-                    "excluded_payment_types": [{"id": "ticket"}],  # Exclude payment types that don't support QR
-                    "installments": 1  # No installments for food orders
-                },
-                "statement_descriptor": "Venezia Helados",
-                "expires": True,
-                "expiration_date_to": (datetime.now() + timedelta(hours=24)).isoformat()
-            }
-            
-            # Create the preference
             preference_response = self.mp.preference().create(preference_data)
-            
+
             if preference_response["status"] == 201:
                 response = preference_response["response"]
-                response_data = {
+                return True, {
                     "id": response["id"],
                     "payment_link": response["init_point"],
                     "qr_code": response.get("point_of_interaction", {}).get("transaction_data", {}).get("qr_code")
                 }
-                
-                if hasattr(order_or_sale, 'sale'):
-                    # Update delivery order with payment info
-                    order_or_sale.mp_preference_id = response_data["id"]
-                    order_or_sale.mp_payment_link = response_data["payment_link"]
-                    order_or_sale.mp_qr_link = response_data["qr_code"]
-                    order_or_sale.mp_status = "pending"
-                    order_or_sale.mp_created_at = datetime.now()
-                    db.session.commit()
-                
-                return True, response_data
-            
-            return False, "Error creating MercadoPago preference"
-            
+
+            return False, f"Error creating MercadoPago preference (HTTP {preference_response['status']})"
+
         except Exception as e:
             return False, str(e)
-            
+
+    def create_preference(self, order_or_sale):
+        """Create a MercadoPago preference for a delivery order or sale.
+
+        Delivery orders get the payment fields set on the object; committing is
+        up to the caller. Sales are normally handled by payment_queue instead,
+        off the request that creates them.
+        """
+        if not self.is_configured:
+            return False, "MercadoPago is not configured. Please set MERCADOPAGO_ACCESS_TOKEN."
+
+        try:
+            success, response_data = self.request_preference(self.build_preference_data(order_or_sale))
+        except Exception as e:
+            return False, str(e)
+
+        if success:
+            self.apply_preference(order_or_sale, response_data)
+        return success, response_data
+
+    def apply_preference(self, order_or_sale, response_data):
+        """Store a created preference on a delivery order (sales keep theirs in payment_queue)"""
+        if hasattr(order_or_sale, 'sale'):
+            # Update delivery order with payment info
+            order_or_sale.mp_preference_id = response_data["id"]
+            order_or_sale.mp_payment_link = response_data["payment_link"]
+            order_or_sale.mp_qr_link = response_data["qr_code"]
+            order_or_sale.mp_status = "pending"
+            order_or_sale.mp_created_at = datetime.now()
+
     def create_delivery_preference(self, delivery_order, sale=None):
         """Create a MercadoPago preference for a delivery order"""
         return self.create_preference(delivery_order)
@@ -102,65 +164,94 @@ class MercadoPagoIntegration:
         """Create a MercadoPago preference for a regular (non-delivery) sale"""
         return self.create_preference(sale)
 
+    def fetch_payment(self, payment_id):
+        """Get a payment from the API; returns (success, payment dict or error message)"""
+        if not self.is_configured:
+            return False, "MercadoPago is not configured. Please set MERCADOPAGO_ACCESS_TOKEN."
+
+        try:
+            payment_info = self.mp.payment().get(payment_id)
+            if payment_info["status"] == 200:
+                return True, payment_info["response"]
+            return False, f"Error getting payment information (HTTP {payment_info['status']})"
+        except Exception as e:
+            return False, str(e)
+
+    def _payment_target(self, external_reference):
+        """Delivery order or sale a payment belongs to.
+
+        Webshop preferences use the delivery order id as external reference and
+        POS preferences the sale id, so a delivery order only matches when its
+        own preference was created.
+        """
+        try:
+            reference = int(external_reference)
+        except (TypeError, ValueError):
+            return None
+        delivery = DeliveryOrder.query.get(reference)
+        if delivery and delivery.mp_preference_id:
+            return delivery
+        return Sale.query.get(reference) or delivery
+
+    def _copy_payment(self, target, payment, now):
+        target.mp_payment_id = str(payment["id"])
+        target.mp_status = payment["status"]
+        target.mp_payment_type = payment.get("payment_type_id")
+        target.mp_payment_method = payment.get("payment_method_id")
+        target.mp_card_last_four = (payment.get("card") or {}).get("last_four_digits")
+        target.mp_rejection_reason = payment.get("status_detail")
+        if payment["status"] == "approved" and not target.mp_approved_at:
+            target.mp_approved_at = now
+        target.mp_last_updated = now
+
+    def apply_payment(self, payment):
+        """Copy a payment's state onto its delivery order and/or sale; the caller commits.
+
+        Safe to repeat for the same payment: the approval timestamp and the move
+        of the delivery order to "En Preparación" only happen on the first approval.
+        """
+        target = self._payment_target(payment.get("external_reference"))
+        if target is None:
+            return False, "Order/Sale not found"
+
+        now = datetime.now()
+        if isinstance(target, DeliveryOrder):
+            was_approved = target.mp_status == "approved"
+            self._copy_payment(target, payment, now)
+            # Update linked sale as well if exists
+            if target.sale:
+                self._copy_payment(target.sale, payment, now)
+                target.sale.payment_status = payment["status"]
+            if payment["status"] == "approved" and not was_approved:
+                paid_status = DeliveryStatus.query.get(PAID_DELIVERY_STATUS_ID)
+                current = target.current_status
+                # Only move forward: never pull back an order already on its way
+                if paid_status and (current is None or current.order < paid_status.order):
+                    target.update_status(paid_status.id, notes="Pago aprobado (MercadoPago)",
+                                         created_by="mercadopago", commit=False)
+        else:
+            self._copy_payment(target, payment, now)
+            target.payment_status = payment["status"]
+        return True, "Payment status updated"
+
     def process_webhook(self, data):
-        """Process webhook notifications from MercadoPago"""
+        """Process a webhook notification inline (the webhook routes queue them in payment_queue instead)"""
         if not self.is_configured:
             return False, "MercadoPago is not configured. Please set MERCADOPAGO_ACCESS_TOKEN."
-            
+
         try:
-            if data["type"] == "payment":
-                payment_id = data["data"]["id"]
-                payment_info = self.mp.payment().get(payment_id)
-                
-                if payment_info["status"] == 200:
-                    payment = payment_info["response"]
-                    delivery_id = int(payment["external_reference"])
-                    delivery = DeliveryOrder.query.get(delivery_id)
-                    
-                    if delivery:
-                        delivery.mp_payment_id = str(payment["id"])
-                        delivery.mp_status = payment["status"]
-                        delivery.mp_payment_type = payment.get("payment_type_id")
-                        delivery.mp_payment_method = payment.get("payment_method_id")
-                        delivery.mp_card_last_four = payment.get("card", {}).get("last_four_digits")
-                        delivery.mp_rejection_reason = payment.get("status_detail")
-                        if payment["status"] == "approved":
-                            delivery.mp_approved_at = datetime.now()
-                        delivery.mp_last_updated = datetime.now()
-                        # Update linked sale as well if exists
-                        if delivery.sale:
-                            delivery.sale.mp_payment_id = str(payment["id"])
-                            delivery.sale.mp_status = payment["status"]
-                            delivery.sale.mp_payment_type = payment.get("payment_type_id")
-                            delivery.sale.mp_payment_method = payment.get("payment_method_id")
-                            if payment["status"] == "approved":
-                                delivery.sale.mp_approved_at = datetime.now()
-                            delivery.sale.mp_last_updated = datetime.now()
-                            delivery.sale.payment_status = payment["status"]
-                        db.session.commit()
-                        return True, "Payment status updated"
-                    # If not a delivery, try direct sale by external reference
-                    sale = Sale.query.get(delivery_id)
-                    if sale:
-                        sale.mp_payment_id = str(payment["id"])
-                        sale.mp_status = payment["status"]
-                        sale.mp_payment_type = payment.get("payment_type_id")
-                        sale.mp_payment_method = payment.get("payment_method_id")
-                        sale.mp_card_last_four = payment.get("card", {}).get("last_four_digits")
-                        sale.mp_rejection_reason = payment.get("status_detail")
-                        if payment["status"] == "approved":
-                            sale.mp_approved_at = datetime.now()
-                        sale.mp_last_updated = datetime.now()
-                        sale.payment_status = payment["status"]
-                        db.session.commit()
-                        return True, "Payment status updated"
-                    return False, "Order/Sale not found"
-                
-                return False, "Error getting payment information"
-            
-            return True, "Non-payment webhook received"
-            
+            if data["type"] != "payment":
+                return True, "Non-payment webhook received"
+            success, payment = self.fetch_payment(data["data"]["id"])
+            if not success:
+                return False, payment
+            success, message = self.apply_payment(payment)
+            if success:
+                db.session.commit()
+            return success, message
+
         except Exception as e:
+            db.session.rollback()
             return False, str(e)
 
     def get_payment_status(self, payment_id):
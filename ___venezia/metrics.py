@@ -0,0 +1,298 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds in seconds; the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10)
+OUTBOUND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _Shard:
+    """Counters written by a single thread: recording never takes a lock"""
+
+    def __init__(self):
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.errors = {}  # (endpoint, method) -> count
+        self.latency = {}  # (endpoint, method) -> [count per bucket..., +Inf count, sum]
+        self.outbound = {}  # service -> [count per bucket..., +Inf count, sum]
+        self.outbound_requests = {}  # (service, outcome) -> count
+
+
+def _observe(histograms, key, buckets, seconds):
+    counts = histograms.get(key)
+    if counts is None:
+        counts = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+    counts[bisect_left(buckets, seconds)] += 1
+    counts[-1] += seconds
+
+
+def _merge_counts(total, part):
+    for key, value in part.items():
+        total[key] = total.get(key, 0) + value
+
+
+def _merge_histograms(total, part):
+    for key, counts in part.items():
+        merged = total.get(key)
+        if merged is None:
+            total[key] = list(counts)
+        else:
+            for i, value in enumerate(counts):
+                merged[i] += value
+
+
+def quantile(buckets, counts, q):
+    """Estimate a quantile from histogram bucket counts (linear within the bucket, like histogram_quantile)"""
+    total = sum(counts[:-1])
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts[:-1]):
+        if seen + count >= rank and count:
+            if i == len(buckets):
+                return buckets[-1]  # in +Inf: the best we can say is "above the last bound"
+            lower = buckets[i - 1] if i else 0
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}' if labels else ''
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class Metrics:
+    """Request latency histograms, error counters and outbound HTTP timings for /metrics.
+
+    Each thread records into its own shard without locking; a scrape sums the
+    shards (and those of finished threads, folded into `retired`) and renders
+    the Prometheus text format. Counters are per process: with several
+    workers each one is scraped (or summed) separately.
+    """
+
+    def __init__(self):
+        # Only for the shard list, never on the request path. Reentrant: a thread's finalizer
+        # (_retire) may run from garbage collection while a scrape holds it
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.shards = []
+        self.retired = _Shard()
+        self.started = time.time()
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = _Shard()
+            with self.lock:
+                self.shards.append(shard)
+            # Threads come and go (one per request with the dev server): fold their counters when they end
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self.lock:
+            if shard in self.shards:
+                self.shards.remove(shard)
+                self._fold(self.retired, shard)
+
+    @staticmethod
+    def _fold(total, shard):
+        _merge_counts(total.requests, shard.requests.copy())
+        _merge_counts(total.errors, shard.errors.copy())
+        _merge_histograms(total.latency, shard.latency.copy())
+        _merge_histograms(total.outbound, shard.outbound.copy())
+        _merge_counts(total.outbound_requests, shard.outbound_requests.copy())
+
+    # -- recording ---------------------------------------------------------
+
+    def _start(self):
+        g.metrics_started = time.perf_counter()
+
+    def _finish(self, response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            self.observe_request(request.endpoint, request.method, response.status_code,
+                                 time.perf_counter() - started)
+        return response
+
+    def _teardown(self, exc):
+        # after_request doesn't run when an exception propagates: count it as a 500 here
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            self.observe_request(request.endpoint, request.method, 500, time.perf_counter() - started)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        shard = self._shard()
+        endpoint = endpoint or 'unmatched'  # 404s: one label, not one per URL
+        key = (endpoint, method, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        if status >= 500:
+            shard.errors[(endpoint, method)] = shard.errors.get((endpoint, method), 0) + 1
+        _observe(shard.latency, (endpoint, method), LATENCY_BUCKETS, seconds)
+
+    def observe_outbound(self, service, seconds, ok=True):
+        shard = self._shard()
+        key = (service, 'ok' if ok else 'error')
+        shard.outbound_requests[key] = shard.outbound_requests.get(key, 0) + 1
+        _observe(shard.outbound, service, OUTBOUND_BUCKETS, seconds)
+
+    @contextmanager
+    def outbound(self, service):
+        """Time a call to an external API; an exception counts as an error"""
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.observe_outbound(service, time.perf_counter() - started, ok)
+
+    # -- reading -----------------------------------------------------------
+
+    def snapshot(self):
+        """All shards summed into one"""
+        total = _Shard()
+        with self.lock:
+            self._fold(total, self.retired)
+            for shard in self.shards:
+                self._fold(total, shard)
+        return total
+
+    def latency_summary(self):
+        """p50/p95/p99 per endpoint, estimated from the histogram buckets"""
+        total = self.snapshot()
+        summary = []
+        for (endpoint, method), counts in total.latency.items():
+            requests = sum(counts[:-1])
+            summary.append({
+                'endpoint': endpoint,
+                'method': method,
+                'requests': requests,
+                'errors': total.errors.get((endpoint, method), 0),
+                'avg_ms': round(counts[-1] * 1000 / requests, 2),
+                **{f'p{int(q * 100)}_ms': round(quantile(LATENCY_BUCKETS, counts, q) * 1000, 2) for q in QUANTILES}
+            })
+        summary.sort(key=lambda s: -s['requests'])
+        return summary
+
+    def render(self, sql=None, caches=None, queues=None, writers=None, replica=None):
+        """Prometheus text format; sql/caches/queues/writers/replica are the stats() of the other modules"""
+        total = self.snapshot()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, buckets, counts, **labels):
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(**labels)} {_number(counts[-1])}')
+            lines.append(f'{name}_count{_labels(**labels)} {cumulative}')
+
+        family('venezia_uptime_seconds', 'gauge', 'Seconds since this worker started')
+        lines.append(f'venezia_uptime_seconds {_number(time.time() - self.started)}')
+
+        family('venezia_http_requests_total', 'counter', 'Requests served, by endpoint, method and status')
+        for (endpoint, method, status), count in sorted(total.requests.items()):
+            lines.append(f'venezia_http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+        family('venezia_http_request_errors_total', 'counter', 'Requests that ended in a 5xx or an unhandled exception')
+        for (endpoint, method), count in sorted(total.errors.items()):
+            lines.append(f'venezia_http_request_errors_total{_labels(endpoint=endpoint, method=method)} {count}')
+        family('venezia_http_request_duration_seconds', 'histogram', 'Request latency')
+        for (endpoint, method), counts in sorted(total.latency.items()):
+            histogram('venezia_http_request_duration_seconds', LATENCY_BUCKETS, counts, endpoint=endpoint, method=method)
+
+        if sql is not None:
+            family('venezia_db_queries_total', 'counter', 'SQL statements run while serving requests')
+            for e in sql['endpoints']:
+                lines.append(f'venezia_db_queries_total{_labels(endpoint=e["endpoint"])} {e["queries"]}')
+            family('venezia_db_seconds_total', 'counter', 'Time spent in the database while serving requests')
+            for e in sql['endpoints']:
+                lines.append(f'venezia_db_seconds_total{_labels(endpoint=e["endpoint"])} {_number(e["db_ms"] / 1000)}')
+            family('venezia_db_time_share', 'gauge', 'Share of request time spent in the database')
+            for e in sql['endpoints']:
+                lines.append(f'venezia_db_time_share{_labels(endpoint=e["endpoint"])} {_number(e["db_share"])}')
+            family('venezia_db_n_plus_one_requests_total', 'counter', 'Requests that repeated a statement past the N+1 threshold')
+            for e in sql['endpoints']:
+                lines.append(f'venezia_db_n_plus_one_requests_total{_labels(endpoint=e["endpoint"])} {e["n_plus_one_requests"]}')
+
+        family('venezia_outbound_requests_total', 'counter', 'Calls to external APIs (MercadoPago, WhatsApp)')
+        for (service, outcome), count in sorted(total.outbound_requests.items()):
+            lines.append(f'venezia_outbound_requests_total{_labels(service=service, outcome=outcome)} {count}')
+        family('venezia_outbound_request_duration_seconds', 'histogram', 'Latency of calls to external APIs')
+        for service, counts in sorted(total.outbound.items()):
+            histogram('venezia_outbound_request_duration_seconds', OUTBOUND_BUCKETS, counts, service=service)
+
+        if caches:
+            family('venezia_cache_hits_total', 'counter', 'Cache lookups served from memory')
+            for name, stats in caches.items():
+                lines.append(f'venezia_cache_hits_total{_labels(cache=name)} {stats["hits"]}')
+            family('venezia_cache_misses_total', 'counter', 'Cache lookups that went to the database')
+            for name, stats in caches.items():
+                lines.append(f'venezia_cache_misses_total{_labels(cache=name)} {stats["misses"]}')
+            family('venezia_cache_hit_ratio', 'gauge', 'Hits over lookups since the worker started')
+            for name, stats in caches.items():
+                lines.append(f'venezia_cache_hit_ratio{_labels(cache=name)} {_number(stats["hit_ratio"])}')
+
+        if queues:
+            family('venezia_queue_jobs', 'gauge', 'Background queue jobs by status')
+            for name, stats in queues.items():
+                for status, count in sorted(stats['jobs'].items(), key=lambda item: str(item[0])):
+                    lines.append(f'venezia_queue_jobs{_labels(queue=name, status=status)} {count}')
+            family('venezia_queue_processed_total', 'counter', 'Jobs processed by this worker')
+            for name, stats in queues.items():
+                lines.append(f'venezia_queue_processed_total{_labels(queue=name)} {stats["processed"]}')
+            family('venezia_queue_failures_total', 'counter', 'Job attempts that failed in this worker')
+            for name, stats in queues.items():
+                lines.append(f'venezia_queue_failures_total{_labels(queue=name)} {stats["failures"]}')
+
+        if writers:
+            family('venezia_sqlite_write_transactions_total', 'counter', 'Write transactions through the SQLite writer queue')
+            lines.append(f'venezia_sqlite_write_transactions_total {writers["transactions"]}')
+            family('venezia_sqlite_write_waits_total', 'counter', 'Write transactions that had to wait for their turn')
+            lines.append(f'venezia_sqlite_write_waits_total {writers["waits"]}')
+            family('venezia_sqlite_write_timeouts_total', 'counter', 'Write transactions that gave up waiting')
+            lines.append(f'venezia_sqlite_write_timeouts_total {writers["timeouts"]}')
+            family('venezia_sqlite_writers_waiting', 'gauge', 'Write transactions waiting for their turn now')
+            lines.append(f'venezia_sqlite_writers_waiting {writers["waiting"]}')
+
+        if replica:
+            if replica['staleness_seconds'] is not None:
+                family('venezia_analytics_replica_staleness_seconds', 'gauge', 'How far the analytics replica is behind')
+                lines.append(f'venezia_analytics_replica_staleness_seconds {_number(replica["staleness_seconds"])}')
+            family('venezia_analytics_replica_requests_total', 'counter', 'Analytics requests by the database that served them')
+            lines.append(f'venezia_analytics_replica_requests_total{_labels(source="replica")} {replica["replica_requests"]}')
+            lines.append(f'venezia_analytics_replica_requests_total{_labels(source="primary")} {replica["fallback_requests"]}')
+            family('venezia_analytics_replica_refresh_failures_total', 'counter', 'Replica refreshes that failed in this worker')
+            lines.append(f'venezia_analytics_replica_refresh_failures_total {replica["failures"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
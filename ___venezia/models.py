@@ -101,6 +101,9 @@ class Store(db.Model):
 
 class Stock(db.Model):
     __tablename__ = 'stocks'
+    __table_args__ = (
+        db.Index('uq_stocks_store_product', 'store_id', 'product_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
@@ -111,15 +114,36 @@ class Stock(db.Model):
 
 class StockHistory(db.Model):
     __tablename__ = 'stock_history'
+    __table_args__ = (
+        db.Index('ix_stock_history_timestamp', 'timestamp'),
+        db.Index('ix_stock_history_store_product_timestamp', 'store_id', 'product_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
-    quantity_change = db.Column(db.Integer, nullable=False)
+    quantity_change = db.Column(db.Float, nullable=False)
     reason = db.Column(db.String(200))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+class StockLedgerSnapshot(db.Model):
+    """Stock of every store and product at taken_at (a checkpoint), folded from stock_history by stock_ledger"""
+    __tablename__ = 'stock_ledger_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('taken_at', 'store_id', 'product_id', name='uq_stock_ledger_snapshot_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    quantity = db.Column(db.Float, nullable=False, default=0)
+
 class Sale(db.Model):
     __tablename__ = 'sales'
+    __table_args__ = (
+        # Date ranges and keyset pages newest first, overall and per store
+        db.Index('ix_sales_created_at', 'created_at', 'id'),
+        db.Index('ix_sales_store_created_at', 'store_id', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
@@ -149,6 +173,9 @@ class Sale(db.Model):
 
 class SaleItem(db.Model):
     __tablename__ = 'sale_items'
+    __table_args__ = (
+        db.Index('ix_sale_items_sale', 'sale_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sale_id = db.Column(db.Integer, db.ForeignKey('sales.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
@@ -169,10 +196,110 @@ class SaleItem(db.Model):
     
     # Set flavors from a list
     def set_flavors_list(self, flavors_list):
+        self.flavors = SaleItem.encode_flavors(flavors_list)
+
+    # JSON column value for a flavors list (used by bulk inserts too)
+    @staticmethod
+    def encode_flavors(flavors_list):
         if flavors_list:
-            self.flavors = json.dumps(flavors_list)
-        else:
-            self.flavors = None
+            return json.dumps(flavors_list)
+        return None
+
+class Cart(db.Model):
+    """Server-side cart (POS or webshop), referenced from the session by its short id"""
+    __tablename__ = 'carts'
+    id = db.Column(db.String(16), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False, default='pos')  # 'pos' or 'webshop'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class CartLine(db.Model):
+    __tablename__ = 'cart_lines'
+    __table_args__ = (
+        db.Index('ix_cart_lines_cart_id', 'cart_id', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.String(16), db.ForeignKey('carts.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    unit_price = db.Column(db.Float, nullable=False)
+    data = db.Column(db.Text)  # JSON: name, flavors and channel specific fields
+
+class NumberSequence(db.Model):
+    """Counter behind batch and order numbers, one row per sequence key"""
+    __tablename__ = 'number_sequences'
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PaymentLinkJob(db.Model):
+    """Pending MercadoPago preference for a sale, processed by payment_queue"""
+    __tablename__ = 'payment_link_jobs'
+    __table_args__ = (
+        db.Index('ix_payment_link_jobs_due', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sales.id'), nullable=False, unique=True)
+    delivery_order_id = db.Column(db.Integer, db.ForeignKey('delivery_orders.id'))
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PaymentNotification(db.Model):
+    """MercadoPago webhook notification, one row per (topic, resource id); repeats bump received_count"""
+    __tablename__ = 'payment_notifications'
+    __table_args__ = (
+        db.UniqueConstraint('topic', 'resource_id', name='uq_payment_notifications_resource'),
+        db.Index('ix_payment_notifications_due', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(50), nullable=False)  # 'payment', 'merchant_order', ...
+    resource_id = db.Column(db.String(100), nullable=False)
+    raw = db.Column(db.Text)  # last notification body as received
+    received_count = db.Column(db.Integer, nullable=False, default=1)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed, ignored
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(500))
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+
+class SalesDailyRollup(db.Model):
+    """Sale count and amount per day, maintained incrementally by sales_rollup"""
+    __tablename__ = 'sales_daily_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'date', 'payment_method', 'payment_status', 'is_delivery',
+                            name='uq_sales_daily_rollup_key'),
+        db.Index('ix_sales_daily_rollup_date', 'date', 'store_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    payment_method = db.Column(db.String(50), nullable=False)
+    payment_status = db.Column(db.String(20), nullable=False, default='pending')
+    is_delivery = db.Column(db.Boolean, nullable=False, default=False)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0)
+
+class FlavorPairDaily(db.Model):
+    """Flavor pair co-occurrence per day, maintained incrementally by flavor_affinity"""
+    __tablename__ = 'flavor_pair_daily'
+    __table_args__ = (
+        db.UniqueConstraint('source', 'date', 'flavor_a', 'flavor_b', name='uq_flavor_pair_daily_key'),
+        db.Index('ix_flavor_pair_daily_date', 'source', 'date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(20), nullable=False)  # 'production' or 'sale'
+    date = db.Column(db.Date, nullable=False)
+    flavor_a = db.Column(db.String(100), nullable=False)  # flavor_a <= flavor_b
+    flavor_b = db.Column(db.String(100), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 class Product(db.Model):
     __tablename__ = 'products'
@@ -228,6 +355,9 @@ class Ingredient(db.Model):
 
 class IngredientTransaction(db.Model):
     __tablename__ = 'ingredient_transactions'
+    __table_args__ = (
+        db.Index('ix_ingredient_transactions_production', 'production_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), nullable=False)
     production_id = db.Column(db.Integer, db.ForeignKey('productions.id'))
@@ -259,20 +389,18 @@ class Production(db.Model):
 
     @staticmethod
     def generate_batch_number(flavor):
+        from sequences import sequence_allocator, max_suffix
         flavor_code = FLAVORS[flavor]
-        last_production = Production.query.filter(
-            Production.batch_number.like(f'{flavor_code}%')
-        ).order_by(Production.batch_number.desc()).first()
-        
-        if last_production:
-            last_number = int(last_production.batch_number[5:])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        
+        new_number = sequence_allocator.next(
+            f'batch:{flavor_code}',
+            seed=lambda: max_suffix(Production.batch_number, flavor_code)
+        )
         return f"{flavor_code}{new_number:04d}"
 
 class ProductionCost(db.Model):
+    __table_args__ = (
+        db.Index('ix_production_cost_production', 'production_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     production_id = db.Column(db.Integer, db.ForeignKey('productions.id'), nullable=False)
     ingredient = db.Column(db.String(100), nullable=False)
@@ -282,6 +410,25 @@ class ProductionCost(db.Model):
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     production = db.relationship('Production', backref='costs')
 
+class ProductionEvent(db.Model):
+    """Timeline of a batch: start, pause, resume, finish, waste and QC events"""
+    __tablename__ = 'production_events'
+    __table_args__ = (
+        db.Index('ix_production_events_production', 'production_id', 'occurred_at'),
+        db.Index('ix_production_events_occurred', 'occurred_at'),
+    )
+    TYPES = ('start', 'pause', 'resume', 'finish', 'waste', 'qc')
+
+    id = db.Column(db.Integer, primary_key=True)
+    production_id = db.Column(db.Integer, db.ForeignKey('productions.id'), nullable=False)
+    event_type = db.Column(db.String(10), nullable=False)
+    occurred_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    quantity = db.Column(db.Float)  # kg wasted, for 'waste'
+    score = db.Column(db.Float)  # 0-100, for 'qc'
+    operator = db.Column(db.String(100))
+    notes = db.Column(db.String(200))
+    production = db.relationship('Production', backref=db.backref('events', lazy='dynamic', cascade='all, delete-orphan'))
+
 class GeneralMinimum(db.Model):
     __tablename__ = 'general_minimums'
     id = db.Column(db.Integer, primary_key=True)
@@ -297,6 +444,9 @@ class ProductCategory(db.Model):
 
 class DeliveryAddress(db.Model):
     __tablename__ = 'delivery_addresses'
+    __table_args__ = (
+        db.Index('ix_delivery_addresses_phone', 'phone'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     customer_name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20), nullable=False)
@@ -341,21 +491,18 @@ class DeliveryAddress(db.Model):
         return max(name_score, address_score, landmark_score)
     
     @classmethod
-    def search(cls, query, min_score=60):
+    def search(cls, query, min_score=60, limit=20):
         """
         Search for delivery addresses that match the query.
-        Returns a list of tuples (address, score) sorted by score.
+        Returns up to `limit` tuples (address, score) sorted by score.
+        Candidates come from the in-memory index in customer_search.
         """
-        addresses = cls.query.all()
-        results = []
-        
-        for addr in addresses:
-            score = addr.match_score(query)
-            if score >= min_score:
-                results.append((addr, score))
-        
-        # Sort by score descending
-        return sorted(results, key=lambda x: x[1], reverse=True)
+        from customer_search import customer_index
+        scored = customer_index.search_ids(query, min_score=min_score, limit=limit)
+        if not scored:
+            return []
+        addresses = {addr.id: addr for addr in cls.query.filter(cls.id.in_([i for i, _ in scored])).all()}
+        return [(addresses[i], score) for i, score in scored if i in addresses]
 
 class DeliveryStatus(db.Model):
     __tablename__ = 'delivery_statuses'
@@ -370,6 +517,9 @@ class DeliveryStatus(db.Model):
 
 class DeliveryStatusHistory(db.Model):
     __tablename__ = 'delivery_status_history'
+    __table_args__ = (
+        db.Index('ix_delivery_status_history_order', 'delivery_order_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     delivery_order_id = db.Column(db.Integer, db.ForeignKey('delivery_orders.id'), nullable=False)
@@ -384,6 +534,10 @@ class DeliveryStatusHistory(db.Model):
 
 class DeliveryOrder(db.Model):
     __tablename__ = 'delivery_orders'
+    __table_args__ = (
+        db.Index('ix_delivery_orders_created_at', 'created_at', 'id'),
+        db.Index('ix_delivery_orders_sale', 'sale_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sale_id = db.Column(db.Integer, db.ForeignKey('sales.id'), nullable=False)
     address_id = db.Column(db.Integer, db.ForeignKey('delivery_addresses.id'), nullable=False)
@@ -412,7 +566,7 @@ class DeliveryOrder(db.Model):
     address = db.relationship('DeliveryAddress', backref='delivery_orders')
     current_status = db.relationship('DeliveryStatus', backref='delivery_orders')
 
-    def update_status(self, status_id, notes=None, created_by='system'):
+    def update_status(self, status_id, notes=None, created_by='system', commit=True):
         """Update the delivery order status and create a history entry"""
         self.current_status_id = status_id
         
@@ -430,7 +584,8 @@ class DeliveryOrder(db.Model):
         if status and status.name == 'Delivered':
             self.actual_delivery_time = datetime.utcnow()
         
-        db.session.commit()
+        if commit:
+            db.session.commit()
     
     def calculate_estimated_time(self):
         """Calculate estimated delivery time based on distance and current orders"""
@@ -587,21 +742,14 @@ class ProductionOrder(db.Model):
         super(ProductionOrder, self).__init__(**kwargs)
         if not self.order_number:
             # Generate order number: PO-YYYYMMDD-XXXX
+            from sequences import sequence_allocator, max_suffix
             today = datetime.now()
             prefix = f"PO-{today.strftime('%Y%m%d')}-"
-            
-            # Get the last order number for today
-            last_order = ProductionOrder.query.filter(
-                ProductionOrder.order_number.like(f"{prefix}%")
-            ).order_by(ProductionOrder.order_number.desc()).first()
-            
-            if last_order:
-                last_number = int(last_order.order_number.split('-')[-1])
-                new_number = str(last_number + 1).zfill(4)
-            else:
-                new_number = '0001'
-            
-            self.order_number = f"{prefix}{new_number}"
+            new_number = sequence_allocator.next(
+                f"production_order:{today.strftime('%Y%m%d')}",
+                seed=lambda: max_suffix(ProductionOrder.order_number, prefix)
+            )
+            self.order_number = f"{prefix}{str(new_number).zfill(4)}"
 
 class ProductionOrderHistory(db.Model):
     __tablename__ = 'production_order_history'
@@ -0,0 +1,74 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a cursor token cannot be decoded"""
+
+
+def encode_cursor(values):
+    """Opaque token for the sort key of the last row of a page"""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, columns):
+    """Decode a token produced by encode_cursor for the given sort columns"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError('Cursor inválido') from e
+    if not isinstance(payload, list) or len(payload) != len(columns):
+        raise InvalidCursorError('Cursor inválido')
+    values = []
+    for column, value in zip(columns, payload):
+        try:
+            python_type = column.type.python_type
+            if python_type is datetime:
+                value = datetime.fromisoformat(value) if value is not None else None
+            elif python_type is int and (not isinstance(value, int) or isinstance(value, bool)):
+                raise TypeError(f'{column.key} must be an integer')
+        except (ValueError, TypeError) as e:
+            raise InvalidCursorError('Cursor inválido') from e
+        values.append(value)
+    return values
+
+
+def _after(columns, values):
+    """Rows strictly after `values` for a descending sort on `columns`"""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        prefix = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*prefix, column < value))
+    return or_(*clauses)
+
+
+def parse_limit(value, default=DEFAULT_LIMIT):
+    try:
+        limit = int(value) if value is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def keyset_page(query, columns, cursor=None, limit=DEFAULT_LIMIT):
+    """Fetch one page of `query` ordered descending by `columns` (last one must be unique).
+
+    Returns (rows, next_cursor); next_cursor is None on the last page. Unlike
+    OFFSET pagination, the cost of a page does not grow with its depth.
+    """
+    if cursor:
+        query = query.filter(_after(columns, decode_cursor(cursor, columns)))
+    rows = query.order_by(*[c.desc() for c in columns]).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+    return rows, next_cursor
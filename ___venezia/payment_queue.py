@@ -0,0 +1,473 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, case, event, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+from extensions import db
+from mercadopago_integration import mp_integration
+from models import DeliveryOrder, PaymentLinkJob, PaymentNotification, Sale
+
+BATCH_SIZE = 10  # jobs claimed per round
+CONCURRENCY = int(os.environ.get('PAYMENT_QUEUE_CONCURRENCY', '4'))  # parallel calls to the MP API
+POLL_SECONDS = 5  # idle wait between rounds when nobody wakes the worker
+BACKOFF_SECONDS = [2, 5, 15, 60, 300]  # wait before retry n; the last value repeats
+MAX_ATTEMPTS = 6
+STALE_RUNNING = timedelta(minutes=5)  # 'running' jobs older than this were left by a dead worker
+SUPPORTED_TOPICS = {'payment'}  # other notification topics are stored but not processed
+COALESCE_SECONDS = 2  # a repeat of an already processed notification is re-checked once after this
+
+
+def backoff(attempts):
+    return timedelta(seconds=BACKOFF_SECONDS[min(attempts, len(BACKOFF_SECONDS)) - 1])
+
+
+class BackgroundQueue:
+    """Table-backed job queue drained by a daemon thread (or an external worker process).
+
+    Producers insert rows in their own transaction and the worker is woken
+    when that transaction commits. Workers claim due rows with a conditional
+    UPDATE, so several threads or processes can share one table.
+    """
+    name = 'queue'
+    model = None
+
+    def __init__(self):
+        self.app = None
+        self.mode = 'thread'
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.finished = threading.Condition()
+        self.processed = 0
+        self.failures = 0
+        self.in_flight = []  # ids claimed by the current round
+
+    def init_app(self, app):
+        """PAYMENT_QUEUE config: 'thread' (in-process worker, default) or 'external' (scripts/payment_worker.py)"""
+        self.app = app
+        self.mode = app.config.get('PAYMENT_QUEUE', 'thread')
+
+    def _wake_on_commit(self, session):
+        session.info.setdefault('payment_queues', set()).add(self)
+
+    def notify(self):
+        self.ensure_worker()
+        self.wakeup.set()
+
+    def ensure_worker(self):
+        if self.app is None or self.mode != 'thread':
+            return
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run_forever, name=self.name, daemon=True)
+                self.thread.start()
+
+    def _claim(self, limit):
+        """Mark up to `limit` due rows as running; returns the claimed ids"""
+        table = self.model.__table__
+        now = datetime.utcnow()
+        due = or_(
+            (table.c.status == 'pending') & (table.c.next_attempt_at <= now),
+            (table.c.status == 'running') & (table.c.updated_at < now - STALE_RUNNING)
+        )
+        candidates = db.session.execute(
+            select(table.c.id).where(due).order_by(table.c.next_attempt_at, table.c.id).limit(limit)
+        ).scalars().all()
+        claimed = []
+        for row_id in candidates:
+            # Conditional UPDATE: only one worker (thread or process) wins each row
+            result = db.session.execute(update(table).where(table.c.id == row_id, due).values(
+                status='running', attempts=table.c.attempts + 1, updated_at=now
+            ))
+            if result.rowcount:
+                claimed.append(row_id)
+        db.session.commit()
+        self.in_flight = claimed
+        return claimed
+
+    def _release(self):
+        """Hand rows claimed by a failed round back to the queue"""
+        if not self.in_flight:
+            return
+        table = self.model.__table__
+        now = datetime.utcnow()
+        db.session.execute(update(table).where(table.c.id.in_(self.in_flight), table.c.status == 'running').values(
+            status='pending', next_attempt_at=now + backoff(1), updated_at=now
+        ))
+        db.session.commit()
+        self.in_flight = []
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def _idle_seconds(self):
+        """Sleep until the next retry is due, at most POLL_SECONDS"""
+        table = self.model.__table__
+        try:
+            next_due = db.session.execute(
+                select(db.func.min(table.c.next_attempt_at)).where(table.c.status == 'pending')
+            ).scalar()
+            db.session.rollback()
+        except Exception:
+            db.session.rollback()
+            return POLL_SECONDS
+        if next_due is None:
+            return POLL_SECONDS
+        return min(POLL_SECONDS, max(0.05, (next_due - datetime.utcnow()).total_seconds()))
+
+    def _finished_batch(self, count):
+        self.processed += count
+        with self.finished:
+            self.finished.notify_all()
+
+    def drain(self, timeout=30.0):
+        """Run rounds until nothing is due (scripts and tests); returns rows handled"""
+        handled = 0
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            count = self.run_once()
+            if not count:
+                break
+            handled += count
+        return handled
+
+    def run_forever(self):
+        with self.app.app_context():
+            print(f"{self.name} worker started")
+            while True:
+                try:
+                    handled = self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error in {self.name} worker: {str(e)}")
+                    handled = 0
+                    time.sleep(POLL_SECONDS)
+                    try:
+                        self._release()
+                    except Exception:
+                        db.session.rollback()
+                finally:
+                    db.session.remove()
+                if not handled:
+                    self.wakeup.wait(self._idle_seconds())
+                    self.wakeup.clear()
+
+    def stats(self):
+        table = self.model.__table__
+        counts = dict(db.session.execute(
+            select(table.c.status, db.func.count(table.c.id)).group_by(table.c.status)
+        ).all())
+        return {
+            'jobs': counts,
+            'processed': self.processed,
+            'failures': self.failures,
+            'worker_alive': bool(self.thread and self.thread.is_alive()),
+            'mode': self.mode
+        }
+
+
+class PaymentLinkQueue(BackgroundQueue):
+    """Creates MercadoPago preferences for sales off the request path.
+
+    process_sale only inserts a payment_link_jobs row in its own transaction,
+    so the sale commits without waiting on the MP API. A daemon thread (or
+    scripts/payment_worker.py) claims due jobs in batches with a conditional
+    UPDATE, calls the API for the whole batch in parallel with no database
+    transaction open, and writes links and job states back in one short
+    transaction. Failed calls are retried with backoff until MAX_ATTEMPTS.
+    The POS polls /api/payment_status/<sale_id> until the link shows up;
+    wait_for() lets a request block briefly for it instead.
+    """
+
+    name = 'payment-links'
+    model = PaymentLinkJob
+
+    # -- producer side -----------------------------------------------------
+
+    def enqueue(self, session, sale_id, delivery_order_id=None):
+        """Queue a preference for a sale; becomes visible to the worker when the session commits"""
+        session.execute(insert(PaymentLinkJob.__table__).values(
+            sale_id=sale_id,
+            delivery_order_id=delivery_order_id,
+            status='pending',
+            attempts=0,
+            next_attempt_at=datetime.utcnow(),
+            created_at=datetime.utcnow(),
+            updated_at=datetime.utcnow()
+        ))
+        self._wake_on_commit(session)
+
+    def status(self, sale_id):
+        """Job state and payment link for a sale, or None if no job was queued"""
+        jobs = PaymentLinkJob.__table__
+        job = db.session.execute(select(
+            jobs.c.status, jobs.c.attempts, jobs.c.last_error, jobs.c.delivery_order_id
+        ).where(jobs.c.sale_id == sale_id)).first()
+        if job is None:
+            return None
+        target = DeliveryOrder.__table__ if job.delivery_order_id else Sale.__table__
+        target_id = job.delivery_order_id or sale_id
+        link = db.session.execute(select(
+            target.c.mp_payment_link, target.c.mp_qr_link
+        ).where(target.c.id == target_id)).first()
+        return {
+            'status': job.status,
+            'attempts': job.attempts,
+            'last_error': job.last_error,
+            'payment_link': link.mp_payment_link if link else None,
+            'qr_link': link.mp_qr_link if link else None
+        }
+
+    def wait_for(self, sale_id, timeout=5.0):
+        """Block up to `timeout` seconds until the sale's job is done or failed; returns status().
+
+        Call it with no pending changes: each poll ends the session's transaction.
+        """
+        self.ensure_worker()
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.status(sale_id)
+            # End the read: the next poll sees the worker's commit, and no lock is held while waiting
+            db.session.rollback()
+            remaining = deadline - time.monotonic()
+            if state is None or state['status'] in ('done', 'failed') or remaining <= 0:
+                return state
+            with self.finished:
+                # Short slices so a job finished by another process is noticed too
+                self.finished.wait(min(remaining, 0.5))
+
+    # -- worker side -------------------------------------------------------
+
+    def _claim_jobs(self, limit):
+        claimed = self._claim(limit)
+        if not claimed:
+            return []
+        return db.session.query(PaymentLinkJob).filter(PaymentLinkJob.id.in_(claimed)).all()
+
+    def _payloads(self, jobs):
+        """(job, preference data or error) for each job, built before any API call"""
+        sales = {sale.id: sale for sale in Sale.query.filter(Sale.id.in_([job.sale_id for job in jobs])).all()}
+        delivery_ids = [job.delivery_order_id for job in jobs if job.delivery_order_id]
+        deliveries = {}
+        if delivery_ids:
+            deliveries = {order.id: order for order in DeliveryOrder.query.options(
+                joinedload(DeliveryOrder.address), joinedload(DeliveryOrder.sale)
+            ).filter(DeliveryOrder.id.in_(delivery_ids)).all()}
+
+        payloads = []
+        for job in jobs:
+            target = deliveries.get(job.delivery_order_id) if job.delivery_order_id else sales.get(job.sale_id)
+            if target is None:
+                payloads.append((job, None, 'Sale or delivery order not found'))
+                continue
+            try:
+                payloads.append((job, mp_integration.build_preference_data(target), None))
+            except Exception as e:
+                payloads.append((job, None, str(e)))
+        return payloads
+
+    def run_once(self):
+        """Process one batch of due jobs; returns how many were handled"""
+        jobs = self._claim_jobs(BATCH_SIZE)
+        if not jobs:
+            return 0
+
+        payloads = self._payloads(jobs)
+        snapshot = [(job.id, job.sale_id, job.delivery_order_id, job.attempts) for job in jobs]
+        db.session.rollback()  # nothing to write yet: don't keep a transaction open during the API calls
+
+        def call(payload):
+            job, data, error = payload
+            if error:
+                return False, error
+            return mp_integration.request_preference(data)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(CONCURRENCY, len(payloads)))) as pool:
+            results = list(pool.map(call, payloads))
+
+        now = datetime.utcnow()
+        sale_links, delivery_links, job_updates = [], [], []
+        for (job_id, sale_id, delivery_order_id, attempts), (success, response) in zip(snapshot, results):
+            if success:
+                link = {
+                    'target_id': delivery_order_id or sale_id,
+                    'mp_preference_id': response.get('id'),
+                    'mp_payment_link': response.get('payment_link'),
+                    'mp_qr_link': response.get('qr_code'),
+                    'mp_created_at': datetime.now()
+                }
+                (delivery_links if delivery_order_id else sale_links).append(link)
+                job_updates.append({'job_id': job_id, 'status': 'done', 'next_attempt_at': now, 'last_error': None})
+                continue
+            self.failures += 1
+            print(f"Warning: MercadoPago preference for sale {sale_id} failed (attempt {attempts}): {response}")
+            job_updates.append({
+                'job_id': job_id,
+                'status': 'failed' if attempts >= MAX_ATTEMPTS or not mp_integration.is_configured else 'pending',
+                'next_attempt_at': now + backoff(attempts),
+                'last_error': str(response)[:500]
+            })
+
+        for table, links in ((Sale.__table__, sale_links), (DeliveryOrder.__table__, delivery_links)):
+            if links:
+                db.session.execute(update(table).where(table.c.id == bindparam('target_id')).values(
+                    mp_preference_id=bindparam('mp_preference_id'),
+                    mp_payment_link=bindparam('mp_payment_link'),
+                    mp_qr_link=bindparam('mp_qr_link'),
+                    mp_created_at=bindparam('mp_created_at'),
+                    mp_status='pending'
+                ), links)
+        jobs_table = PaymentLinkJob.__table__
+        db.session.execute(update(jobs_table).where(jobs_table.c.id == bindparam('job_id')).values(
+            status=bindparam('status'),
+            next_attempt_at=bindparam('next_attempt_at'),
+            last_error=bindparam('last_error'),
+            updated_at=now
+        ), job_updates)
+        db.session.commit()
+
+        self._finished_batch(len(jobs))
+        return len(jobs)
+
+
+def parse_notification(args, body):
+    """(topic, resource id) of a webhook (JSON body) or IPN (query string) notification"""
+    body = body if isinstance(body, dict) else {}
+    topic = body.get('type') or body.get('topic') or args.get('type') or args.get('topic')
+    data = body.get('data') if isinstance(body.get('data'), dict) else {}
+    resource_id = data.get('id') or args.get('data.id') or args.get('id')
+    if not resource_id and body.get('resource'):
+        # IPN bodies carry the resource as an id or a URL ending in it
+        resource_id = str(body['resource']).rstrip('/').rsplit('/', 1)[-1]
+    if not topic or not resource_id:
+        return None, None
+    return str(topic), str(resource_id)
+
+
+class NotificationQueue(BackgroundQueue):
+    """Records MercadoPago webhook notifications and applies them off the request.
+
+    The webhook only upserts a payment_notifications row keyed by (topic,
+    resource id) and answers; MercadoPago's duplicates just bump
+    received_count on the existing row. The worker fetches the payments of a
+    batch in parallel and applies them in one transaction. A notification
+    that arrives while its row is being processed sends the row back to
+    pending, and a repeat of an already processed one re-checks the payment
+    once after COALESCE_SECONDS (payment.updated reuses the same id).
+    """
+    name = 'payment-notifications'
+    model = PaymentNotification
+
+    def record(self, session, topic, resource_id, raw):
+        """Store a notification durably; returns False when it was folded into an existing row"""
+        table = PaymentNotification.__table__
+        now = datetime.utcnow()
+        rearm = table.c.status.in_(('done', 'failed'))
+        result = session.execute(update(table).where(
+            table.c.topic == topic, table.c.resource_id == resource_id
+        ).values(
+            received_count=table.c.received_count + 1,
+            last_received_at=now,
+            raw=raw,
+            status=case((rearm, 'pending'), else_=table.c.status),
+            attempts=case((rearm, 0), else_=table.c.attempts),
+            next_attempt_at=case((rearm, now + timedelta(seconds=COALESCE_SECONDS)), else_=table.c.next_attempt_at)
+        ))
+        if result.rowcount:
+            self._wake_on_commit(session)
+            return False
+
+        supported = topic in SUPPORTED_TOPICS
+        try:
+            with session.begin_nested():
+                session.execute(insert(table).values(
+                    topic=topic,
+                    resource_id=resource_id,
+                    raw=raw,
+                    received_count=1,
+                    status='pending' if supported else 'ignored',
+                    attempts=0,
+                    next_attempt_at=now,
+                    received_at=now,
+                    last_received_at=now,
+                    updated_at=now,
+                    processed_at=None if supported else now
+                ))
+        except IntegrityError:
+            # Same notification inserted concurrently by another request
+            return self.record(session, topic, resource_id, raw)
+        if supported:
+            self._wake_on_commit(session)
+        return True
+
+    def run_once(self):
+        """Fetch and apply one batch of due notifications; returns how many were handled"""
+        claimed = self._claim(BATCH_SIZE)
+        if not claimed:
+            return 0
+        table = PaymentNotification.__table__
+        rows = db.session.execute(select(
+            table.c.id, table.c.resource_id, table.c.received_count, table.c.attempts
+        ).where(table.c.id.in_(claimed))).all()
+        db.session.rollback()  # no transaction open during the API calls
+
+        with ThreadPoolExecutor(max_workers=max(1, min(CONCURRENCY, len(rows)))) as pool:
+            results = list(pool.map(lambda row: mp_integration.fetch_payment(row.resource_id), rows))
+
+        finish = update(table).where(table.c.id == bindparam('row_id'), table.c.received_count == bindparam('seen'))
+        for row, (success, payment) in zip(rows, results):
+            now = datetime.utcnow()
+            values = {'row_id': row.id, 'seen': row.received_count, 'status': 'done', 'next_attempt_at': now,
+                      'last_error': None, 'processed_at': now}
+            if success:
+                # One short transaction per payment: a bad one doesn't hold back the rest of the batch
+                try:
+                    applied, message = mp_integration.apply_payment(payment)
+                    if not applied:
+                        values['last_error'] = str(message)[:500]
+                    db.session.flush()
+                except Exception as e:
+                    db.session.rollback()
+                    success, payment = False, str(e)
+            if not success:
+                self.failures += 1
+                print(f"Warning: MercadoPago payment {row.resource_id} failed (attempt {row.attempts}): {payment}")
+                values.update({
+                    'status': 'failed' if row.attempts >= MAX_ATTEMPTS else 'pending',
+                    'next_attempt_at': now + backoff(row.attempts),
+                    'last_error': str(payment)[:500],
+                    'processed_at': None
+                })
+            db.session.execute(finish.values(
+                status=bindparam('status'),
+                next_attempt_at=bindparam('next_attempt_at'),
+                last_error=bindparam('last_error'),
+                processed_at=bindparam('processed_at'),
+                updated_at=now
+            ), values)
+            # Notified again while we were fetching: look at the payment once more
+            db.session.execute(update(table).where(table.c.id == row.id, table.c.status == 'running').values(
+                status='pending', attempts=0, next_attempt_at=now + timedelta(seconds=COALESCE_SECONDS), updated_at=now
+            ))
+            db.session.commit()
+
+        self._finished_batch(len(rows))
+        return len(rows)
+
+
+payment_queue = PaymentLinkQueue()
+notification_queue = NotificationQueue()
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_payment_workers(session):
+    for queue in session.info.pop('payment_queues', ()):
+        queue.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_payment_jobs(session):
+    session.info.pop('payment_queues', None)
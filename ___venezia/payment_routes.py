@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify, redirect, url_for
 from models import DeliveryOrder, db
 from mercadopago_integration import mp_integration
 from whatsapp_integration import whatsapp
+from payment_queue import notification_queue, parse_notification
 
 payment = Blueprint('payment', __name__)
 
@@ -10,12 +11,17 @@ def create_payment(delivery_id):
     """Create a new payment preference and send payment link via WhatsApp"""
     try:
         delivery_order = DeliveryOrder.query.get_or_404(delivery_id)
-        
+        preference_data = mp_integration.build_preference_data(delivery_order)
+        # No transaction open during the API call: it would hold the SQLite write lock
+        db.session.rollback()
+
         # Create MercadoPago preference
-        success, result = mp_integration.create_preference(delivery_order)
+        success, result = mp_integration.request_preference(preference_data)
         
         if not success:
             return jsonify({'error': result}), 400
+        mp_integration.apply_preference(delivery_order, result)
+        db.session.commit()
         
         # Send payment link via WhatsApp
         whatsapp_success, whatsapp_result = whatsapp.send_payment_link(delivery_order)
@@ -50,47 +56,26 @@ def send_payment(delivery_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@payment.route('/webhook', methods=['POST'])
-def webhook():
-    """Handle MercadoPago webhook notifications"""
+def receive_notification():
+    """Store a MercadoPago notification and acknowledge it; payment_queue applies it"""
     try:
-        data = request.get_json()
-        
-        # Process the webhook data
-        success, message = mp_integration.process_webhook(data)
-        
-        if not success:
-            return jsonify({'error': message}), 400
-        
-        # If payment was processed successfully, update sale status
-        if data["type"] == "payment":
-            payment_info = mp_integration.mp.payment().get(data["data"]["id"])
-            
-            if payment_info["status"] == 200:
-                payment = payment_info["response"]
-                
-                # Get the delivery order from the external reference
-                delivery_order = DeliveryOrder.query.get(int(payment["external_reference"]))
-                
-                if delivery_order:
-                    # Update delivery order payment information
-                    delivery_order.mp_payment_id = str(payment["id"])
-                    delivery_order.mp_status = payment["status"]
-                    
-                    # Update sale payment status
-                    delivery_order.sale.payment_status = payment["status"]
-                    
-                    # If payment is approved, update delivery status
-                    if payment["status"] == "approved":
-                        delivery_order.update_status(2)  # Change to "En Preparación"
-                    
-                    db.session.commit()
-        
-        return jsonify({'message': message}), 200
-        
+        topic, resource_id = parse_notification(request.args, request.get_json(silent=True))
+        if not topic:
+            return jsonify({'error': 'Invalid notification'}), 400
+
+        created = notification_queue.record(db.session, topic, resource_id, request.get_data(as_text=True))
+        db.session.commit()
+        return jsonify({'message': 'Notification received' if created else 'Duplicate notification'}), 200
+
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@payment.route('/webhook', methods=['POST'])
+def webhook():
+    """Handle MercadoPago webhook notifications"""
+    return receive_notification()
+
 @payment.route('/status/<string:payment_id>')
 def payment_status(payment_id):
     """Get the current status of a payment"""
@@ -0,0 +1,206 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import case, func, select
+from extensions import db
+from models import Production, ProductionEvent
+
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+EPOCH = datetime(1970, 1, 1)
+
+BatchMetrics = namedtuple('BatchMetrics', [
+    'id', 'batch_number', 'flavor', 'quantity', 'day', 'started', 'finished', 'success_status', 'cost',
+    'cycle_hours', 'paused_hours', 'active_hours', 'kg_per_hour', 'waste', 'quality'
+])
+
+
+class TimelineError(ValueError):
+    """Raised when an event doesn't fit the batch timeline (e.g. resume without pause)"""
+
+
+# -- timeline --------------------------------------------------------------
+
+def record_event(production, event_type, occurred_at=None, quantity=None, score=None, operator=None, notes=None):
+    """Add an event to a batch timeline; the caller commits"""
+    if event_type not in ProductionEvent.TYPES:
+        raise TimelineError(f'Tipo de evento inválido: {event_type}')
+    if event_type == 'waste' and not (quantity and quantity > 0):
+        raise TimelineError('La merma debe ser mayor a 0 kg')
+    if event_type == 'qc' and (score is None or not 0 <= score <= 100):
+        raise TimelineError('El puntaje de calidad debe estar entre 0 y 100')
+
+    if event_type in ('pause', 'resume'):
+        if production.end_time:
+            raise TimelineError('Esta producción ya está finalizada')
+        counts = dict(db.session.query(ProductionEvent.event_type, func.count(ProductionEvent.id)).filter(
+            ProductionEvent.production_id == production.id,
+            ProductionEvent.event_type.in_(('pause', 'resume'))
+        ).group_by(ProductionEvent.event_type).all())
+        paused = counts.get('pause', 0) > counts.get('resume', 0)
+        if event_type == 'pause' and paused:
+            raise TimelineError('La producción ya está pausada')
+        if event_type == 'resume' and not paused:
+            raise TimelineError('La producción no está pausada')
+
+    event = ProductionEvent(
+        production_id=production.id,
+        event_type=event_type,
+        occurred_at=occurred_at or datetime.utcnow(),
+        quantity=quantity,
+        score=score,
+        operator=operator,
+        notes=notes
+    )
+    db.session.add(event)
+    return event
+
+
+def event_to_dict(event):
+    return {
+        'id': event.id,
+        'type': event.event_type,
+        'occurred_at': event.occurred_at.isoformat(),
+        'quantity': event.quantity,
+        'score': event.score,
+        'operator': event.operator,
+        'notes': event.notes
+    }
+
+
+# -- metrics ---------------------------------------------------------------
+
+def _seconds(column):
+    """Unix seconds of a DateTime column, as a float (SQLite julianday)"""
+    return (func.julianday(column) - UNIX_EPOCH_JULIAN_DAY) * 86400.0
+
+
+def _timeline_query(from_date=None, finished_only=False):
+    """One row per batch with its timeline folded into aggregates.
+
+    Batches without events fall back to production_date / end_time, so
+    productions recorded before the timeline existed still count. Paused
+    time is sum(resume times) - sum(pause times), which is exact for
+    alternating pause/resume pairs; a pause left open is closed at finish.
+    """
+    event = ProductionEvent
+
+    def when(event_type, value):
+        return case((event.event_type == event_type, value))
+
+    at = _seconds(event.occurred_at)
+    query = select(
+        Production.id, Production.batch_number, Production.flavor, Production.quantity,
+        Production.success_status, Production.production_cost,
+        func.coalesce(func.min(when('start', at)), _seconds(Production.production_date)).label('started'),
+        func.coalesce(func.max(when('finish', at)), _seconds(Production.end_time)).label('finished'),
+        func.coalesce(func.sum(when('pause', at)), 0).label('pause_sum'),
+        func.count(when('pause', 1)).label('pauses'),
+        func.coalesce(func.sum(when('resume', at)), 0).label('resume_sum'),
+        func.count(when('resume', 1)).label('resumes'),
+        func.coalesce(func.sum(when('waste', event.quantity)), 0).label('waste'),
+        func.avg(when('qc', event.score)).label('quality')
+    ).select_from(Production).outerjoin(event, event.production_id == Production.id)\
+     .group_by(Production.id)
+    if from_date is not None:
+        query = query.where(Production.production_date >= from_date)
+    if finished_only:
+        query = query.where(Production.end_time.isnot(None))
+    return query
+
+
+def _batch(row):
+    started = EPOCH + timedelta(seconds=row.started) if row.started is not None else None
+    finished = EPOCH + timedelta(seconds=row.finished) if row.finished is not None else None
+    cycle = paused = active = rate = None
+    if started and finished:
+        cycle = max(row.finished - row.started, 0)
+        paused = row.resume_sum - row.pause_sum
+        if row.pauses > row.resumes:
+            paused += row.finished * (row.pauses - row.resumes)
+        paused = min(max(paused, 0), cycle)
+        active = cycle - paused
+        rate = row.quantity / (active / 3600) if active > 0 else None
+    return BatchMetrics(
+        id=row.id,
+        batch_number=row.batch_number,
+        flavor=row.flavor,
+        quantity=float(row.quantity or 0),
+        day=started.date() if started else None,
+        started=started,
+        finished=finished,
+        success_status=row.success_status,
+        cost=float(row.production_cost or 0),
+        cycle_hours=cycle / 3600 if cycle is not None else None,
+        paused_hours=paused / 3600 if paused is not None else None,
+        active_hours=active / 3600 if active is not None else None,
+        kg_per_hour=rate,
+        waste=float(row.waste or 0),
+        quality=float(row.quality) if row.quality is not None else None
+    )
+
+
+def batch_metrics(days=None, finished_only=False):
+    """BatchMetrics of every batch started in the last `days` days (all if None), newest first"""
+    from_date = datetime.utcnow() - timedelta(days=days) if days else None
+    batches = [_batch(row) for row in db.session.execute(_timeline_query(from_date, finished_only))]
+    batches.sort(key=lambda b: b.finished or b.started or EPOCH, reverse=True)
+    return batches
+
+
+def summarize(batches, group_by=('flavor', 'day')):
+    """Throughput, cycle time, waste and quality per group, in a single pass over the batches.
+
+    kg_per_hour is total kg of finished batches over their total active
+    hours, so long batches weigh more than short ones.
+    """
+    groups = {}
+    for batch in batches:
+        key = tuple(getattr(batch, field) for field in group_by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'batches': 0, 'kg': 0.0, 'finished': 0, 'finished_kg': 0.0, 'active_hours': 0.0,
+                'cycle_hours': 0.0, 'waste': 0.0, 'quality_sum': 0.0, 'quality_count': 0,
+                'cost': 0.0, 'failed': 0
+            }
+        group['batches'] += 1
+        group['kg'] += batch.quantity
+        group['waste'] += batch.waste
+        group['cost'] += batch.cost
+        if batch.success_status == 'failed':
+            group['failed'] += 1
+        if batch.quality is not None:
+            group['quality_sum'] += batch.quality
+            group['quality_count'] += 1
+        if batch.active_hours is not None:
+            group['finished'] += 1
+            group['finished_kg'] += batch.quantity
+            group['active_hours'] += batch.active_hours
+            group['cycle_hours'] += batch.cycle_hours
+
+    results = []
+    for key, group in groups.items():
+        result = dict(zip(group_by, key))
+        if 'day' in result and result['day'] is not None:
+            result['day'] = result['day'].isoformat()
+        produced = group['kg'] + group['waste']
+        result.update({
+            'batches': group['batches'],
+            'kg': round(group['kg'], 3),
+            'kg_per_hour': round(group['finished_kg'] / group['active_hours'], 3) if group['active_hours'] > 0 else None,
+            'avg_cycle_hours': round(group['cycle_hours'] / group['finished'], 3) if group['finished'] else None,
+            'active_hours': round(group['active_hours'], 3),
+            'waste_kg': round(group['waste'], 3),
+            'waste_pct': round(group['waste'] / produced * 100, 2) if produced > 0 else 0,
+            'avg_quality': round(group['quality_sum'] / group['quality_count'], 1) if group['quality_count'] else None,
+            'cost': round(group['cost'], 2),
+            'cost_per_kg': round(group['cost'] / group['kg'], 2) if group['kg'] > 0 else None,
+            'success_rate': round(1 - group['failed'] / group['batches'], 4)
+        })
+        results.append(result)
+    results.sort(key=lambda r: tuple('' if r[field] is None else r[field] for field in group_by))
+    return results
+
+
+def production_metrics(days=30, group_by=('flavor', 'day')):
+    """summarize() over the batches started in the last `days` days"""
+    return summarize(batch_metrics(days), group_by)
@@ -0,0 +1,213 @@
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event, func, inspect as sa_inspect, or_
+from sqlalchemy.orm import Session
+from extensions import db
+from models import Ingredient, Product, ProductionOrder, Recipe, RecipeIngredient
+
+MAX_AGE_SECONDS = 300  # reload after this long to pick up edits made by other workers
+
+# Production order statuses that no longer need ingredients (see update_production_order_status)
+COMPLETED_STATUS_ID = 3
+CANCELLED_STATUS_ID = 4
+
+# lines: ((ingredient_id, quantity per kg), ...); ingredients: {ingredient_id: (name, cost_per_unit)}
+RecipeCost = namedtuple('RecipeCost', ['recipe_id', 'product_id', 'name', 'cost_per_kg', 'lines', 'ingredients'])
+
+
+class RecipeCostCache:
+    """Cost per kg of every recipe, rolled up from Ingredient.cost_per_unit.
+
+    Recipe quantities are per kg of product (as add_production uses them).
+    All recipes load with one query; the whole roll-up is dropped when a
+    commit changes an ingredient price or any recipe or recipe line.
+    """
+
+    def __init__(self, max_age=MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.recipes = None  # recipe_id -> RecipeCost
+        self.by_product = None  # product_id -> RecipeCost ('flavor' recipes first, then oldest)
+        self.loaded_at = 0
+        self.loads = 0
+
+    def _load(self):
+        rows = db.session.query(
+            Recipe.id, Recipe.product_id, Recipe.name, Recipe.type,
+            RecipeIngredient.ingredient_id, RecipeIngredient.quantity, Ingredient.name.label('ingredient'),
+            Ingredient.cost_per_unit
+        ).outerjoin(RecipeIngredient, RecipeIngredient.recipe_id == Recipe.id)\
+         .outerjoin(Ingredient, Ingredient.id == RecipeIngredient.ingredient_id)\
+         .order_by(Recipe.id).all()
+
+        recipes = {}
+        types = {}
+        for row in rows:
+            entry = recipes.setdefault(row.id, {'product_id': row.product_id, 'name': row.name, 'cost': 0.0,
+                                                'lines': {}, 'ingredients': {}})
+            types[row.id] = row.type
+            if row.ingredient_id is not None:
+                quantity = float(row.quantity or 0)
+                entry['lines'][row.ingredient_id] = entry['lines'].get(row.ingredient_id, 0) + quantity
+                entry['cost'] += quantity * float(row.cost_per_unit or 0)
+                entry['ingredients'][row.ingredient_id] = (row.ingredient, float(row.cost_per_unit or 0))
+        recipes = {
+            recipe_id: RecipeCost(recipe_id, e['product_id'], e['name'], round(e['cost'], 4),
+                                  tuple(e['lines'].items()), e['ingredients'])
+            for recipe_id, e in recipes.items()
+        }
+        by_product = {}
+        for recipe_id in sorted(recipes, key=lambda rid: (types[rid] != 'flavor', rid)):
+            by_product.setdefault(recipes[recipe_id].product_id, recipes[recipe_id])
+        return recipes, by_product
+
+    def _current(self):
+        with self.lock:
+            if self.recipes is not None and time.monotonic() - self.loaded_at <= self.max_age:
+                return self.recipes, self.by_product
+        recipes, by_product = self._load()
+        with self.lock:
+            self.loads += 1
+            # Never cache what this session changed but has not committed yet
+            if not db.session.info.get('recipe_costing'):
+                self.recipes, self.by_product = recipes, by_product
+                self.loaded_at = time.monotonic()
+        return recipes, by_product
+
+    def recipe(self, recipe_id):
+        return self._current()[0].get(recipe_id)
+
+    def for_product(self, product_id):
+        """RecipeCost used to produce a product, or None if it has no recipe"""
+        return self._current()[1].get(int(product_id))
+
+    def cost_per_kg(self, product_id):
+        recipe = self.for_product(product_id)
+        return recipe.cost_per_kg if recipe else None
+
+    def production_cost(self, product_id, quantity):
+        """Ingredient cost of producing `quantity` kg (0 without a recipe)"""
+        recipe = self.for_product(product_id)
+        return round(recipe.cost_per_kg * float(quantity or 0), 2) if recipe else 0
+
+    def all(self):
+        return list(self._current()[0].values())
+
+    def clear(self):
+        with self.lock:
+            self.recipes = self.by_product = None
+
+
+recipe_costs = RecipeCostCache()
+
+
+def plan_ingredient_requirements():
+    """Ingredients needed by all open production orders versus current stock.
+
+    Open orders are summed per product in SQL (quantity minus progress),
+    then expanded through the cached recipe lines in one pass.
+    """
+    remaining = func.sum(func.max(ProductionOrder.quantity - func.coalesce(ProductionOrder.progress, 0), 0))
+    demand = db.session.query(
+        ProductionOrder.product_id, remaining.label('remaining'), func.count(ProductionOrder.id).label('orders')
+    ).filter(or_(
+        ProductionOrder.status_id.is_(None),
+        ProductionOrder.status_id.notin_((COMPLETED_STATUS_ID, CANCELLED_STATUS_ID))
+    )).group_by(ProductionOrder.product_id).all()
+
+    required = {}  # ingredient_id -> quantity
+    by_product = {}  # ingredient_id -> {product_id: quantity}
+    missing_recipes = []
+    estimated_cost = 0.0
+    order_count = 0
+    for row in demand:
+        order_count += row.orders
+        quantity = float(row.remaining or 0)
+        if quantity <= 0:
+            continue
+        recipe = recipe_costs.for_product(row.product_id)
+        if recipe is None:
+            missing_recipes.append({'product_id': row.product_id, 'quantity': quantity, 'orders': row.orders})
+            continue
+        estimated_cost += recipe.cost_per_kg * quantity
+        for ingredient_id, per_kg in recipe.lines:
+            need = per_kg * quantity
+            required[ingredient_id] = required.get(ingredient_id, 0) + need
+            by_product.setdefault(ingredient_id, {})[row.product_id] = need
+
+    product_ids = {row.product_id for row in demand}
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(product_ids)).all()) if product_ids else {}
+    for entry in missing_recipes:
+        entry['product'] = names.get(entry['product_id'])
+
+    ingredients = db.session.query(
+        Ingredient.id, Ingredient.name, Ingredient.unit, Ingredient.current_stock,
+        Ingredient.minimum_stock, Ingredient.cost_per_unit
+    ).filter(Ingredient.id.in_(required)).all() if required else []
+
+    lines = []
+    purchase_cost = 0.0
+    for ing in ingredients:
+        need = required[ing.id]
+        stock = float(ing.current_stock or 0)
+        shortfall = max(need - stock, 0)
+        purchase_cost += shortfall * float(ing.cost_per_unit or 0)
+        lines.append({
+            'ingredient_id': ing.id,
+            'name': ing.name,
+            'unit': ing.unit,
+            'required': round(need, 3),
+            'current_stock': stock,
+            'minimum_stock': float(ing.minimum_stock or 0),
+            'shortfall': round(shortfall, 3),
+            'shortfall_with_minimum': round(max(need + float(ing.minimum_stock or 0) - stock, 0), 3),
+            'purchase_cost': round(shortfall * float(ing.cost_per_unit or 0), 2),
+            'by_product': {names.get(pid, str(pid)): round(q, 3) for pid, q in by_product[ing.id].items()}
+        })
+    lines.sort(key=lambda line: (-line['shortfall'], line['name']))
+
+    return {
+        'open_orders': order_count,
+        'ingredients': lines,
+        'missing_recipes': missing_recipes,
+        'estimated_cost': round(estimated_cost, 2),
+        'purchase_cost': round(purchase_cost, 2)
+    }
+
+
+# -- invalidation ----------------------------------------------------------
+
+def _price_changed(ingredient):
+    return sa_inspect(ingredient).attrs.cost_per_unit.history.has_changes()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_recipe_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Recipe, RecipeIngredient)) or (
+                isinstance(obj, Ingredient) and obj in session.dirty and _price_changed(obj)):
+            session.info['recipe_costing'] = True
+            return
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _watch_bulk_recipe_writes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    if orm_execute_state.execution_options.get('ingredient_stock_only'):
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if getattr(table, 'name', None) in (Recipe.__tablename__, RecipeIngredient.__tablename__, Ingredient.__tablename__):
+        orm_execute_state.session.info['recipe_costing'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_recipe_changes(session):
+    if session.info.pop('recipe_costing', None):
+        recipe_costs.clear()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_recipe_changes(session):
+    session.info.pop('recipe_costing', None)
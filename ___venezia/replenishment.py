@@ -0,0 +1,244 @@
+import math
+from datetime import datetime
+import numpy as np
+from sqlalchemy import func, or_, select
+from extensions import db
+from models import GeneralMinimum, Product, ProductCategory, Production, ProductionOrder, Store
+from batch_distribution import FLAVOR_CATEGORY_NAME, MAIN_STORE_NAME
+from recipe_costing import COMPLETED_STATUS_ID, CANCELLED_STATUS_ID
+from stock_snapshot import stock_snapshot
+from stock_forecast import DepletionForecast, load_history, utc_today
+
+COVER_DAYS = 2  # stock each store should hold beyond its minimum, in days of forecast demand
+MIN_TRANSFER = 0.1  # kg (or units); smaller transfers aren't worth a trip
+
+
+class StockMatrix:
+    """Stock, minimums and forecast demand as dense stores x products arrays"""
+
+    def __init__(self, store_ids, product_ids):
+        self.store_ids = np.asarray(store_ids, dtype=np.int64)  # sorted
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)  # sorted
+        shape = (len(self.store_ids), len(self.product_ids))
+        self.stock = np.zeros(shape)
+        self.minimum = np.zeros(shape)  # per store minimum_quantity
+        self.demand = np.zeros(shape)  # forecast sales over the cover days
+        self.carried = np.zeros(shape, dtype=bool)  # the store has a stock row or sells the product
+        self.general_minimum = np.zeros(shape[1])
+
+    def index(self, store_ids, product_ids):
+        return np.searchsorted(self.store_ids, store_ids), np.searchsorted(self.product_ids, product_ids)
+
+
+def _store_levels(store_ids):
+    """(store, product, quantity, minimum) columns from the cached stock snapshot"""
+    columns = ([], [], [], [])
+    for store_id in store_ids:
+        levels = stock_snapshot.store(int(store_id))
+        count = len(levels)
+        columns[0].append(np.full(count, store_id, dtype=np.int64))
+        columns[1].append(np.fromiter(levels.keys(), dtype=np.int64, count=count))
+        columns[2].append(np.fromiter((level.quantity for level in levels.values()), dtype=float, count=count))
+        columns[3].append(np.fromiter((level.minimum for level in levels.values()), dtype=float, count=count))
+    if not store_ids.size:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    return tuple(np.concatenate(column) for column in columns)
+
+
+def load_matrix(cover_days=COVER_DAYS, today=None):
+    """Stock levels (from the stock snapshot), general minimums and the forecast as a StockMatrix"""
+    today = today or utc_today()
+    store_ids = np.array(db.session.execute(select(Store.id).order_by(Store.id)).scalars().all(), dtype=np.int64)
+    minimums = db.session.execute(select(GeneralMinimum.product_id, GeneralMinimum.quantity)).all()
+    forecast = DepletionForecast(load_history(today=today))
+    if len(forecast.pairs):
+        known = np.isin(forecast.pairs[:, 0], store_ids)
+        pairs = forecast.pairs[known]
+        demand = forecast.demand(today, cover_days).sum(1)[known]
+    else:
+        pairs, demand = np.empty((0, 2), dtype=np.int64), np.empty(0)
+
+    stock_stores, stock_products, quantities, store_minimums = _store_levels(store_ids)
+    product_ids = np.unique(np.concatenate([
+        stock_products,
+        np.array([m.product_id for m in minimums], dtype=np.int64),
+        pairs[:, 1]
+    ]))
+    matrix = StockMatrix(store_ids, product_ids)
+    if not len(store_ids) or not len(product_ids):
+        return matrix
+
+    si, pi = matrix.index(stock_stores, stock_products)
+    matrix.stock[si, pi] = quantities
+    matrix.minimum[si, pi] = store_minimums
+    matrix.carried[si, pi] = True
+    if minimums:
+        _, gi = matrix.index([], [m.product_id for m in minimums])
+        matrix.general_minimum[gi] = [m.quantity or 0 for m in minimums]
+    if len(pairs):
+        si, pi = matrix.index(pairs[:, 0], pairs[:, 1])
+        matrix.demand[si, pi] = demand
+        matrix.carried[si, pi] |= demand > 0
+    return matrix
+
+
+def _open_order_kg(product_ids):
+    """kg still to be made by open production orders, per product"""
+    if not product_ids:
+        return {}
+    remaining = func.sum(func.max(ProductionOrder.quantity - func.coalesce(ProductionOrder.progress, 0), 0))
+    return dict(db.session.execute(
+        select(ProductionOrder.product_id, remaining).where(
+            ProductionOrder.product_id.in_(product_ids),
+            or_(ProductionOrder.status_id.is_(None),
+                ProductionOrder.status_id.notin_((COMPLETED_STATUS_ID, CANCELLED_STATUS_ID)))
+        ).group_by(ProductionOrder.product_id)
+    ).all())
+
+
+def _batches(product_ids):
+    """Finished, unassigned batches per product, oldest first: {product_id: [[batch_number, kg], ...]}"""
+    if not product_ids:
+        return {}
+    rows = db.session.execute(
+        select(Product.id, Production.batch_number, Production.quantity)
+        .join(Product, Product.name == Production.flavor)
+        .join(ProductCategory, ProductCategory.id == Product.category_id)
+        .where(ProductCategory.name == FLAVOR_CATEGORY_NAME, Product.id.in_(product_ids),
+               Production.end_time.isnot(None), Production.assigned_store_id.is_(None))
+        .order_by(Production.end_time, Production.id)
+    ).all()
+    batches = {}
+    for row in rows:
+        batches.setdefault(row.id, []).append([row.batch_number, float(row.quantity or 0)])
+    return batches
+
+
+def compute_plan(matrix, main_index):
+    """Transfers per (store, product) from the main store, in one pass over the matrix.
+
+    target = minimum (the store's own, else the general one) + forecast
+    demand over the cover days. Every store that carries a product and is
+    below target asks for the difference; the main store gives what it has
+    above its own target, to the emptiest stores (largest missing fraction)
+    first. Returns (need, transfer, main_deficit) arrays.
+    """
+    minimum = np.where(matrix.minimum > 0, matrix.minimum, matrix.general_minimum[None, :])
+    target = minimum + matrix.demand
+    need = np.where(matrix.carried, np.maximum(target - matrix.stock, 0), 0)
+    need[main_index] = 0
+    available = np.maximum(matrix.stock[main_index] - target[main_index], 0)
+    main_deficit = np.maximum(target[main_index] - matrix.stock[main_index], 0)
+
+    rows, cols = np.nonzero(need > 0)
+    amounts = need[rows, cols]
+    urgency = amounts / target[rows, cols]
+    order = np.lexsort((-urgency, cols))  # per product, most urgent first
+    rows, cols, amounts = rows[order], cols[order], amounts[order]
+
+    # Running total of what the stores before this one (same product) asked for
+    cumulative = np.cumsum(amounts)
+    group_start = np.r_[True, cols[1:] != cols[:-1]] if len(cols) else np.zeros(0, dtype=bool)
+    offsets = np.maximum.accumulate(np.where(group_start, cumulative - amounts, 0)) if len(cols) else cumulative
+    before = cumulative - amounts - offsets
+    given = np.clip(available[cols] - before, 0, amounts)
+    given = np.floor(given * 100) / 100  # whole hundredths, never more than available
+    given[given < MIN_TRANSFER] = 0
+
+    transfer = np.zeros_like(need)
+    transfer[rows, cols] = given
+    return need, transfer, main_deficit
+
+
+def replenishment_plan(cover_days=COVER_DAYS, store_id=None, today=None):
+    """Proposed transfers from Tienda Principal and production for what it can't cover.
+
+    `allocations` is ready for batch_distribution: transfers are drawn
+    from finished unassigned batches of the flavor first (oldest first) and
+    the rest is moved as plain main store stock.
+    """
+    matrix = load_matrix(cover_days, today)
+    main_id = db.session.scalar(select(Store.id).where(Store.name == MAIN_STORE_NAME))
+    plan = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'cover_days': cover_days,
+        'transfers': [],
+        'production': [],
+        'allocations': [],
+        'total_kg': 0
+    }
+    if main_id is None or main_id not in matrix.store_ids or not len(matrix.product_ids):
+        return plan
+
+    main_index = int(np.searchsorted(matrix.store_ids, main_id))
+    need, transfer, main_deficit = compute_plan(matrix, main_index)
+    if store_id:
+        keep = matrix.store_ids == int(store_id)
+        need, transfer = need * keep[:, None], transfer * keep[:, None]
+
+    rows, cols = np.nonzero(need > 0)
+    short_products = np.nonzero((need.sum(0) - transfer.sum(0) + main_deficit) > 0)[0]
+    product_ids = {int(matrix.product_ids[c]) for c in np.r_[cols, short_products]}
+    names = dict(db.session.execute(select(Product.id, Product.name).where(Product.id.in_(product_ids))).all()) \
+        if product_ids else {}
+    store_names = dict(db.session.execute(select(Store.id, Store.name)).all())
+    minimum = np.where(matrix.minimum > 0, matrix.minimum, matrix.general_minimum[None, :])
+
+    # Columns as plain lists, rounded in numpy, then one dict per line
+    columns = zip(
+        matrix.store_ids[rows].tolist(),
+        matrix.product_ids[cols].tolist(),
+        np.round(matrix.stock[rows, cols], 3).tolist(),
+        np.round(minimum[rows, cols], 3).tolist(),
+        np.round(matrix.demand[rows, cols], 3).tolist(),
+        np.round(need[rows, cols], 3).tolist(),
+        np.round(transfer[rows, cols], 2).tolist(),
+        (transfer[rows, cols] >= need[rows, cols] - 0.01).tolist()
+    )
+    plan['transfers'] = [{
+        'store_id': s_id,
+        'store': store_names.get(s_id),
+        'product_id': p_id,
+        'product': names.get(p_id),
+        'current_quantity': current,
+        'minimum': minimum_quantity,
+        'forecast_demand': forecast_demand,
+        'shortfall': shortfall,
+        'quantity': quantity,
+        'covered': covered
+    } for s_id, p_id, current, minimum_quantity, forecast_demand, shortfall, quantity, covered in columns]
+    plan['transfers'].sort(key=lambda t: (t['covered'], -t['shortfall'], t['store_id'], t['product_id']))
+
+    uncovered = need.sum(0) - transfer.sum(0) + main_deficit
+    open_orders = _open_order_kg([int(matrix.product_ids[c]) for c in short_products])
+    for c in short_products:
+        product_id = int(matrix.product_ids[c])
+        ordered = float(open_orders.get(product_id) or 0)
+        to_produce = math.ceil(max(uncovered[c] - ordered, 0) * 10) / 10
+        plan['production'].append({
+            'product_id': product_id,
+            'product': names.get(product_id),
+            'main_stock': round(float(matrix.stock[main_index, c]), 3),
+            'uncovered': round(float(uncovered[c]), 3),
+            'open_orders': round(ordered, 3),
+            'quantity': to_produce
+        })
+    plan['production'].sort(key=lambda p: -p['quantity'])
+
+    moving = [t for t in plan['transfers'] if t['quantity'] > 0]
+    batches = _batches({t['product_id'] for t in moving})
+    for t in moving:
+        left = t['quantity']
+        for batch in batches.get(t['product_id'], []):
+            if left <= 0:
+                break
+            take = min(batch[1], left)
+            if take <= 0:
+                continue
+            batch[1] -= take
+            left = round(left - take, 3)
+            plan['allocations'].append({'batch_number': batch[0], 'store_id': t['store_id'], 'quantity': round(take, 3)})
+        if left > 0:
+            plan['allocations'].append({'product_id': t['product_id'], 'store_id': t['store_id'], 'quantity': left})
+    plan['total_kg'] = round(sum(t['quantity'] for t in moving), 2)
+    return plan
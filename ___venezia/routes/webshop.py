@@ -4,6 +4,14 @@ from functools import wraps
 import json
 from models import Product, ProductCategory, Stock, WebUser, DeliveryAddress, Sale, SaleItem, DeliveryOrder, Store
 from extensions import db
+from stock_reservation import stock_engine, StockConflictError
+from bill_of_materials import expand_cart
+from stock_snapshot import stock_snapshot
+from sequences import sequence_allocator, max_suffix
+from cart_store import get_cart_store, current_cart_id, load_cart, product_cache
+from mercadopago_integration import mp_integration
+from payment_queue import payment_queue
+from flavor_affinity import SALE, top_pairs
 import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
@@ -16,28 +24,29 @@ POTE_CONFIGS = {
     '1/2 KG': {'min_flavors': 1, 'max_flavors': 4},
     '1 KG': {'min_flavors': 1, 'max_flavors': 5}
 }
-
-# Counter for order numbers, should be replaced with database sequence
-_order_counter = 0
+WEBSHOP_PAYMENT_WAIT_SECONDS = 8  # how long checkout waits for the MercadoPago link before answering
+FLAVOR_AFFINITY_DAYS = 90  # window of sales behind the "also picked" suggestions
 
 def generate_order_number():
-    """Generate a user-friendly order number"""
-    global _order_counter
-    _order_counter += 1
+    """Generate a user-friendly order number from the per-year database sequence"""
     year = datetime.now().year
-    return f'VEN-{year}-{_order_counter:03d}'
-
-def init_webshop_session():
-    """Initialize webshop session variables if they don't exist"""
-    if 'webshop_cart' not in session:
-        session['webshop_cart'] = []
-    if 'webshop_cart_total' not in session:
-        session['webshop_cart_total'] = 0.0
+    number = sequence_allocator.next(
+        f'webshop_order:{year}',
+        seed=lambda: max_suffix(DeliveryOrder.delivery_notes, f'Order #VEN-{year}-')
+    )
+    return f'VEN-{year}-{number:03d}'
+
+def first_store_level(stores, product_id):
+    """Stock level of a product in the first store that carries it (no store selected)"""
+    for store in stores:
+        level = stock_snapshot.get(store.id, product_id)
+        if level is not None:
+            return level
+    return None
 
 @webshop.before_request
 def before_request():
-    """Initialize session before each request"""
-    init_webshop_session()
+    """Restore the customer's branch from the cookie set by set_store"""
     # Seleccionar sucursal desde cookie si existe
     try:
         if 'active_store_id' not in session:
@@ -78,12 +87,10 @@ def index():
         # Get stock information for each product (por sucursal si está seleccionada)
         for product in products:
             if product.track_stock:
-                stock = None
-                if active_store_id:
-                    stock = Stock.query.filter_by(store_id=active_store_id, product_id=product.id).first()
-                if stock is None:
-                    stock = Stock.query.filter_by(product_id=product.id).first()
-                product.stock = stock.quantity if stock else 0
+                level = stock_snapshot.get(active_store_id, product.id) if active_store_id else None
+                if level is None:
+                    level = first_store_level(stores, product.id)
+                product.stock = level.quantity if level else 0
             else:
                 product.stock = None  # No stock tracking needed
         
@@ -116,11 +123,12 @@ def get_products():
             print(f"Product: {product.name}, active: {product.active}, category: {product.category.name}, format: {product.sales_format}")
 
         # Format products for response
+        stores = Store.query.order_by(Store.id).all()
         products_data = []
         for product in products:
             # Get stock information
-            stock = Stock.query.filter_by(product_id=product.id).first()
-            stock_qty = stock.quantity if stock else 0
+            level = first_store_level(stores, product.id)
+            stock_qty = level.quantity if level else 0
 
             product_data = {
                 'id': product.id,
@@ -152,23 +160,20 @@ def get_flavors():
     try:
         # Filtrar por stock de sucursal si hay store activa
         store_id = session.get('active_store_id')
-        query = Product.query.join(ProductCategory).filter(
+        flavors = Product.query.join(ProductCategory).filter(
             ProductCategory.name == 'Sabores',
             Product.active == True
-        )
-        if store_id:
-            query = query.join(Stock, Stock.product_id == Product.id).filter(
-                Stock.store_id == store_id,
-                Stock.quantity > 0
-            )
-        flavors = query.all()
+        ).all()
+        levels = stock_snapshot.store(store_id) if store_id else None
 
         flavors_payload = []
         for flavor in flavors:
             stock_qty = None
             if store_id:
-                s = Stock.query.filter_by(store_id=store_id, product_id=flavor.id).first()
-                stock_qty = float(s.quantity) if s and s.quantity is not None else 0.0
+                level = levels.get(flavor.id)
+                if level is None or level.quantity <= 0:
+                    continue
+                stock_qty = level.quantity
             flavors_payload.append({
                 'id': flavor.id,
                 'name': flavor.name,
@@ -196,114 +201,110 @@ def get_flavors():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@webshop.route('/api/flavors/<int:flavor_id>/also_picked', methods=['GET'])
+def get_also_picked_flavors(flavor_id):
+    """Flavors most often chosen together with this one in the last FLAVOR_AFFINITY_DAYS"""
+    try:
+        flavor = product_cache.get(flavor_id)
+        if not flavor:
+            return jsonify({'status': 'error', 'message': 'Sabor no encontrado'}), 404
+        limit = min(request.args.get('limit', 5, type=int), 20)
+        today = datetime.utcnow().date()
+        pairs = top_pairs(SALE, start=today - timedelta(days=FLAVOR_AFFINITY_DAYS), end=today,
+                          limit=limit, flavor=flavor.name)
+        partners = [(p['flavors'][1] if p['flavors'][0] == flavor.name else p['flavors'][0], p['count']) for p in pairs]
+        ids = dict(db.session.query(Product.name, Product.id).filter(
+            Product.name.in_([name for name, _ in partners])
+        ).all()) if partners else {}
+        return jsonify({
+            'status': 'success',
+            'flavor_id': flavor_id,
+            'also_picked': [{'id': ids.get(name), 'name': name, 'count': count} for name, count in partners]
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @webshop.route('/api/cart', methods=['GET'])
 def get_cart():
     """Get current cart contents"""
+    cart = load_cart('webshop')
     return jsonify({
         'status': 'success',
-        'cart': session.get('webshop_cart', []),
-        'total': session.get('webshop_cart_total', 0.0)
+        'cart': cart,
+        'total': cart.total
     })
 
+@webshop.route('/api/cart/count', methods=['GET'])
+def get_cart_count():
+    """Number of lines in the cart (header badge)"""
+    cart_id = current_cart_id('webshop')
+    return jsonify({'status': 'success', 'count': get_cart_store().count(cart_id) if cart_id else 0})
+
 @webshop.route('/api/cart/check-stock', methods=['GET'])
 def check_cart_stock():
     """Verifica stock actual para sabores y envases del carrito en la sucursal activa.
     Retorna advertencias si hay stock bajo y bloquea si es insuficiente.
     """
     try:
-        if not session.get('webshop_cart'):
+        cart = load_cart('webshop')
+        if not cart:
             return jsonify({'status': 'success', 'warnings': [], 'blocking': False})
 
         store_id = session.get('active_store_id', 1)
-        weight_by_format = {'1/4 KG': 0.25, '1/2 KG': 0.5, '1 KG': 1.0}
-        packaging_by_format = {
-            '1/4 KG': 'Envase 1/4 KG',
-            '1/2 KG': 'Envase 1/2 KG',
-            '1 KG': 'Envase 1 KG'
-        }
+        bom = expand_cart(cart, deduct_products=False)
+        # Niveles de stock desde el snapshot en memoria de la sucursal
+        levels = stock_snapshot.store(store_id)
 
-        flavor_needs = {}
-        packaging_needs = {}
         warnings = []
         blocking = False
-        # Mapa de items que usan cada sabor
-        flavor_to_items = {}
-
-        for item in session['webshop_cart']:
-            product = Product.query.get(item['product_id'])
-            if not product:
-                continue
-            total_weight = weight_by_format.get(product.sales_format)
-            qty = int(item.get('quantity', 1) or 1)
-            if total_weight and item.get('flavors'):
-                flavors_list = item['flavors']
-                num_flavors = max(1, len(flavors_list))
-                per_flavor = round((total_weight * qty) / num_flavors, 2)
-                assigned = per_flavor * num_flavors
-                remainder = round((total_weight * qty) - assigned, 2)
-                for idx, f in enumerate(flavors_list):
-                    f_id = int(f['id'])
-                    add = per_flavor + (remainder if idx == 0 else 0)
-                    flavor_needs[f_id] = round(flavor_needs.get(f_id, 0) + add, 2)
-                    # track items using this flavor
-                    if f_id not in flavor_to_items:
-                        flavor_to_items[f_id] = []
-                    flavor_to_items[f_id].append({'item_index': session['webshop_cart'].index(item)})
-                pkg_name = packaging_by_format.get(product.sales_format)
-                if pkg_name:
-                    packaging_needs[pkg_name] = packaging_needs.get(pkg_name, 0) + qty
-
-        # Evaluar sabores
-        LOW_BUFFER = 0.25  # kg de buffer para advertencia
         insufficient = []
-        for flavor_id, need_kg in flavor_needs.items():
-            stock = Stock.query.filter_by(store_id=store_id, product_id=flavor_id).first()
-            current = float(stock.quantity) if stock and stock.quantity is not None else 0.0
-            if current < need_kg:
-                blocking = True
-                flavor = Product.query.get(flavor_id)
-                warnings.append(f"Sin stock suficiente de {flavor.name if flavor else 'sabor'}. Disponible: {current:.2f} kg, requiere: {need_kg:.2f} kg")
-                insufficient.append({'flavor_id': flavor_id, 'flavor_name': flavor.name if flavor else 'sabor'})
-            elif (current - need_kg) <= LOW_BUFFER:
-                flavor = Product.query.get(flavor_id)
-                warnings.append(f"Stock bajo para {flavor.name if flavor else 'sabor'} (quedará ~{current-need_kg:.2f} kg)")
-
-        # Evaluar envases
-        for pkg_name, need_units in packaging_needs.items():
-            pkg_product = Product.query.filter_by(name=pkg_name).first()
-            if pkg_product:
-                pkg_stock = Stock.query.filter_by(store_id=store_id, product_id=pkg_product.id).first()
-                current = float(pkg_stock.quantity) if pkg_stock and pkg_stock.quantity is not None else 0.0
-                if current < need_units:
+        LOW_BUFFER = 0.25  # kg de buffer para advertencia
+        for product_id, need in bom.deductions.items():
+            kind = bom.kinds[product_id]
+            if kind == 'product':
+                continue
+            name = bom.names.get(product_id, 'sabor')
+            level = levels.get(product_id)
+            current = level.quantity if level else 0.0
+            if kind == 'flavor':
+                if current < need:
                     blocking = True
-                    warnings.append(f"Sin stock suficiente de {pkg_name}. Disponible: {current:.0f} u, requiere: {need_units} u")
-                elif (current - need_units) <= 2:
-                    warnings.append(f"Stock bajo de {pkg_name} (quedarán ~{int(current-need_units)} u)")
+                    warnings.append(f"Sin stock suficiente de {name}. Disponible: {current:.2f} kg, requiere: {need:.2f} kg")
+                    insufficient.append({'flavor_id': product_id, 'flavor_name': name})
+                elif (current - need) <= LOW_BUFFER:
+                    warnings.append(f"Stock bajo para {name} (quedará ~{current-need:.2f} kg)")
+            else:
+                if current < need:
+                    blocking = True
+                    warnings.append(f"Sin stock suficiente de {name}. Disponible: {current:.0f} u, requiere: {int(need)} u")
+                elif (current - need) <= 2:
+                    warnings.append(f"Stock bajo de {name} (quedarán ~{int(current-need)} u)")
 
         # Sugerencias de reemplazo para sabores insuficientes
         suggestions = []
         if blocking and insufficient:
             # obtener sabores alternativos con mayor stock en la sucursal
-            alt_query = db.session.query(Product, Stock).join(Stock, Stock.product_id == Product.id).join(ProductCategory).filter(
+            flavors = Product.query.join(ProductCategory).filter(
                 ProductCategory.name == 'Sabores',
-                Product.active == True,
-                Stock.store_id == store_id,
-                Stock.quantity > 0
-            ).order_by(Stock.quantity.desc())
-            alternatives = alt_query.all()
+                Product.active == True
+            ).all()
+            alternatives = sorted(
+                [(p, levels[p.id].quantity) for p in flavors if p.id in levels and levels[p.id].quantity > 0],
+                key=lambda pair: pair[1], reverse=True
+            )
             for miss in insufficient:
                 # top 3 alternativas distintas al sabor faltante
                 alt_list = []
-                for p, s in alternatives:
+                for p, qty in alternatives:
                     if p.id == miss['flavor_id']:
                         continue
-                    alt_list.append({'id': p.id, 'name': p.name, 'stock': float(s.quantity or 0)})
+                    alt_list.append({'id': p.id, 'name': p.name, 'stock': qty})
                     if len(alt_list) >= 3:
                         break
                 suggestions.append({
                     'missing_flavor_id': miss['flavor_id'],
                     'missing_flavor_name': miss['flavor_name'],
-                    'items': flavor_to_items.get(miss['flavor_id'], []),
+                    'items': [{'item_index': idx} for idx in bom.cart_lines.get(miss['flavor_id'], [])],
                     'alternatives': alt_list
                 })
 
@@ -320,7 +321,7 @@ def replace_flavor():
         old_flavor_id = int(data.get('old_flavor_id'))
         new_flavor_id = int(data.get('new_flavor_id'))
 
-        cart = session.get('webshop_cart', [])
+        cart = load_cart('webshop')
         if item_index < 0 or item_index >= len(cart):
             return jsonify({'status': 'error', 'message': 'Ítem inválido'}), 400
         item = cart[item_index]
@@ -343,8 +344,9 @@ def replace_flavor():
         if not replaced:
             return jsonify({'status': 'error', 'message': 'Sabor a reemplazar no presente'}), 400
 
-        session['webshop_cart'] = cart
-        session.modified = True
+        get_cart_store().update_data(cart.cart_id, 'webshop', item['line_id'], {
+            'id': item.get('id'), 'name': item.get('name'), 'flavors': item['flavors']
+        })
         return jsonify({'status': 'success', 'cart': cart})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -363,23 +365,16 @@ def add_to_cart():
                 'message': 'Product ID is required'
             }), 400
             
-        product = Product.query.get(product_id)
+        product = product_cache.get(product_id)
         if not product:
             return jsonify({
                 'status': 'error',
                 'message': 'Product not found'
             }), 404
             
-        # Initialize cart if it doesn't exist
-        if 'webshop_cart' not in session:
-            session['webshop_cart'] = []
-            
         cart_item = {
             'id': str(uuid.uuid4()),
-            'product_id': product_id,
-            'name': product.name,
-            'price': float(product.price),
-            'quantity': quantity
+            'name': product.name
         }
         
         # If flavors were selected, validate and add them
@@ -410,12 +405,9 @@ def add_to_cart():
                 'name': f.name
             } for f in flavor_products]
             
-        session['webshop_cart'].append(cart_item)
-        session['webshop_cart_total'] = sum(
-            item['price'] * item['quantity'] 
-            for item in session['webshop_cart']
-        )
-        session.modified = True
+        # Only the new line is written; the cart itself lives server side
+        get_cart_store().add_line(current_cart_id('webshop', create=True), 'webshop',
+                                  product.id, quantity, float(product.price), cart_item)
 
         # Guardar sabores recientes en cookie (máximo 8 últimos IDs)
         resp = jsonify({
@@ -456,23 +448,22 @@ def remove_from_cart():
         data = request.get_json()
         index = data.get('index')
 
-        if index is None or index < 0 or index >= len(session['webshop_cart']):
+        cart_id = current_cart_id('webshop')
+        store = get_cart_store()
+        line_id = store.line_id_at(cart_id, index) if cart_id and isinstance(index, int) else None
+        if line_id is None:
             return jsonify({
                 'status': 'error',
                 'message': 'Invalid cart item index'
             }), 400
 
-        session['webshop_cart'].pop(index)
-        session['webshop_cart_total'] = sum(
-            item['price'] * item['quantity'] 
-            for item in session['webshop_cart']
-        )
-        session.modified = True
+        store.remove_line(cart_id, 'webshop', line_id)
+        cart = store.load(cart_id)
 
         return jsonify({
             'status': 'success',
-            'cart': session['webshop_cart'],
-            'total': session['webshop_cart_total']
+            'cart': cart,
+            'total': cart.total
         })
 
     except Exception as e:
@@ -485,15 +476,16 @@ def remove_from_cart():
 @webshop.route('/api/cart/clear', methods=['POST'])
 def clear_cart():
     """Clear the cart"""
-    session['webshop_cart'] = []
-    session['webshop_cart_total'] = 0.0
-    session.modified = True
+    cart_id = current_cart_id('webshop')
+    if cart_id:
+        get_cart_store().clear(cart_id)
     return jsonify({'status': 'success'})
 
 @webshop.route('/checkout', methods=['GET'])
 def checkout():
     """Checkout page"""
-    if not session.get('webshop_cart'):
+    cart_id = current_cart_id('webshop')
+    if not cart_id or not get_cart_store().count(cart_id):
         return redirect(url_for('webshop.index'))
     return render_template('webshop/checkout.html')
 
@@ -611,7 +603,8 @@ def register():
 def process_checkout():
     """Process checkout"""
     # Validate cart is not empty
-    if not session.get('webshop_cart'):
+    cart = load_cart('webshop')
+    if not cart:
         return jsonify({'error': 'El carrito está vacío'}), 400
 
     try:
@@ -665,53 +658,16 @@ def process_checkout():
         db.session.add(delivery_address)
         db.session.flush()  # Get the address ID without committing
 
-        # Validación de stock por sabores y preparación de descuentos
-        weight_by_format = {'1/4 KG': 0.25, '1/2 KG': 0.5, '1 KG': 1.0}
-        packaging_by_format = {
-            '1/4 KG': 'Envase 1/4 KG',
-            '1/2 KG': 'Envase 1/2 KG',
-            '1 KG': 'Envase 1 KG'
-        }
-        flavor_deductions = {}  # product_id -> kg a descontar
-        packaging_counts = {}    # packaging_name -> unidades a descontar
-
-        for item in session['webshop_cart']:
-            product = Product.query.get(item['product_id'])
-            if not product:
-                return jsonify({'error': 'Producto no encontrado en carrito'}), 400
-            total_weight = weight_by_format.get(product.sales_format)
-            if total_weight and item.get('flavors'):
-                flavors_list = item['flavors']
-                num_flavors = max(1, len(flavors_list))
-                per_flavor = round(total_weight / num_flavors, 2)
-                # Ajuste de redondeo: distribuir diferencia
-                assigned = per_flavor * num_flavors
-                remainder = round(total_weight - assigned, 2)
-                for idx, f in enumerate(flavors_list):
-                    f_id = int(f['id'])
-                    add = per_flavor + (remainder if idx == 0 else 0)
-                    flavor_deductions[f_id] = round(flavor_deductions.get(f_id, 0) + add, 2)
-                # Packaging
-                pkg_name = packaging_by_format.get(product.sales_format)
-                if pkg_name:
-                    packaging_counts[pkg_name] = packaging_counts.get(pkg_name, 0) + item.get('quantity', 1)
-
-        # Verificar stock disponible por sabor y envase
-        for flavor_id, need_kg in flavor_deductions.items():
-            stock = Stock.query.filter_by(store_id=store_id, product_id=flavor_id).first()
-            if not stock or stock.quantity < need_kg:
-                return jsonify({'error': 'Stock insuficiente para sabores seleccionados'}), 400
-        for pkg_name, need_units in packaging_counts.items():
-            pkg_product = Product.query.filter_by(name=pkg_name).first()
-            if pkg_product:
-                pkg_stock = Stock.query.filter_by(store_id=store_id, product_id=pkg_product.id).first()
-                if not pkg_stock or pkg_stock.quantity < need_units:
-                    return jsonify({'error': f'Sin stock de envases ({pkg_name})'}), 400
+        # Descuentos de stock por sabor (kg) y envase, compartidos con el POS
+        bom = expand_cart(cart, deduct_products=False)
+        if bom.errors:
+            db.session.rollback()
+            return jsonify({'error': 'Producto no encontrado en carrito', 'details': bom.errors}), 400
 
         # Create sale (multi-sucursal: usar store elegida en sesión si existe)
         sale = Sale(
             store_id=store_id,
-            total_amount=session['webshop_cart_total'],
+            total_amount=cart.total,
             created_at=datetime.utcnow(),
             payment_status='pending',
             payment_method='online',  # Default payment method
@@ -719,9 +675,23 @@ def process_checkout():
         )
         db.session.add(sale)
         db.session.flush()  # Get the sale ID without committing
+
+        # Validar y descontar stock de sabores y envases en un solo paso
+        try:
+            reservation = stock_engine.reserve(store_id, bom.lines, reason=f'Venta #{sale.id}')
+        except StockConflictError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 409
+        if not reservation.ok:
+            db.session.rollback()
+            return jsonify({
+                'error': 'Stock insuficiente para sabores seleccionados',
+                'details': reservation.error_messages,
+                'shortfalls': reservation.shortfalls
+            }), 400
         
         # Add sale items
-        for item in session['webshop_cart']:
+        for item in cart:
             sale_item = SaleItem(
                 sale=sale,
                 product_id=item['product_id'],
@@ -743,45 +713,28 @@ def process_checkout():
             delivery_notes=f"Order #{generate_order_number()}"  # Store order number in notes
         )
         db.session.add(delivery)
-        
-        # Aplicar descuentos de stock (sabores y envases)
-        for flavor_id, need_kg in flavor_deductions.items():
-            stock = Stock.query.filter_by(store_id=store_id, product_id=flavor_id).with_for_update().first()
-            if stock:
-                stock.quantity = round(stock.quantity - need_kg, 2)
-        for pkg_name, need_units in packaging_counts.items():
-            pkg_product = Product.query.filter_by(name=pkg_name).first()
-            if pkg_product:
-                pkg_stock = Stock.query.filter_by(store_id=store_id, product_id=pkg_product.id).with_for_update().first()
-                if pkg_stock:
-                    pkg_stock.quantity = round(pkg_stock.quantity - need_units, 2)
-
-        # Crear preferencia de pago (sandbox si no hay token real)
-        try:
-            from mercadopago_integration import mp_integration
-            success, result = mp_integration.create_delivery_preference(delivery)
-            if success and isinstance(result, dict) and result.get('payment_link'):
-                db.session.commit()
+        db.session.flush()
+
+        # Preferencia de pago via cola: el pedido se confirma sin esperar a MercadoPago
+        if mp_integration.is_configured:
+            payment_queue.enqueue(db.session, sale.id, delivery_order_id=delivery.id)
+        db.session.commit()
+
+        response = {
+            'orderId': delivery.id,
+            'orderNumber': delivery.delivery_notes.replace("Order #", "")
+        }
+        if mp_integration.is_configured:
+            # Sin transacción abierta: esperar un poco el link para redirigir al pago
+            link = payment_queue.wait_for(sale.id, timeout=WEBSHOP_PAYMENT_WAIT_SECONDS)
+            if link and link['payment_link']:
                 # Mantener carrito hasta pago aprobado; mostrar link de pago
-                return jsonify({
-                    'orderId': delivery.id,
-                    'orderNumber': delivery.delivery_notes.replace("Order #", ""),
-                    'payment_link': result.get('payment_link')
-                })
+                response['payment_link'] = link['payment_link']
+            elif link and link['status'] == 'failed':
+                response['warning'] = f"Pago no disponible: {link['last_error']}"
             else:
-                # Si MP no está configurado (sandbox off), confirmar localmente
-                db.session.commit()
-                return jsonify({
-                    'orderId': delivery.id,
-                    'orderNumber': delivery.delivery_notes.replace("Order #", "")
-                })
-        except Exception as pay_err:
-            db.session.commit()
-            return jsonify({
-                'orderId': delivery.id,
-                'orderNumber': delivery.delivery_notes.replace("Order #", ""),
-                'warning': f'Pago no disponible: {str(pay_err)}'
-            })
+                response['payment_pending'] = True
+        return jsonify(response)
     
     except Exception as e:
         db.session.rollback()
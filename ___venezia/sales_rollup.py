@@ -0,0 +1,180 @@
+from datetime import datetime
+from sqlalchemy import event, func, inspect as sa_inspect, update, insert, select
+from sqlalchemy.orm import Session
+from models import Sale, SalesDailyRollup
+
+# Sale columns that decide which rollup row a sale is counted in
+KEY_ATTRS = ('store_id', 'created_at', 'payment_method', 'payment_status', 'is_delivery')
+TRACKED_ATTRS = KEY_ATTRS + ('total_amount',)
+
+
+def rollup_key(store_id, created_at, payment_method, payment_status, is_delivery):
+    return (store_id, created_at.date(), payment_method, payment_status or 'pending', bool(is_delivery))
+
+
+def _current(sale):
+    values = {attr: getattr(sale, attr) for attr in TRACKED_ATTRS}
+    if values['created_at'] is None:
+        return None
+    return rollup_key(*(values[attr] for attr in KEY_ATTRS)), float(values['total_amount'] or 0)
+
+
+def _previous(sale, unloaded=None):
+    """Key and amount the sale had before this flush, or None if unchanged.
+
+    `unloaded` has the old values of columns assigned without being loaded
+    first, read from the database before the flush (see _read_unloaded).
+    """
+    state = sa_inspect(sale)
+    values = {}
+    changed = False
+    for attr in TRACKED_ATTRS:
+        history = state.attrs[attr].history
+        if history.deleted:
+            values[attr] = history.deleted[0]
+            changed = True
+        elif history.added:
+            values[attr] = (unloaded or {}).get(attr)
+            changed = True
+        else:
+            values[attr] = getattr(sale, attr)
+    if not changed or values['created_at'] is None:
+        return None
+    return rollup_key(*(values[attr] for attr in KEY_ATTRS)), float(values['total_amount'] or 0)
+
+
+def _read_unloaded(session):
+    """Old values, from the database, of tracked columns that were assigned without being loaded
+    (expired after a commit, or None before): {sale id: {attr: value}}"""
+    ids = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Sale) or _identity(obj) is None:
+            continue
+        state = sa_inspect(obj)
+        if any(state.attrs[attr].history.added and not state.attrs[attr].history.deleted for attr in TRACKED_ATTRS):
+            ids.add(_identity(obj))
+    if not ids:
+        return {}
+    columns = [getattr(Sale, attr) for attr in TRACKED_ATTRS]
+    rows = session.connection().execute(select(Sale.id, *columns).where(Sale.id.in_(ids)))
+    return {row[0]: dict(zip(TRACKED_ATTRS, row[1:])) for row in rows}
+
+
+def _identity(sale):
+    identity = sa_inspect(sale).identity
+    return identity[0] if identity else None
+
+
+def collect_deltas(session, unloaded=None):
+    """Rollup deltas (key -> [count, amount]) for the sales in a flush"""
+    deltas = {}
+    unloaded = unloaded or {}
+
+    def add(entry, sign):
+        if entry is None:
+            return
+        key, amount = entry
+        delta = deltas.setdefault(key, [0, 0.0])
+        delta[0] += sign
+        delta[1] += sign * amount
+
+    for obj in session.new:
+        if isinstance(obj, Sale):
+            add(_current(obj), 1)
+    for obj in session.dirty:
+        if isinstance(obj, Sale) and obj not in session.deleted:
+            previous = _previous(obj, unloaded.get(_identity(obj)))
+            if previous is not None:
+                add(previous, -1)
+                add(_current(obj), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Sale):
+            previous = _previous(obj, unloaded.get(_identity(obj)))
+            add(previous if previous is not None else _current(obj), -1)
+
+    return {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+
+
+def apply_deltas(connection, deltas):
+    """Upsert the deltas into sales_daily_rollup: one UPDATE per key, INSERT when missing"""
+    table = SalesDailyRollup.__table__
+    for (store_id, day, payment_method, payment_status, is_delivery), (count, amount) in deltas.items():
+        match = (
+            (table.c.store_id == store_id) &
+            (table.c.date == day) &
+            (table.c.payment_method == payment_method) &
+            (table.c.payment_status == payment_status) &
+            (table.c.is_delivery == is_delivery)
+        )
+        result = connection.execute(update(table).where(match).values(
+            sale_count=table.c.sale_count + count,
+            total_amount=table.c.total_amount + amount
+        ))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(
+                store_id=store_id, date=day, payment_method=payment_method,
+                payment_status=payment_status, is_delivery=is_delivery,
+                sale_count=count, total_amount=amount
+            ))
+
+
+@event.listens_for(Session, 'before_flush')
+def _remember_unloaded(session, flush_context, instances):
+    # The flush overwrites the row: read what it held while it's still there
+    session.info['sales_rollup_unloaded'] = _read_unloaded(session)
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_sales_rollup(session, flush_context):
+    # Runs inside the flush transaction, so a rollback also discards the rollup change
+    deltas = collect_deltas(session, session.info.pop('sales_rollup_unloaded', None))
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def rebuild(session):
+    """Recompute the whole rollup table from sales (backfill / repair)"""
+    table = SalesDailyRollup.__table__
+    day = func.date(Sale.created_at)
+    rows = session.query(
+        Sale.store_id, day.label('day'), Sale.payment_method,
+        func.coalesce(Sale.payment_status, 'pending').label('payment_status'),
+        func.coalesce(Sale.is_delivery, False).label('is_delivery'),
+        func.count(Sale.id).label('sale_count'),
+        func.coalesce(func.sum(Sale.total_amount), 0).label('total_amount')
+    ).filter(Sale.created_at.isnot(None)).group_by(
+        Sale.store_id, day, Sale.payment_method,
+        func.coalesce(Sale.payment_status, 'pending'), func.coalesce(Sale.is_delivery, False)
+    ).all()
+
+    session.execute(table.delete())
+    if rows:
+        session.execute(insert(table), [{
+            'store_id': row.store_id,
+            'date': row.day if not isinstance(row.day, str) else _parse_day(row.day),
+            'payment_method': row.payment_method,
+            'payment_status': row.payment_status,
+            'is_delivery': bool(row.is_delivery),
+            'sale_count': row.sale_count,
+            'total_amount': float(row.total_amount or 0)
+        } for row in rows])
+    return len(rows)
+
+
+def _parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def filter_rollup(query, start_date, end_date, store_id=None, payment_method=None, payment_status=None):
+    """Apply the sales_data date range (inclusive) and filters to a rollup query"""
+    query = query.filter(
+        SalesDailyRollup.date >= start_date,
+        SalesDailyRollup.date <= end_date
+    )
+    if store_id:
+        query = query.filter(SalesDailyRollup.store_id == store_id)
+    if payment_method:
+        query = query.filter(SalesDailyRollup.payment_method == payment_method)
+    if payment_status:
+        query = query.filter(SalesDailyRollup.payment_status == payment_status)
+    return query
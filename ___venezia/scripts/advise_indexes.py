@@ -0,0 +1,243 @@
+"""Index advisor: replays captured SQL through EXPLAIN QUERY PLAN and reports what runs without an index.
+
+Usage:
+  python scripts/advise_indexes.py advise WORKLOAD.jsonl [...]  [--all]
+      WORKLOAD is what the app wrote with SQL_CAPTURE_FILE set; the plans
+      come from the app's database (SQLALCHEMY_DATABASE_URI), read only.
+  python scripts/advise_indexes.py demo [--sales 150000] [--repeat 5]
+      Seeds a throwaway database of realistic size, drives the hot endpoints
+      to capture their workload, and compares plans and timings without and
+      with the hot-path indexes declared in models.py.
+"""
+import os
+import io
+import sys
+import time
+import random
+import tempfile
+import argparse
+import contextlib
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Declared in models.py for the hot paths; demo drops them for the "before" numbers
+HOT_PATH_INDEXES = (
+    'uq_stocks_store_product', 'ix_sales_created_at', 'ix_sales_store_created_at', 'ix_sale_items_sale',
+    'ix_delivery_addresses_phone', 'ix_delivery_status_history_order', 'ix_delivery_orders_created_at',
+    'ix_delivery_orders_sale',
+)
+ENDPOINTS = (
+    '/', '/stores', '/deliveries', '/deliveries?limit=50', '/api/get_recent_sales',
+    '/api/sales_data?per_page=20', '/api/sales_data?per_page=20&store_id={store_id}',
+    '/api/sales_data?cursor=&per_page=50', '/api/stock_data', '/api/stock/matrix',
+    '/api/stock/as_of?store_id={store_id}&at={as_of}', '/api/delivery/search_customer?q={phone}',
+    '/api/delivery/{delivery_id}/details', '/api/payment_status/{sale_id}', '/pos', '/reports',
+    '/get_stock_analytics_data', '/dashboard',
+)
+
+
+def advise(args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import app, db
+    from index_advisor import IndexAdvisor, load_workload, format_report
+
+    workload = load_workload(*args.workload)
+    with app.app_context(), db.engine.connect() as connection:
+        if connection.dialect.name != 'sqlite':
+            print('EXPLAIN QUERY PLAN is SQLite only')
+            return
+        report = IndexAdvisor(connection).analyze(workload)
+    flagged = sum(1 for _, _, findings in report if findings)
+    print(f'{len(workload)} statements, {flagged} with findings\n')
+    print(format_report(report, only_findings=not args.all))
+
+
+def seed(db, sales, appmod):
+    """Stores, flavors and stock from init_db, then a year of sales, stock moves and deliveries"""
+    from models import (Store, Product, ProductCategory, Stock, StockHistory, Sale, SaleItem, DeliveryAddress, DeliveryStatus,
+                        DeliveryOrder, DeliveryStatusHistory)
+    with contextlib.redirect_stdout(io.StringIO()):
+        appmod.init_db()
+    rng = random.Random(7)
+    connection = db.session.connection()
+    insert = lambda model, rows: rows and connection.execute(model.__table__.insert(), rows)
+
+    insert(Store, [{'name': f'Sucursal {i}', 'address': f'Calle {i}'} for i in range(4)])
+    insert(DeliveryStatus, [{'name': name, 'order': i + 1} for i, name in
+                            enumerate(('Preparing', 'Ready', 'Out for Delivery', 'Delivered', 'Cancelled'))])
+    packaged = ProductCategory.query.filter_by(name='Productos Envasados').first()
+    insert(Product, [{'name': f'Postre {i}', 'price': 2500, 'category_id': packaged.id, 'sales_format': 'UNIDAD',
+                      'active': True, 'track_stock': True} for i in range(20)])
+    store_ids = [s.id for s in Store.query.all()]
+    product_ids = [p.id for p in Product.query.all()]
+    status_ids = [s.id for s in DeliveryStatus.query.order_by(DeliveryStatus.order).all()]
+    stocked = set(connection.execute(db.select(Stock.store_id, Stock.product_id)).all())
+    insert(Stock, [{'store_id': s, 'product_id': p, 'quantity': rng.uniform(5, 40), 'minimum_quantity': 5}
+                   for s in store_ids for p in product_ids if (s, p) not in stocked])
+
+    addresses = [{'customer_name': f'Cliente {i}', 'phone': f'11{rng.randrange(10 ** 8):08d}',
+                  'address': f'Av. Siempreviva {i}'} for i in range(max(1, sales // 30))]
+    insert(DeliveryAddress, addresses)
+    address_ids = [a for (a,) in connection.exec_driver_sql('SELECT id FROM delivery_addresses')]
+
+    now = datetime.utcnow()
+    next_sale = (connection.exec_driver_sql('SELECT MAX(id) FROM sales').scalar() or 0) + 1
+    next_order = (connection.exec_driver_sql('SELECT MAX(id) FROM delivery_orders').scalar() or 0) + 1
+    chunk = 10000
+    for start in range(0, sales, chunk):
+        sale_rows, item_rows, history_rows, order_rows, status_rows = [], [], [], [], []
+        for sale_id in range(next_sale + start, next_sale + min(start + chunk, sales)):
+            created = now - timedelta(seconds=rng.randrange(365 * 86400))
+            store_id = rng.choice(store_ids)
+            delivery = rng.random() < 0.1
+            total = 0
+            for product_id in rng.sample(product_ids, rng.randint(1, 4)):
+                quantity = rng.randint(1, 3)
+                total += quantity * 2500
+                item_rows.append({'sale_id': sale_id, 'product_id': product_id, 'quantity': quantity,
+                                  'unit_price': 2500, 'total_price': quantity * 2500, 'created_at': created})
+                history_rows.append({'store_id': store_id, 'product_id': product_id, 'quantity_change': -quantity,
+                                     'reason': f'Venta #{sale_id}', 'timestamp': created})
+            sale_rows.append({'id': sale_id, 'store_id': store_id, 'total_amount': total, 'created_at': created,
+                              'payment_method': rng.choice(('cash', 'card', 'mercadopago')),
+                              'payment_status': 'completed', 'is_delivery': delivery})
+            if delivery:
+                order_rows.append({'id': next_order, 'sale_id': sale_id, 'address_id': rng.choice(address_ids),
+                                   'current_status_id': status_ids[3], 'created_at': created})
+                status_rows += [{'delivery_order_id': next_order, 'status_id': status, 'created_at': created}
+                                for status in status_ids[:4]]
+                next_order += 1
+        insert(Sale, sale_rows)
+        insert(SaleItem, item_rows)
+        insert(StockHistory, history_rows)
+        insert(DeliveryOrder, order_rows)
+        insert(DeliveryStatusHistory, status_rows)
+    db.session.commit()
+    # Rollup, ledger checkpoints and the rest of the derived tables are backfilled by init_db
+    with contextlib.redirect_stdout(io.StringIO()):
+        appmod.init_db()
+
+
+def drive(app, client, params, repeat):
+    """Best time (ms) of every endpoint, plus a cash sale and a delivery sale through the POS"""
+    timings = {}
+    with client.session_transaction() as session:
+        session['selected_store'] = params['store_id']
+    for template in ENDPOINTS:
+        url = template.format(**params)
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = client.get(url)
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        timings[template] = (response.status_code, best)
+    for body in ({'payment_method': 'cash'},
+                 {'payment_method': 'cash', 'is_delivery': True, 'delivery_data': params['delivery_data']}):
+        best = None
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                client.post('/api/add_to_cart', json={'product_id': params['product_id'], 'quantity': 1})
+                started = time.perf_counter()
+                response = client.post('/api/process_sale', json=body)
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        label = 'POST /api/process_sale' + (' (delivery)' if body.get('is_delivery') else '')
+        timings[label] = (response.status_code, best)
+    return timings
+
+
+def demo(args):
+    db_dir = tempfile.mkdtemp(prefix='venezia_index_')
+    workload_file = os.path.join(db_dir, 'workload.jsonl')
+    os.environ.update(SQLALCHEMY_DATABASE_URI=f'sqlite:///{os.path.join(db_dir, "demo.db")}',
+                      SQL_PROFILE='stats', SQL_CAPTURE_FILE=workload_file, MERCADOPAGO_ACCESS_TOKEN='')
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as appmod
+    from app import app, db
+    from db_indexes import ensure_indexes
+    from index_advisor import IndexAdvisor, load_workload, format_report
+    from models import Product, Stock, Sale, DeliveryOrder, DeliveryAddress
+
+    started = time.perf_counter()
+    with app.app_context():
+        seed(db, args.sales, appmod)
+        counts = {table: db.session.execute(db.text(f'SELECT COUNT(*) FROM {table}')).scalar()
+                  for table in ('sales', 'sale_items', 'stock_history', 'delivery_orders', 'delivery_status_history')}
+        sale = Sale.query.order_by(Sale.id.desc()).first()
+        order = DeliveryOrder.query.order_by(DeliveryOrder.id.desc()).first()
+        address = db.session.get(DeliveryAddress, order.address_id)
+        stock = Stock.query.join(Product).filter(Stock.store_id == sale.store_id, Product.sales_format == 'UNIDAD').first()
+        params = {
+            'store_id': sale.store_id, 'sale_id': sale.id, 'delivery_id': order.id, 'product_id': stock.product_id,
+            'phone': address.phone[-6:], 'as_of': (datetime.utcnow() - timedelta(days=45)).strftime('%Y-%m-%d'),
+            'delivery_data': {'customer_name': address.customer_name, 'phone': address.phone,
+                              'address': address.address}
+        }
+        for name in HOT_PATH_INDEXES:
+            db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+        db.session.commit()
+    print(f'seeded in {time.perf_counter() - started:.0f}s: '
+          + ', '.join(f'{table} {count}' for table, count in counts.items()))
+
+    client = app.test_client()
+    before = drive(app, client, params, args.repeat)
+    workload = load_workload(workload_file)
+    with app.app_context(), db.engine.connect() as connection:
+        advisor = IndexAdvisor(connection)
+        report = advisor.analyze(workload)
+        statements_before = {entry['fingerprint']: advisor.time(entry, args.repeat) for entry in workload}
+    flagged = [item for item in report if item[2]]
+    print(f'\nwithout the hot-path indexes: {len(workload)} statements captured, {len(flagged)} with findings\n')
+    print(format_report(report))
+
+    with app.app_context():
+        started = time.perf_counter()
+        _, created = ensure_indexes(db.engine)
+        print(f'\nmigration created {len(created)} indexes in {time.perf_counter() - started:.1f}s: {", ".join(created)}')
+
+    after = drive(app, client, params, args.repeat)
+    with app.app_context(), db.engine.connect() as connection:
+        advisor = IndexAdvisor(connection)
+        report = advisor.analyze(workload)
+        statements_after = {entry['fingerprint']: advisor.time(entry, args.repeat) for entry in workload}
+    flagged = [item for item in report if item[2]]
+    print(f'\nwith them: {len(flagged)} statements with findings\n')
+    print(format_report(report))
+
+    print(f'\n{"endpoint":<58} {"status":>6} {"before ms":>10} {"after ms":>10} {"speedup":>8}')
+    for label, (status, ms_before) in before.items():
+        ms_after = after[label][1]
+        print(f'{label[:58]:<58} {status:>6} {ms_before:>10.1f} {ms_after:>10.1f} {ms_before / ms_after:>7.1f}x')
+
+    from sql_profiler import summary
+    changed = sorted(((statements_before[fp], statements_after[fp], fp) for fp in statements_before
+                      if statements_before[fp] is not None), reverse=True)[:args.top]
+    print(f'\n{"slowest captured statements":<100} {"before ms":>10} {"after ms":>10}')
+    for ms_before, ms_after, fp in changed:
+        print(f'{summary(fp)[:100]:<100} {ms_before:>10.2f} {ms_after:>10.2f}')
+    print(f'\ntotal of captured SELECTs: {sum(v for v in statements_before.values() if v):.1f} ms before, '
+          f'{sum(v for v in statements_after.values() if v):.1f} ms after')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    advise_parser = commands.add_parser('advise')
+    advise_parser.add_argument('workload', nargs='+')
+    advise_parser.add_argument('--all', action='store_true', help='list statements without findings too')
+    demo_parser = commands.add_parser('demo')
+    demo_parser.add_argument('--sales', type=int, default=150000)
+    demo_parser.add_argument('--repeat', type=int, default=5, help='runs per endpoint and statement (best is kept)')
+    demo_parser.add_argument('--top', type=int, default=15, help='statements listed in the timing table')
+    args = parser.parse_args()
+    if args.command == 'advise':
+        advise(args)
+    else:
+        demo(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""Checkout latency while 12-month reports run, on the primary vs the analytics replica.
+
+Usage: python scripts/bench_analytics_replica.py [--sales 150000] [--terminals 4] [--checkouts 60]
+                                                 [--reporters 2] [--refresh 60] [--sqlite-profile production|off]
+
+Seeds a throwaway database (scripts/advise_indexes.py), then for each
+scenario runs two processes against a fresh copy of it, like two app
+workers: POS terminals checking out, and report users opening 12-month
+reports with cold caches. Scenarios: no reports (baseline), reports on the
+primary (ANALYTICS_REPLICA=off) and reports on the replica
+(ANALYTICS_REPLICA=sqlite, refreshed every --refresh seconds). Never
+touches venezia.db.
+
+All processes share this machine's CPUs and disk, unlike a replica on its
+own server: what it measures is lock contention between reports and
+checkouts, plus the cost of the refreshes.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timedelta
+
+SCENARIOS = (('baseline', 'off', False), ('primary', 'off', True), ('replica', 'sqlite', True))  # (name, ANALYTICS_REPLICA, report users)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_app():
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # The app prints as it goes; results go to the real stdout (emit)
+    sys.stdout = io.StringIO()
+    import app as appmod
+    return appmod
+
+
+def emit(line):
+    sys.__stdout__.write(line + '\n')
+    sys.__stdout__.flush()
+
+
+def run_seed(args):
+    appmod = load_app()
+    from advise_indexes import seed
+    from models import Product, Stock
+    with appmod.app.app_context():
+        seed(appmod.db, args.sales, appmod)
+        packaged = [p.id for p in Product.query.filter_by(sales_format='UNIDAD').all()]
+        Stock.query.filter(Stock.product_id.in_(packaged)).update({'quantity': 10 ** 6}, synchronize_session=False)
+        appmod.db.session.commit()
+
+
+def run_checkouts(args):
+    appmod = load_app()
+    app, db = appmod.app, appmod.db
+    from models import Product, Stock
+    with app.app_context():
+        pairs = db.session.query(Stock.store_id, Stock.product_id).join(Product).filter(
+            Product.sales_format == 'UNIDAD').all()
+    store_ids = sorted({s for s, _ in pairs})
+    product_ids = sorted({p for _, p in pairs})
+    checkout_ms, errors = [], []
+
+    def terminal(number):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['selected_store'] = store_ids[number % len(store_ids)]
+        for _ in range(args.checkouts):
+            for product_id in random.sample(product_ids, 3):
+                client.post('/api/add_to_cart', json={'product_id': product_id, 'quantity': 1})
+            started = time.perf_counter()
+            response = client.post('/api/process_sale', json={'payment_method': 'cash'})
+            checkout_ms.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors.append((response.get_json(silent=True) or {}).get('error', response.status_code))
+
+    threads = [threading.Thread(target=terminal, args=(i,)) for i in range(args.terminals)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    emit(json.dumps({
+        'checkouts': len(checkout_ms),
+        'errors': len(errors),
+        'p50': round(percentile(checkout_ms, 0.5), 1),
+        'p95': round(percentile(checkout_ms, 0.95), 1),
+        'p99': round(percentile(checkout_ms, 0.99), 1),
+        'max': round(max(checkout_ms), 1)
+    }))
+
+
+def run_reports(args):
+    appmod = load_app()
+    app = appmod.app
+    import analytics
+    from stock_forecast import daily_sales_cache
+    from analytics_replica import analytics_replica
+    if analytics_replica.mode == 'sqlite':
+        analytics_replica.refresh()
+    year_ago = (datetime.utcnow() - timedelta(days=365)).strftime('%Y-%m-%d')
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    report_ms, sources, errors = [], {}, []
+    done = threading.Event()
+
+    def reporter():
+        client = app.test_client()
+        while not done.is_set():
+            # Cold caches: every report as if opened for the first time
+            analytics.analytics_cache.clear()
+            daily_sales_cache.clear()
+            url = random.choice((
+                f'/api/sales_data?start_date={year_ago}&end_date={today}&per_page=50&page={random.randint(1, 300)}',
+                f'/get_stock_analytics_data?days={random.randint(330, 365)}',
+                '/api/production_metrics?days=365',
+            ))
+            started = time.perf_counter()
+            try:
+                response = client.get(url)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            report_ms.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            source = response.headers.get('X-Data-Source', 'primary')
+            sources[source] = sources.get(source, 0) + 1
+
+    threads = [threading.Thread(target=reporter) for _ in range(args.reporters)]
+    for thread in threads:
+        thread.start()
+    emit('ready')
+    # The parent removes the file when the checkouts are done
+    while os.path.exists(args.running):
+        time.sleep(0.1)
+    done.set()
+    for thread in threads:
+        thread.join()
+    emit(json.dumps({
+        'reports': len(report_ms),
+        'errors': len(errors),
+        'report_avg_ms': round(sum(report_ms) / len(report_ms), 1) if report_ms else None,
+        'sources': sources,
+        'refreshes': analytics_replica.refreshes
+    }))
+
+
+def child(role, db_file, args, replica='off', extra=()):
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f'sqlite:///{db_file}?timeout=30', MERCADOPAGO_ACCESS_TOKEN='',
+               SQL_PROFILE='off', SQLITE_PROFILE=args.sqlite_profile, ANALYTICS_REPLICA=replica,
+               ANALYTICS_REPLICA_REFRESH=str(args.refresh))
+    command = [sys.executable, os.path.abspath(__file__), '--role', role, '--sales', str(args.sales),
+               '--terminals', str(args.terminals), '--checkouts', str(args.checkouts),
+               '--reporters', str(args.reporters), '--refresh', str(args.refresh), '--sqlite-profile', args.sqlite_profile, *extra]
+    # stderr to a file: a full pipe would stall the child
+    errors = open(f'{db_file}.{role}.log', 'w')
+    return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=errors, text=True)
+
+
+def result(process, db_file, role):
+    stdout, _ = process.communicate()
+    lines = [line for line in stdout.splitlines() if line.startswith('{')]
+    if not lines:
+        with open(f'{db_file}.{role}.log') as log:
+            raise RuntimeError(log.read()[-2000:])
+    return json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sales', type=int, default=150000)
+    parser.add_argument('--terminals', type=int, default=4)
+    parser.add_argument('--checkouts', type=int, default=60, help='checkouts per terminal')
+    parser.add_argument('--reporters', type=int, default=2, help='users opening reports at the same time')
+    parser.add_argument('--refresh', type=float, default=60, help='seconds between replica refreshes')
+    parser.add_argument('--sqlite-profile', choices=('production', 'off'), default='production')
+    parser.add_argument('--role', choices=('seed', 'checkouts', 'reports'), help=argparse.SUPPRESS)
+    parser.add_argument('--running', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == 'seed':
+        return run_seed(args)
+    if args.role == 'checkouts':
+        return run_checkouts(args)
+    if args.role == 'reports':
+        return run_reports(args)
+
+    workdir = tempfile.mkdtemp(prefix='venezia_bench_')
+    try:
+        bench(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench(args, workdir):
+    seeded = os.path.join(workdir, 'seed.db')
+    started = time.perf_counter()
+    seeding = child('seed', seeded, args)
+    seeding.communicate()
+    if seeding.returncode:
+        with open(f'{seeded}.seed.log') as log:
+            print(log.read()[-2000:])
+        return
+    # Everything in the main file, so each scenario can start from a plain copy of it
+    connection = sqlite3.connect(seeded)
+    connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    if args.sqlite_profile == 'off':
+        # The rollback journal the app used before the SQLite production profile
+        connection.execute('PRAGMA journal_mode = DELETE')
+    connection.close()
+    print(f'seeded {args.sales} sales in {time.perf_counter() - started:.0f}s; '
+          f'{args.terminals} terminals x {args.checkouts} checkouts, {args.reporters} report users, '
+          f'SQLITE_PROFILE={args.sqlite_profile}')
+    print(f'{"reports on":<10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8} {"errors":>7} '
+          f'{"reports":>8} {"report ms":>10} {"errors":>7}  sources')
+
+    for name, replica, with_reports in SCENARIOS:
+        db_file = os.path.join(workdir, f'{name}.db')
+        shutil.copy(seeded, db_file)
+        reports = None
+        if with_reports:
+            running = os.path.join(workdir, f'{name}.running')
+            open(running, 'w').close()
+            reports = child('reports', db_file, args, replica, ('--running', running))
+            while reports.stdout.readline().strip() != 'ready':
+                if reports.poll() is not None:
+                    result(reports, db_file, 'reports')
+        checkouts = result(child('checkouts', db_file, args, replica), db_file, 'checkouts')
+        report_stats = {}
+        if reports is not None:
+            os.remove(running)
+            report_stats = result(reports, db_file, 'reports')
+        print(f'{name:<10} {checkouts["p50"]:>8} {checkouts["p95"]:>8} {checkouts["p99"]:>8} {checkouts["max"]:>8} '
+              f'{checkouts["errors"]:>7} {report_stats.get("reports", "-"):>8} '
+              f'{report_stats.get("report_avg_ms") or "-":>10} {report_stats.get("errors", "-"):>7}  '
+              f'{report_stats.get("sources", "")}')
+
+
+if __name__ == '__main__':
+    main()
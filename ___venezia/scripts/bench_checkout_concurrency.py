@@ -0,0 +1,194 @@
+"""Checkout throughput with several POS terminals at once, SQLite profile off vs production.
+
+Usage: python scripts/bench_checkout_concurrency.py [--terminals 8] [--sales 40] [--lines 5] [--readers 2]
+                                                   [--pollers 2]
+
+Each terminal is its own client session: it fills a cart through
+/api/add_to_cart and checks out with /api/process_sale, over and over.
+Reader threads query stock meanwhile, to show whether writes block them.
+Pollers do what pos.js does after a card sale: GET /api/payment_status
+until the payment is approved, against scripts/mp_stub_server.py. Their
+payment stays 'in_process', so every poll asks MercadoPago and writes the
+status from a GET while the terminals commit.
+Every profile runs in a fresh process against a throwaway SQLite
+database, never against venezia.db.
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+import subprocess
+import contextlib
+
+STORES = 4
+PRODUCTS = 60
+PROFILES = ('off', 'production')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_profile(args):
+    """Child process: SQLITE_PROFILE and the database URI are set before the app is imported"""
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import mp_stub_server
+        stub = mp_stub_server.serve(0)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['MERCADOPAGO_ACCESS_TOKEN'] = 'TEST-stub'
+    os.environ['MERCADOPAGO_API_BASE_URL'] = f'http://127.0.0.1:{stub.server_port}'
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import app, db
+    from sqlalchemy import func, select
+    from models import Store, Product, Stock, Sale
+    from sqlite_profile import sqlite_profile
+
+    with app.app_context():
+        db.create_all()
+        stores = [Store(name=f'Sucursal {i}') for i in range(STORES)]
+        products = [Product(name=f'Producto {i}', price=1000) for i in range(PRODUCTS)]
+        db.session.add_all(stores + products)
+        db.session.flush()
+        db.session.add_all([Stock(store_id=s.id, product_id=p.id, quantity=10 ** 6) for s in stores for p in products])
+        db.session.commit()
+        store_ids, product_ids = [s.id for s in stores], [p.id for p in products]
+
+    checkout_ms, read_ms, poll_ms, errors, poll_errors = [], [], [], [], []
+    done = threading.Event()
+
+    def terminal(number):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['selected_store'] = store_ids[number % len(store_ids)]
+        for _ in range(args.sales):
+            for product_id in random.sample(product_ids, args.lines):
+                client.post('/api/add_to_cart', json={'product_id': product_id, 'quantity': 1})
+            started = time.perf_counter()
+            response = client.post('/api/process_sale', json={'payment_method': 'cash'})
+            checkout_ms.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors.append((response.get_json(silent=True) or {}).get('error', response.status_code))
+
+    def reader():
+        # Outside a request transactions default to writing: these only read
+        with app.app_context(), sqlite_profile.write_intent(False):
+            while not done.is_set():
+                started = time.perf_counter()
+                db.session.execute(select(func.sum(Stock.quantity)).where(Stock.store_id == random.choice(store_ids)))
+                db.session.rollback()
+                read_ms.append((time.perf_counter() - started) * 1000)
+                time.sleep(0.005)
+
+    def poller(number):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['selected_store'] = store_ids[number % len(store_ids)]
+        client.post('/api/add_to_cart', json={'product_id': random.choice(product_ids), 'quantity': 1})
+        sale_id = client.post('/api/process_sale', json={'payment_method': 'card'}).get_json()['sale_id']
+        state = mp_stub_server.state
+        with state['lock']:
+            payment_id = state['next_payment_id']
+            state['next_payment_id'] += 1
+            state['payments'][payment_id] = {'id': payment_id, 'status': 'in_process',
+                                             'external_reference': str(sale_id)}
+        while not done.is_set():
+            started = time.perf_counter()
+            response = client.get(f'/api/payment_status/{sale_id}')
+            poll_ms.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                poll_errors.append((response.get_json(silent=True) or {}).get('message', response.status_code))
+            time.sleep(0.005)
+
+    terminals = [threading.Thread(target=terminal, args=(i,)) for i in range(args.terminals)]
+    readers = [threading.Thread(target=reader) for _ in range(args.readers)]
+    readers += [threading.Thread(target=poller, args=(i,)) for i in range(args.pollers)]
+    with contextlib.redirect_stdout(io.StringIO()):  # process_sale logs every request
+        started = time.perf_counter()
+        for thread in readers + terminals:
+            thread.start()
+        for thread in terminals:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        done.set()
+        for thread in readers:
+            thread.join()
+
+    with app.app_context():
+        sales = db.session.scalar(select(func.count(Sale.id)))
+        journal = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+    print(json.dumps({
+        'profile': os.environ['SQLITE_PROFILE'],
+        'journal_mode': journal,
+        'sales': sales,
+        'errors': len(errors),
+        'error_sample': sorted({str(e) for e in errors})[:3],
+        'sales_per_s': round(sales / elapsed, 1),
+        'checkout_p50_ms': round(percentile(checkout_ms, 0.5), 1),
+        'checkout_p95_ms': round(percentile(checkout_ms, 0.95), 1),
+        'checkout_max_ms': round(max(checkout_ms), 1),
+        'read_p95_ms': round(percentile(read_ms, 0.95), 2) if read_ms else None,
+        'read_max_ms': round(max(read_ms), 2) if read_ms else None,
+        'polls': len(poll_ms),
+        'poll_errors': len(poll_errors),
+        'poll_error_sample': sorted({str(e) for e in poll_errors})[:3],
+        'poll_p95_ms': round(percentile(poll_ms, 0.95), 1) if poll_ms else None,
+        'writer_queue': sqlite_profile.writers.stats() if sqlite_profile.enabled else None
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--terminals', type=int, default=8)
+    parser.add_argument('--sales', type=int, default=40, help='checkouts per terminal')
+    parser.add_argument('--lines', type=int, default=5, help='cart lines per sale')
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--pollers', type=int, default=2, help='threads polling /api/payment_status')
+    parser.add_argument('--profile', choices=PROFILES, help=argparse.SUPPRESS)  # child process
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args)
+        return
+
+    print(f'{args.terminals} terminals x {args.sales} sales x {args.lines} lines, {args.readers} readers, '
+          f'{args.pollers} payment status pollers')
+    print(f'{"profile":<11} {"journal":<8} {"sales/s":>8} {"errors":>7} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"max ms":>8} {"read p95":>9} {"read max":>9} {"polls":>6} {"poll err":>9} {"poll p95":>9}')
+    for profile in PROFILES:
+        db_file = os.path.join(tempfile.mkdtemp(prefix='venezia_bench_'), 'bench.db')
+        env = dict(os.environ, SQLITE_PROFILE=profile, SQLALCHEMY_DATABASE_URI=f'sqlite:///{db_file}?timeout=30',
+                   SQL_PROFILE='off')
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--profile', profile, '--terminals', str(args.terminals),
+             '--sales', str(args.sales), '--lines', str(args.lines), '--readers', str(args.readers),
+             '--pollers', str(args.pollers)],
+            env=env, capture_output=True, text=True
+        )
+        lines = [line for line in output.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            print(f'{profile:<11} failed:\n{output.stderr[-2000:]}')
+            continue
+        r = json.loads(lines[-1])
+        print(f'{r["profile"]:<11} {r["journal_mode"]:<8} {r["sales_per_s"]:>8} {r["errors"]:>7} '
+              f'{r["checkout_p50_ms"]:>8} {r["checkout_p95_ms"]:>8} {r["checkout_max_ms"]:>8} '
+              f'{r["read_p95_ms"]:>9} {r["read_max_ms"]:>9} {r["polls"]:>6} {r["poll_errors"]:>9} '
+              f'{r["poll_p95_ms"]:>9}')
+        if r['error_sample']:
+            print(f'{"":<11} errors: {"; ".join(r["error_sample"])}')
+        if r['poll_error_sample']:
+            print(f'{"":<11} payment status errors: {"; ".join(r["poll_error_sample"])}')
+        if r['writer_queue']:
+            print(f'{"":<11} writer queue: {r["writer_queue"]}')
+
+
+if __name__ == '__main__':
+    main()
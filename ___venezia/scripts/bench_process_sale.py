@@ -0,0 +1,113 @@
+"""Benchmark stock handling of /api/process_sale: per-line queries vs the reservation engine.
+
+Usage: python scripts/bench_process_sale.py [--sales 300] [--lines 20]
+
+Runs against a throwaway SQLite database, never against venezia.db.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='venezia_bench_'), 'bench.db')
+os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_FILE}'
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from models import Store, Product, Stock, StockHistory, Sale, SaleItem
+from stock_reservation import stock_engine
+
+STORES = 4
+PRODUCTS = 60
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+    stores = [Store(name=f'Sucursal {i}') for i in range(STORES)]
+    products = [Product(name=f'Producto {i}', price=1000) for i in range(PRODUCTS)]
+    db.session.add_all(stores + products)
+    db.session.flush()
+    db.session.add_all([
+        Stock(store_id=s.id, product_id=p.id, quantity=10 ** 6)
+        for s in stores for p in products
+    ])
+    db.session.commit()
+    return [s.id for s in stores], [p.id for p in products]
+
+
+def random_cart(product_ids, lines):
+    return [{
+        'product_id': pid,
+        'quantity': 1,
+        'unit_price': 1000.0,
+        'total_price': 1000.0,
+        'flavors': []
+    } for pid in random.sample(product_ids, lines)]
+
+
+def new_sale(store_id, cart):
+    sale = Sale(store_id=store_id, total_amount=sum(i['total_price'] for i in cart),
+                payment_method='cash', payment_status='completed')
+    db.session.add(sale)
+    db.session.flush()
+    return sale
+
+
+def legacy_sale(store_id, cart):
+    """Per-line flow used by process_sale before the reservation engine"""
+    sale = new_sale(store_id, cart)
+    for item in cart:
+        stock = Stock.query.filter_by(store_id=store_id, product_id=item['product_id']).with_for_update().first()
+        if stock.quantity < float(item['quantity']):
+            Product.query.get(item['product_id'])
+            db.session.rollback()
+            return
+        db.session.add(SaleItem(sale_id=sale.id, product_id=item['product_id'],
+                                quantity=float(item['quantity']), unit_price=item['unit_price'],
+                                total_price=item['total_price']))
+        stock.quantity = stock.quantity - float(item['quantity'])
+        db.session.add(StockHistory(store_id=store_id, product_id=item['product_id'],
+                                    quantity_change=-float(item['quantity']), reason=f'Venta #{sale.id}'))
+    for item in cart:
+        Product.query.get(item['product_id'])
+    db.session.commit()
+
+
+def engine_sale(store_id, cart):
+    sale = new_sale(store_id, cart)
+    reservation = stock_engine.reserve(store_id, cart, reason=f'Venta #{sale.id}')
+    if not reservation.ok:
+        db.session.rollback()
+        return
+    stock_engine.insert_sale_items(sale.id, cart)
+    db.session.commit()
+
+
+def run(label, fn, carts):
+    db.session.expire_all()
+    start = time.perf_counter()
+    for store_id, cart in carts:
+        fn(store_id, cart)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<22} {len(carts) / elapsed:8.1f} sales/s  ({elapsed * 1000 / len(carts):.2f} ms/sale)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sales', type=int, default=300)
+    parser.add_argument('--lines', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        store_ids, product_ids = seed()
+        carts = [(random.choice(store_ids), random_cart(product_ids, args.lines)) for _ in range(args.sales)]
+        print(f'{args.sales} sales x {args.lines} lines, {STORES} stores, {PRODUCTS} products')
+        run('per-line (before)', legacy_sale, carts)
+        run('reservation engine', engine_sale, carts)
+
+
+if __name__ == '__main__':
+    main()
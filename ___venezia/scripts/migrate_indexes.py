@@ -0,0 +1,17 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from db_indexes import ensure_indexes
+
+def migrate_indexes(dry_run=False):
+    """Create the indexes declared on the models that an existing database lacks (init_db does it on startup too)"""
+    with app.app_context():
+        removed, created = ensure_indexes(db.engine, dry_run=dry_run)
+        verb = 'would be' if dry_run else 'were'
+        print(f"{removed} duplicate stock rows {verb} merged")
+        print(f"{len(created)} indexes {verb} created: {', '.join(created) or '-'}")
+
+if __name__ == '__main__':
+    migrate_indexes(dry_run='--dry-run' in sys.argv[1:])
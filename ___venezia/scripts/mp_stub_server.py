@@ -0,0 +1,160 @@
+"""Local stand-in for the MercadoPago API, for development and load tests.
+
+Run it and point the app at it:
+
+    python scripts/mp_stub_server.py --port 8089 --delay 1.5 --fail-rate 0.2
+    MERCADOPAGO_ACCESS_TOKEN=TEST-stub MERCADOPAGO_API_BASE_URL=http://localhost:8089 python app.py
+
+Implements the calls the app makes (create preference, get payment, search
+payments) plus POST /stub/pay/<preference_id>?status=approved to simulate a
+customer paying, which also sends the webhook to the preference's
+notification_url.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+state = {
+    'lock': threading.Lock(),
+    'preferences': {},  # preference id -> preference data
+    'payments': {},  # payment id -> payment
+    'next_payment_id': 1000,
+    'requests': 0,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+    fail_first = 0
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _simulate_latency(self):
+        """Sleep and decide whether this call fails; True means answer with a 500"""
+        with state['lock']:
+            state['requests'] += 1
+            count = state['requests']
+        if self.delay:
+            time.sleep(self.delay)
+        return count <= self.fail_first or random.random() < self.fail_rate
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == '/checkout/preferences':
+            if self._simulate_latency():
+                return self._send(500, {'message': 'stub: simulated failure', 'status': 500})
+            data = self._body()
+            preference_id = f'stub-{uuid.uuid4().hex[:12]}'
+            with state['lock']:
+                state['preferences'][preference_id] = data
+            host = self.headers.get('Host', 'localhost')
+            return self._send(201, {
+                'id': preference_id,
+                'init_point': f'http://{host}/checkout/{preference_id}',
+                'sandbox_init_point': f'http://{host}/checkout/{preference_id}',
+                'external_reference': data.get('external_reference'),
+                'items': data.get('items', []),
+                'point_of_interaction': {'transaction_data': {'qr_code': f'stub-qr-{preference_id}'}}
+            })
+
+        if url.path.startswith('/stub/pay/'):
+            preference_id = url.path.rsplit('/', 1)[-1]
+            status = parse_qs(url.query).get('status', ['approved'])[0]
+            with state['lock']:
+                preference = state['preferences'].get(preference_id)
+                if preference is None:
+                    return self._send(404, {'message': 'preference not found'})
+                payment_id = state['next_payment_id']
+                state['next_payment_id'] += 1
+                payment = {
+                    'id': payment_id,
+                    'status': status,
+                    'status_detail': 'accredited' if status == 'approved' else 'cc_rejected_other_reason',
+                    'external_reference': preference.get('external_reference'),
+                    'transaction_amount': sum(i['unit_price'] * i['quantity'] for i in preference.get('items', [])),
+                    'payment_type_id': 'account_money',
+                    'payment_method_id': 'account_money',
+                    'date_created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+                state['payments'][payment_id] = payment
+            notification_url = preference.get('notification_url')
+            if notification_url:
+                try:
+                    notification = json.dumps({'type': 'payment', 'action': 'payment.created',
+                                               'data': {'id': str(payment_id)}}).encode()
+                    urlopen(Request(notification_url, data=notification,
+                                    headers={'Content-Type': 'application/json'}), timeout=5)
+                except Exception as e:
+                    print(f'stub: webhook to {notification_url} failed: {e}')
+            return self._send(201, payment)
+
+        return self._send(404, {'message': 'not found'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/v1/payments/search':
+            reference = parse_qs(url.query).get('external_reference', [None])[0]
+            with state['lock']:
+                results = [p for p in state['payments'].values() if p['external_reference'] == reference]
+            results.sort(key=lambda p: p['id'], reverse=True)
+            return self._send(200, {'results': results, 'paging': {'total': len(results)}})
+
+        if url.path.startswith('/v1/payments/'):
+            try:
+                payment_id = int(url.path.rsplit('/', 1)[-1])
+            except ValueError:
+                return self._send(400, {'message': 'invalid payment id'})
+            with state['lock']:
+                payment = state['payments'].get(payment_id)
+            if payment is None:
+                return self._send(404, {'message': 'payment not found'})
+            return self._send(200, payment)
+
+        if url.path == '/stub/stats':
+            with state['lock']:
+                return self._send(200, {
+                    'requests': state['requests'],
+                    'preferences': len(state['preferences']),
+                    'payments': len(state['payments'])
+                })
+
+        return self._send(404, {'message': 'not found'})
+
+    def log_message(self, format, *args):
+        print(f'stub: {self.command} {self.path} -> {args[1] if len(args) > 1 else ""}')
+
+
+def serve(port=8089, delay=0.0, fail_rate=0.0, fail_first=0):
+    StubHandler.delay = delay
+    StubHandler.fail_rate = fail_rate
+    StubHandler.fail_first = fail_first
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    print(f'MercadoPago stub listening on http://127.0.0.1:{server.server_port}')
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local MercadoPago API stand-in')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before answering a preference')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of preference calls answered with 500')
+    parser.add_argument('--fail-first', type=int, default=0, help='answer the first N preference calls with 500')
+    args = parser.parse_args()
+    serve(args.port, args.delay, args.fail_rate, args.fail_first).serve_forever()
@@ -0,0 +1,21 @@
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from payment_queue import payment_queue, notification_queue
+
+def run_payment_worker():
+    """Dedicated MercadoPago preference and webhook worker, for PAYMENT_QUEUE=external deployments"""
+    with app.app_context():
+        db.create_all()
+    threads = [threading.Thread(target=queue.run_forever, name=queue.name, daemon=True)
+               for queue in (payment_queue, notification_queue)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+if __name__ == '__main__':
+    run_payment_worker()
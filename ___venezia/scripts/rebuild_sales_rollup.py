@@ -0,0 +1,17 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from sales_rollup import rebuild
+
+def rebuild_sales_rollup():
+    """Recompute sales_daily_rollup from the sales table (backfill or repair after manual edits)"""
+    with app.app_context():
+        db.create_all()
+        rows = rebuild(db.session)
+        db.session.commit()
+        print(f"sales_daily_rollup rebuilt: {rows} rows")
+
+if __name__ == '__main__':
+    rebuild_sales_rollup()
@@ -0,0 +1,17 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from analytics_replica import analytics_replica
+
+def refresh_analytics_replica():
+    """Copy the database into the analytics replica (cron, with ANALYTICS_REPLICA=sqlite and ANALYTICS_REPLICA_REFRESH=0)"""
+    if analytics_replica.mode != 'sqlite':
+        print("ANALYTICS_REPLICA is not 'sqlite': nothing to refresh")
+        return
+    seconds = analytics_replica.refresh()
+    print(f"analytics replica {analytics_replica.path} refreshed in {seconds:.2f}s")
+
+if __name__ == '__main__':
+    refresh_analytics_replica()
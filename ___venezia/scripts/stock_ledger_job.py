@@ -0,0 +1,46 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from stock_ledger import reconcile, take_daily_checkpoints, take_snapshot
+
+def checkpoint_stock_ledger():
+    """Take the daily checkpoints missing up to today (run from cron, once a day or more)"""
+    with app.app_context():
+        taken = take_daily_checkpoints(db.session)
+        db.session.commit()
+        print(f"stock_ledger_snapshots: {taken} daily checkpoints taken")
+
+def snapshot_stock_ledger():
+    """Extra checkpoint at the current time, for shorter ledger tails on busy days"""
+    with app.app_context():
+        rows = take_snapshot(db.session)
+        db.session.commit()
+        print(f"stock_ledger_snapshots: {rows} rows written")
+
+def reconcile_stock_ledger(repair=False):
+    """Check every Stock row against the sum of its ledger; --repair appends the differences"""
+    with app.app_context():
+        mismatches = reconcile(db.session, repair=repair)
+        for m in mismatches:
+            print(f"store {m.store_id} product {m.product_id}: stock {m.stock} ledger {m.ledger} ({m.difference:+})")
+        db.session.commit()
+        if repair:
+            print(f"{len(mismatches)} differences appended to the ledger")
+        else:
+            print(f"{len(mismatches)} differences found")
+        return mismatches
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'checkpoint'
+    if command == 'checkpoint':
+        checkpoint_stock_ledger()
+    elif command == 'snapshot':
+        snapshot_stock_ledger()
+    elif command == 'reconcile':
+        mismatches = reconcile_stock_ledger(repair='--repair' in sys.argv)
+        sys.exit(1 if mismatches and '--repair' not in sys.argv else 0)
+    else:
+        print("usage: stock_ledger_job.py [checkpoint | snapshot | reconcile [--repair]]")
+        sys.exit(2)
@@ -0,0 +1,81 @@
+import os
+import re
+import threading
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import NumberSequence
+
+# Ids handed out per round trip in block mode; 1 keeps numbers gapless and transactional
+DEFAULT_BLOCK_SIZE = int(os.environ.get('SEQUENCE_BLOCK_SIZE', '1'))
+
+
+def max_suffix(column, prefix):
+    """Largest trailing number among values of `column` starting with `prefix` (seed for old data)"""
+    highest = 0
+    # Range instead of LIKE 'prefix%' so the unique index on the column is used
+    # (SQLite's LIKE is case-insensitive and never uses a plain index)
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    for (value,) in db.session.query(column).filter(column >= prefix, column < upper).all():
+        match = re.search(r'(\d+)$', value[len(prefix):] or '')
+        if match:
+            highest = max(highest, int(match.group(1)))
+    return highest
+
+
+class SequenceAllocator:
+    """Hands out increasing integers per key from the number_sequences table.
+
+    With block_size 1 the increment is a single UPDATE inside the caller's
+    transaction: the row lock serializes concurrent workers and a rollback
+    gives the number back. With a larger block size each worker reserves
+    `block_size` numbers in its own short transaction and serves them from
+    memory (numbers may then have gaps and interleave across workers). Block
+    mode needs a server database; on SQLite a second connection would wait
+    on the request's own write lock, so it falls back to single increments.
+
+    A missing key is created from `seed()`, which lets a sequence continue
+    from numbers that were generated before the table existed.
+    """
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = max(1, block_size)
+        self.lock = threading.Lock()
+        self.blocks = {}  # key -> [next value, last value]
+
+    def _increment(self, connection, key, amount, seed):
+        table = NumberSequence.__table__
+        stmt = update(table).where(table.c.key == key).values(value=table.c.value + amount)
+        dialect = connection.get_bind().dialect if hasattr(connection, 'get_bind') else connection.dialect
+        if dialect.update_returning:
+            row = connection.execute(stmt.returning(table.c.value)).first()
+            if row is not None:
+                return row[0]
+        elif connection.execute(stmt).rowcount:
+            return connection.execute(select(table.c.value).where(table.c.key == key)).scalar()
+
+        start = seed() if seed else 0
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table).values(key=key, value=start + amount))
+            return start + amount
+        except IntegrityError:
+            # Another worker created the row first
+            return self._increment(connection, key, amount, None)
+
+    def next(self, key, seed=None):
+        if self.block_size == 1 or db.engine.dialect.name == 'sqlite':
+            return self._increment(db.session, key, 1, seed)
+
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None or block[0] > block[1]:
+                with db.engine.begin() as connection:
+                    last = self._increment(connection, key, self.block_size, seed)
+                block = self.blocks[key] = [last - self.block_size + 1, last]
+            value = block[0]
+            block[0] += 1
+            return value
+
+
+sequence_allocator = SequenceAllocator()
@@ -0,0 +1,242 @@
+import json
+import re
+import threading
+import time
+from datetime import date, datetime
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_THRESHOLD = 10  # same statement this many times in one request is flagged
+HEADER_FINGERPRINTS = 3  # repeated statements listed in the X-SQL-N-Plus-One header
+FINGERPRINT_LENGTH = 160
+TOP_FINGERPRINTS = 10  # repeated statements kept per endpoint in the stats
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = re.compile(r'%\(\w+\)s|:\w+|\$\d+|%s')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+_COLUMNS = re.compile(r'^SELECT .+? FROM ', re.S)
+
+
+def fingerprint(statement):
+    """Statement with literals, parameters and IN lists collapsed, so repeats compare equal"""
+    text = _STRING.sub('?', statement)
+    text = _PARAM.sub('?', text)
+    text = _NUMBER.sub('?', text)
+    text = _LIST.sub('(?)', text)
+    return _SPACE.sub(' ', text).strip()
+
+
+def _capture_value(value):
+    # Bind values as SQLite stores them, so a captured statement can be replayed
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (datetime, date)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return None
+    return str(value)
+
+
+def capture_parameters(parameters):
+    """JSON-safe copy of a statement's parameters (the first row of an executemany)"""
+    if isinstance(parameters, list):
+        parameters = parameters[0] if parameters else ()
+    if isinstance(parameters, dict):
+        return {key: _capture_value(value) for key, value in parameters.items()}
+    return [_capture_value(value) for value in parameters or ()]
+
+
+def summary(fp):
+    """Short form for headers and logs: the column list is dropped, the FROM/WHERE part is what tells queries apart"""
+    return _COLUMNS.sub('SELECT ... FROM ', fp, count=1)[:FINGERPRINT_LENGTH]
+
+
+class RequestProfile:
+    """Queries run while serving one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = {}  # fingerprint -> [count, seconds]
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def repeated(self, threshold):
+        """(fingerprint, count, seconds) run at least `threshold` times, most repeated first"""
+        found = [(fp, count, seconds) for fp, (count, seconds) in self.statements.items() if count >= threshold]
+        return sorted(found, key=lambda item: -item[1])
+
+
+class SqlProfiler:
+    """Per-request SQL counters from the engine events, with an N+1 detector.
+
+    Every statement a request runs is counted and fingerprinted (literals and
+    IN lists collapsed); a fingerprint seen N_PLUS_ONE_THRESHOLD times or more
+    in one request is reported as an N+1. With SQL_CAPTURE_FILE set, the first
+    occurrence of every fingerprint (statement, parameters, endpoint) is
+    appended there as a JSON line: the workload for scripts/advise_indexes.py.
+    SQL_PROFILE config:
+    'headers' adds X-SQL-* response headers (development), 'stats' only
+    aggregates per endpoint (production), 'off' disables it and 'auto'
+    (the default) adds the headers only while the app runs in debug mode.
+    Endpoint stats are kept in every mode but 'off'.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mode = 'auto'
+        self.threshold = N_PLUS_ONE_THRESHOLD
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.reported = set()  # (endpoint, fingerprint) already logged
+        self.capture_path = None
+        self.captured = set()  # fingerprints already written to capture_path
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.get('SQL_PROFILE') or 'auto'
+        self.threshold = int(app.config.get('SQL_N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD))
+        self.capture_path = app.config.get('SQL_CAPTURE_FILE') or None
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    @property
+    def headers(self):
+        # app.debug is only known once the app runs, so 'auto' is decided per request
+        return self.mode == 'headers' or (self.mode == 'auto' and self.app is not None and self.app.debug)
+
+    def _start(self):
+        if self.enabled:
+            g.sql_profile = RequestProfile()
+
+    def _finish(self, response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        repeated = profile.repeated(self.threshold)
+        self._aggregate(endpoint, profile, time.perf_counter() - profile.started, repeated)
+
+        if self.headers:
+            response.headers['X-SQL-Queries'] = str(profile.queries)
+            response.headers['X-SQL-Time'] = f'{profile.seconds * 1000:.1f}ms'
+            if repeated:
+                response.headers['X-SQL-N-Plus-One'] = ' | '.join(
+                    f'{count}x {_header_safe(summary(fp))}' for fp, count, _ in repeated[:HEADER_FINGERPRINTS]
+                )
+        return response
+
+    def _aggregate(self, endpoint, profile, seconds, repeated):
+        new_reports = []
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'queries': 0, 'max_queries': 0, 'db_seconds': 0.0,
+                    'request_seconds': 0.0, 'n_plus_one_requests': 0, 'repeated': {}
+                }
+            stats['requests'] += 1
+            stats['queries'] += profile.queries
+            stats['max_queries'] = max(stats['max_queries'], profile.queries)
+            stats['db_seconds'] += profile.seconds
+            stats['request_seconds'] += seconds
+            if repeated:
+                stats['n_plus_one_requests'] += 1
+            for fp, count, _ in repeated:
+                entry = stats['repeated'].setdefault(fp, {'requests': 0, 'max_repeats': 0})
+                entry['requests'] += 1
+                entry['max_repeats'] = max(entry['max_repeats'], count)
+                if (endpoint, fp) not in self.reported:
+                    self.reported.add((endpoint, fp))
+                    new_reports.append((fp, count))
+            if len(stats['repeated']) > TOP_FINGERPRINTS:
+                keep = sorted(stats['repeated'].items(), key=lambda item: -item[1]['max_repeats'])[:TOP_FINGERPRINTS]
+                stats['repeated'] = dict(keep)
+        for fp, count in new_reports:
+            print(f"N+1 in {endpoint}: {count} x {summary(fp)}")
+
+    def record(self, statement, parameters, seconds):
+        if not has_request_context():
+            return  # background workers and scripts aren't profiled
+        profile = g.get('sql_profile')
+        if profile is not None:
+            fp = fingerprint(statement)
+            profile.record(fp, seconds)
+            if self.capture_path and fp not in self.captured:
+                self._capture(fp, statement, parameters)
+
+    def _capture(self, fp, statement, parameters):
+        line = json.dumps({
+            'fingerprint': fp,
+            'statement': statement,
+            'parameters': capture_parameters(parameters),
+            'endpoint': request.endpoint or 'unmatched'
+        })
+        with self.lock:
+            if fp in self.captured:
+                return
+            self.captured.add(fp)
+            with open(self.capture_path, 'a', encoding='utf-8') as capture:
+                capture.write(line + '\n')
+
+    def stats(self):
+        """Aggregated counters per endpoint, the heaviest DB users first"""
+        with self.lock:
+            endpoints = []
+            for endpoint, stats in self.endpoints.items():
+                requests = stats['requests']
+                endpoints.append({
+                    'endpoint': endpoint,
+                    'requests': requests,
+                    'queries': stats['queries'],
+                    'avg_queries': round(stats['queries'] / requests, 2),
+                    'max_queries': stats['max_queries'],
+                    'db_ms': round(stats['db_seconds'] * 1000, 1),
+                    'avg_db_ms': round(stats['db_seconds'] * 1000 / requests, 2),
+                    'db_share': round(stats['db_seconds'] / stats['request_seconds'], 4) if stats['request_seconds'] else None,
+                    'n_plus_one_requests': stats['n_plus_one_requests'],
+                    'repeated': [{'statement': fp, **entry} for fp, entry in
+                                 sorted(stats['repeated'].items(), key=lambda item: -item[1]['max_repeats'])]
+                })
+        endpoints.sort(key=lambda e: -e['db_ms'])
+        return {'mode': self.mode, 'threshold': self.threshold, 'endpoints': endpoints}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.reported.clear()
+
+
+def _header_safe(text):
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+
+sql_profiler = SqlProfiler()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_profiler_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('sql_profiler_start')
+    if starts:
+        sql_profiler.record(statement, parameters, time.perf_counter() - starts.pop())
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+from extensions import db
+
+# Applied to every new connection. WAL lets readers run while a write
+# transaction is open; synchronous=NORMAL is durable in WAL mode except
+# for the last commits on a power cut (never corrupts the database).
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64000),  # KiB: ~64 MB page cache per connection
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('journal_size_limit', 64 * 1024 * 1024),  # truncate the WAL after checkpoints
+)
+BUSY_TIMEOUT_MS = 30000  # same 30 s as the ?timeout=30 of the default URI
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Whether transactions begun in this context will write. Requests set it
+# from the HTTP method; background workers and scripts default to writing.
+_write_intent = ContextVar('sqlite_write_intent', default=True)
+
+
+class WriteQueueTimeout(Exception):
+    """Raised when a write transaction waited longer than the busy timeout for its turn"""
+
+
+class WriterQueue:
+    """One write transaction at a time per process, first come first served.
+
+    Writers wait here (FIFO) instead of retrying inside SQLite's busy
+    handler, which sleeps with backoff and lets late arrivals overtake.
+    The writer keeps its turn until its connection goes back to the pool
+    (right after COMMIT/ROLLBACK). Other processes are kept in line by
+    BEGIN IMMEDIATE and the busy timeout.
+    """
+
+    def __init__(self, timeout=BUSY_TIMEOUT_MS / 1000):
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.owner = None  # thread holding the turn
+        self.records = set()  # connections (their 'sqlite_writer' token) whose transaction holds it
+        self.transactions = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.max_waiting = 0
+        self.timeouts = 0
+
+    def holds(self):
+        return self.owner is threading.current_thread()
+
+    def acquire(self, writer):
+        me = threading.current_thread()
+        with self.condition:
+            if self.owner is me:
+                self.records.add(writer)
+                return
+            started = time.perf_counter()
+            deadline = started + self.timeout
+            self.waiting.append(me)
+            self.max_waiting = max(self.max_waiting, len(self.waiting))
+            while self.owner is not None or self.waiting[0] is not me:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.waiting.remove(me)
+                    self.timeouts += 1
+                    self.condition.notify_all()
+                    raise WriteQueueTimeout('La base de datos está ocupada, intente nuevamente')
+                self.condition.wait(remaining)
+            self.waiting.popleft()
+            self.owner = me
+            self.records.add(writer)
+            waited = time.perf_counter() - started
+            self.transactions += 1
+            if waited > 0.001:
+                self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self, writer):
+        with self.condition:
+            if writer not in self.records:
+                return
+            self.records.discard(writer)
+            if not self.records:
+                self.owner = None
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'transactions': self.transactions,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.wait_seconds * 1000 / self.transactions, 3) if self.transactions else None,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'waiting': len(self.waiting),
+                'max_waiting': self.max_waiting,
+                'timeouts': self.timeouts
+            }
+
+
+class SqliteProfile:
+    """Production settings for a SQLite database (SQLITE_PROFILE='production', the default).
+
+    - WAL journal and the PRAGMAS above on every connection;
+    - transactions begun with an explicit BEGIN: IMMEDIATE for requests that
+      may write (POST, PUT, PATCH, DELETE; background workers and scripts),
+      DEFERRED for GET/HEAD/OPTIONS, so the write lock is taken up front and
+      with_for_update() (a no-op on SQLite) really serializes read-then-write;
+    - write transactions of the process go through a WriterQueue, so readers
+      never wait and writers get the lock in arrival order.
+
+    SQLITE_PROFILE='off' leaves the driver defaults. Other databases are untouched.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.engine = None
+        self.writers = WriterQueue()
+
+    def init_app(self, app):
+        self.app = app
+        if app.config.get('SQLITE_PROFILE', 'production') == 'off':
+            return
+        with app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'sqlite':
+            return
+        self.engine = engine
+        self.writers.timeout = app.config.get('SQLITE_BUSY_TIMEOUT_MS', BUSY_TIMEOUT_MS) / 1000
+        event.listen(engine, 'connect', self._configure)
+        event.listen(engine, 'begin', self._begin)
+        event.listen(engine, 'checkin', self._checkin)
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    @property
+    def enabled(self):
+        return self.engine is not None
+
+    def _configure(self, dbapi_connection, connection_record):
+        # Transactions are begun explicitly in _begin, not by the driver
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout = {int(self.writers.timeout * 1000)}')
+        for name, value in PRAGMAS:
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    def _begin(self, conn):
+        # Identifies the pooled connection in the writer queue until it is checked in
+        writer = conn.info.setdefault('sqlite_writer', object())
+        if not _write_intent.get():
+            conn.exec_driver_sql('BEGIN')
+        elif self.writers.holds() and writer not in self.writers.records:
+            # This thread already writes through another connection: IMMEDIATE here
+            # would wait for our own lock. Read-only access still works in WAL.
+            conn.exec_driver_sql('BEGIN')
+        else:
+            self.writers.acquire(writer)
+            try:
+                conn.exec_driver_sql('BEGIN IMMEDIATE')
+            except Exception:
+                self.writers.release(writer)
+                raise
+
+    def _checkin(self, dbapi_connection, connection_record):
+        writer = connection_record.info.get('sqlite_writer')
+        if writer is not None:
+            self.writers.release(writer)
+
+    def _start_request(self):
+        g.sqlite_write_intent = _write_intent.set(request.method not in SAFE_METHODS)
+
+    def _end_request(self, exc):
+        token = g.pop('sqlite_write_intent', None)
+        if token is not None:
+            _write_intent.reset(token)
+
+    @contextmanager
+    def write_intent(self, writes=True):
+        """Override the write intent of transactions begun inside the block (e.g. a GET that writes)"""
+        token = _write_intent.set(writes)
+        try:
+            yield
+        finally:
+            _write_intent.reset(token)
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with self.engine.connect() as connection:
+            pragmas = {name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                       for name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')}
+        return {'enabled': True, 'pragmas': pragmas, 'writers': self.writers.stats()}
+
+
+sqlite_profile = SqliteProfile()
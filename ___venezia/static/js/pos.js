@@ -148,6 +148,25 @@ function showQRInModal(qrLink, paymentLink) {
         startPaymentPolling(window.__lastReceiptData.sale_id);
     }
 }
+// Consultar hasta que la cola de pagos genere el link de MercadoPago
+function waitForPaymentLink(saleId, attempt = 0) {
+    fetch(`/api/payment_status/${saleId}`)
+        .then(res => res.json())
+        .then(data => {
+            if (data.payment_link || data.qr_link) {
+                showQRInModal(data.qr_link, data.payment_link);
+            } else if (data.link_status === 'failed') {
+                Swal.fire({
+                    title: 'Link de pago no disponible',
+                    text: data.link_error || 'No se pudo generar el link de MercadoPago',
+                    icon: 'warning'
+                });
+            } else if (attempt < 30) {
+                setTimeout(() => waitForPaymentLink(saleId, attempt + 1), 1000);
+            }
+        })
+        .catch(error => console.error('[POS] esperando link de pago', error));
+}
 let __paymentPollInterval = null;
 function startPaymentPolling(saleId) {
     clearInterval(__paymentPollInterval);
@@ -336,6 +355,9 @@ function processSale() {
                     // Si hay link de pago, mostrar modal con QR y opción de imprimir
                     if (data.payment_link || data.qr_link) {
                         showQRInModal(data.qr_link, data.payment_link);
+                    } else if (data.payment_link_pending) {
+                        // El link de MercadoPago se genera en segundo plano
+                        waitForPaymentLink(data.sale_id);
                     }
                 });
         } else {
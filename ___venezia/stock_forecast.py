@@ -0,0 +1,286 @@
+import threading
+import time as time_module
+from datetime import date, datetime, time, timedelta
+import numpy as np
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from extensions import db
+from analytics_replica import analytics_replica
+from models import Product, Stock, StockHistory, Store
+
+SALE_REASON_PREFIX = 'Venta #'  # stock_reservation logs sales as 'Venta #<sale id>'
+HISTORY_DAYS = 90
+SMOOTHING_ALPHA = 0.2  # weight of the latest day in the exponential smoothing
+SEASON_SHRINK_WEEKS = 4  # weekday factors lean towards 1 until about this many weeks of data
+MIN_FACTOR = 1e-6
+
+
+def utc_today():
+    """StockHistory timestamps are UTC, so days are UTC days"""
+    return datetime.utcnow().date()
+
+
+class SalesHistory:
+    """Units sold per (store, product) and day, as a dense pairs x days matrix"""
+
+    def __init__(self, pairs, start, quantities, first_day):
+        self.pairs = pairs  # int array (n, 2): store_id, product_id
+        self.start = start  # numpy datetime64[D] of column 0
+        self.quantities = quantities  # float array (n, days), units sold (positive)
+        self.first_day = first_day  # int array (n,): first column where the pair sold
+
+    @property
+    def days(self):
+        return self.quantities.shape[1]
+
+    def weekdays(self):
+        """Weekday (Monday = 0) of every column"""
+        return (self.start.astype(np.int64) + 3 + np.arange(self.days)) % 7
+
+
+def _query_daily_sales(start, end=None):
+    """(store ids, product ids, day numbers, units sold) summed per day for [start, end)"""
+    day = func.date(StockHistory.timestamp)
+    query = select(
+        StockHistory.store_id, StockHistory.product_id, day, func.sum(StockHistory.quantity_change)
+    ).where(
+        StockHistory.timestamp >= datetime.combine(start, time.min),
+        StockHistory.reason.like(f'{SALE_REASON_PREFIX}%'),
+        StockHistory.quantity_change < 0
+    ).group_by(StockHistory.store_id, StockHistory.product_id, day)
+    if end is not None:
+        query = query.where(StockHistory.timestamp < datetime.combine(end, time.min))
+    rows = db.session.execute(query).all()
+    if not rows:
+        return EMPTY_ROWS
+    store_ids, product_ids, days, sold = zip(*rows)
+    return (
+        np.array(store_ids, dtype=np.int64),
+        np.array(product_ids, dtype=np.int64),
+        np.array([str(value)[:10] for value in days], dtype='datetime64[D]').astype(np.int64),
+        -np.array(sold, dtype=float)
+    )
+
+
+EMPTY_ROWS = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+
+
+class DailySalesCache:
+    """Per-day sales sums of closed days, kept per process.
+
+    Past days of StockHistory don't change when sales are logged, so a
+    window only queries the days after the cached range (normally just
+    today). Deleting or back-dating history rows clears the cache on commit;
+    it is also rebuilt after MAX_AGE_SECONDS to pick up such writes from
+    other processes.
+    """
+
+    MAX_AGE_SECONDS = 6 * 3600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.first = None  # first cached day (date)
+        self.end = None  # first day not cached
+        self.rows = EMPTY_ROWS
+        self.loaded_at = 0
+
+    def clear(self):
+        with self.lock:
+            self._reset()
+
+    def window(self, start, today):
+        """Daily rows for [start, today], today always read fresh"""
+        if analytics_replica.active():
+            snapshot = analytics_replica.snapshot_time()
+            if snapshot is None or snapshot.date() < today:
+                # Copied before today began: the replica may miss the end of yesterday, don't cache it
+                return tuple(np.concatenate([a, b]) for a, b in zip(_query_daily_sales(start, today),
+                                                                     _query_daily_sales(today)))
+        with self.lock:
+            if self.first is None or start < self.first or time_module.monotonic() - self.loaded_at > self.MAX_AGE_SECONDS:
+                self.rows = _query_daily_sales(start, today)
+                self.first, self.end = start, today
+                self.loaded_at = time_module.monotonic()
+            elif self.end < today:
+                extra = _query_daily_sales(self.end, today)
+                self.rows = tuple(np.concatenate([a, b]) for a, b in zip(self.rows, extra))
+                self.end = today
+            cached = self.rows
+        fresh = _query_daily_sales(today)
+        keep = cached[2] >= np.datetime64(start, 'D').astype(np.int64)
+        return tuple(np.concatenate([a[keep], b]) for a, b in zip(cached, fresh))
+
+
+daily_sales_cache = DailySalesCache()
+
+
+def load_history(days=HISTORY_DAYS, store_id=None, product_id=None, today=None):
+    """Sales StockHistory of the last `days` days as a SalesHistory matrix"""
+    today = today or utc_today()
+    start = today - timedelta(days=days - 1)
+    store_ids, product_ids, day_numbers, sold = daily_sales_cache.window(start, today)
+    keep = np.ones(len(sold), dtype=bool)
+    if store_id:
+        keep &= store_ids == store_id
+    if product_id:
+        keep &= product_ids == product_id
+
+    start = np.datetime64(start, 'D')
+    columns = day_numbers[keep] - start.astype(np.int64)
+    if not keep.any():
+        return SalesHistory(np.empty((0, 2), dtype=np.int64), start, np.empty((0, days)), np.empty(0, dtype=np.int64))
+
+    keys = np.column_stack([store_ids[keep], product_ids[keep]])
+    pairs, row_pair = np.unique(keys, axis=0, return_inverse=True)
+    row_pair = row_pair.reshape(-1)
+    quantities = np.zeros((len(pairs), days))
+    np.add.at(quantities, (row_pair, columns), sold[keep])
+    first_day = np.full(len(pairs), days, dtype=np.int64)
+    np.minimum.at(first_day, row_pair, columns)
+    return SalesHistory(pairs, start, quantities, first_day)
+
+
+class DepletionForecast:
+    """Smoothed daily demand and weekday profile per (store, product).
+
+    `level` is the demand of an average day: the exponentially smoothed
+    (alpha = SMOOTHING_ALPHA) series of deseasonalized daily sales, counted
+    from the first day the pair sold. `factors` scale it per weekday; they are
+    shrunk towards 1 while there are few weeks of data and average 1 over
+    the week. Everything is computed for all pairs at once.
+    """
+
+    def __init__(self, history, alpha=SMOOTHING_ALPHA, shrink_weeks=SEASON_SHRINK_WEEKS):
+        self.pairs = history.pairs
+        n, days = history.quantities.shape
+        if n == 0:
+            self.level = np.zeros(0)
+            self.factors = np.ones((0, 7))
+            return
+
+        sold = history.quantities
+        active = np.arange(days)[None, :] >= history.first_day[:, None]
+        weekday = history.weekdays()
+        onehot = np.eye(7)[weekday]  # (days, 7)
+
+        # Weekday profile: mean sales per weekday relative to the overall mean
+        sums = (sold * active) @ onehot
+        counts = active.astype(float) @ onehot
+        overall = np.divide(sums.sum(1), counts.sum(1), out=np.zeros(n), where=counts.sum(1) > 0)
+        per_day = np.divide(sums, counts, out=np.zeros((n, 7)), where=counts > 0)
+        raw = np.divide(per_day, overall[:, None], out=np.ones((n, 7)), where=overall[:, None] > 0)
+        weight = counts / (counts + shrink_weeks)
+        factors = weight * raw + (1 - weight)
+        factors /= factors.mean(1, keepdims=True)
+        self.factors = np.maximum(factors, MIN_FACTOR)
+
+        # Normalized exponential smoothing of the deseasonalized series, newest day weighs most
+        deseasonalized = sold / self.factors[:, weekday]
+        decay = (1 - alpha) ** np.arange(days - 1, -1, -1)
+        weights = decay[None, :] * active
+        self.level = np.divide((deseasonalized * weights).sum(1), weights.sum(1),
+                               out=np.zeros(n), where=weights.sum(1) > 0)
+
+    def demand(self, start_day, days=7):
+        """Expected sales for `days` days from `start_day`: array (n, days)"""
+        start = np.datetime64(start_day, 'D').astype(np.int64)
+        weekday = (start + 3 + np.arange(days)) % 7
+        return self.level[:, None] * self.factors[:, weekday]
+
+    def days_until_empty(self, quantities, today=None):
+        """Days until each pair's stock runs out at the forecast demand (inf if it doesn't sell)"""
+        stock = np.maximum(np.asarray(quantities, dtype=float), 0)
+        week = self.demand(today or utc_today(), 7)
+        weekly = week.sum(1)
+        result = np.full(len(stock), np.inf)
+        selling = weekly > 0
+        if not selling.any():
+            return result
+
+        # Whole weeks first, then walk the remaining stock through the next week's profile
+        full_weeks = np.floor(stock[selling] / weekly[selling])
+        remainder = stock[selling] - full_weeks * weekly[selling]
+        cumulative = np.cumsum(week[selling], axis=1)
+        day = np.argmax(cumulative >= remainder[:, None] - 1e-9, axis=1)
+        rows = np.arange(len(day))
+        before = cumulative[rows, day] - week[selling][rows, day]
+        fraction = np.divide(remainder - before, week[selling][rows, day],
+                             out=np.zeros(len(day)), where=week[selling][rows, day] > 0)
+        result[selling] = full_weeks * 7 + day + fraction
+        return result
+
+
+def depletion_forecast(store_id=None, product_id=None, days=HISTORY_DAYS, today=None):
+    """Forecast for every (store, product) with sales in the window, soonest to run out first"""
+    today = today or utc_today()
+    history = load_history(days, store_id, product_id, today)
+    forecast = DepletionForecast(history)
+    if not len(forecast.pairs):
+        return []
+
+    stock = {(row.store_id, row.product_id): float(row.quantity or 0) for row in db.session.execute(
+        select(Stock.store_id, Stock.product_id, Stock.quantity).where(
+            Stock.store_id.in_({int(s) for s in forecast.pairs[:, 0]}),
+            Stock.product_id.in_({int(p) for p in forecast.pairs[:, 1]})
+        )
+    )}
+    quantities = np.array([stock.get((int(s), int(p)), 0.0) for s, p in forecast.pairs])
+    remaining = forecast.days_until_empty(quantities, today)
+    next_week = forecast.demand(today, 7).sum(1)
+
+    store_names = dict(db.session.execute(select(Store.id, Store.name)).all())
+    product_names = dict(db.session.execute(
+        select(Product.id, Product.name).where(Product.id.in_({int(p) for p in forecast.pairs[:, 1]}))
+    ).all())
+
+    results = []
+    for i, (s, p) in enumerate(forecast.pairs):
+        s, p = int(s), int(p)
+        days_left = float(remaining[i])
+        results.append({
+            'store_id': s,
+            'product_id': p,
+            'store_name': store_names.get(s),
+            'product': product_names.get(p),
+            'current_quantity': float(quantities[i]),
+            'daily_rate': round(float(forecast.level[i]), 4),
+            'next_7_days': round(float(next_week[i]), 4),
+            'days_until_empty': days_left,
+            # Slow movers can last past date.max
+            'predicted_date': today + timedelta(days=days_left) if days_left <= (date.max - today).days else None
+        })
+    results.sort(key=lambda r: (r['days_until_empty'], r['store_id'], r['product_id']))
+    return results
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_history_changes(session, flush_context):
+    # Sales are logged with the current time; deleted or back-dated rows change closed days
+    today = datetime.combine(utc_today(), time.min)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, StockHistory) and (obj in session.deleted or obj.timestamp is None or obj.timestamp < today):
+            session.info['stock_forecast'] = True
+            return
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _watch_bulk_history_writes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if table is not None and getattr(table, 'name', None) == StockHistory.__tablename__:
+        orm_execute_state.session.info['stock_forecast'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_history_changes(session):
+    if session.info.pop('stock_forecast', None):
+        daily_sales_cache.clear()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_history_changes(session):
+    session.info.pop('stock_forecast', None)
@@ -0,0 +1,227 @@
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+from sqlalchemy import delete, event, func, inspect as sa_inspect, insert, select, union_all
+from sqlalchemy.orm import Session
+from models import Stock, StockHistory, StockLedgerSnapshot
+
+# Snapshots fold only history older than this, so a transaction that logged a
+# movement just before the snapshot but commits after it is never missed.
+SNAPSHOT_LAG = timedelta(minutes=5)
+TOLERANCE = 1e-6  # kg
+EPOCH = datetime(1970, 1, 1)
+ADJUSTMENT_REASON = 'Ajuste de stock'
+RECONCILIATION_REASON = 'Conciliación de stock'
+
+Mismatch = namedtuple('Mismatch', ['store_id', 'product_id', 'stock', 'ledger', 'difference'])
+
+
+class LedgerError(Exception):
+    """Raised when code tries to rewrite stock_history instead of appending to it"""
+
+
+# -- snapshots -------------------------------------------------------------
+#
+# A snapshot (checkpoint) holds the stock of every store and product at
+# taken_at, so the quantity at any instant is the latest checkpoint before it
+# plus the ledger rows after it. Checkpoints are taken at every UTC midnight
+# (take_daily_checkpoints) and optionally more often; the tail is then at most
+# a day of ledger, read through the timestamp indexes.
+
+def _checkpoint_before(at):
+    """Scalar subquery: newest checkpoint time at or before `at` (NULL if none)"""
+    return select(func.max(StockLedgerSnapshot.taken_at)).where(StockLedgerSnapshot.taken_at <= at)\
+        .scalar_subquery()
+
+
+def _fold_query(at, store_ids=None, product_ids=None):
+    """One grouped query: checkpoint rows + ledger tail, summed per (store, product)"""
+    checkpoint = _checkpoint_before(at)
+    base = select(StockLedgerSnapshot.store_id, StockLedgerSnapshot.product_id,
+                  StockLedgerSnapshot.quantity.label('quantity'))\
+        .where(StockLedgerSnapshot.taken_at == checkpoint)
+    tail = select(StockHistory.store_id, StockHistory.product_id, StockHistory.quantity_change.label('quantity'))\
+        .where(StockHistory.timestamp > func.coalesce(checkpoint, EPOCH), StockHistory.timestamp <= at)
+    if store_ids is not None:
+        base = base.where(StockLedgerSnapshot.store_id.in_(store_ids))
+    if product_ids is not None:
+        base = base.where(StockLedgerSnapshot.product_id.in_(product_ids))
+        # (store, product, timestamp) index: one short range per product
+        tail = tail.where(StockHistory.product_id.in_(product_ids))
+        if store_ids is not None:
+            tail = tail.where(StockHistory.store_id.in_(store_ids))
+    elif store_ids is not None:
+        # Whole stores: `+ 0` keeps the planner off the (store, product, timestamp)
+        # index, whose store prefix spans the whole history, so the tail is read
+        # through the timestamp index (at most a day since the checkpoint)
+        tail = tail.where((StockHistory.store_id + 0).in_(store_ids))
+    movements = union_all(base, tail).subquery()
+    return select(movements.c.store_id, movements.c.product_id, func.sum(movements.c.quantity))\
+        .group_by(movements.c.store_id, movements.c.product_id)
+
+
+def stock_matrix(session, at, store_ids=None, product_ids=None):
+    """{(store_id, product_id): quantity} at `at`, from the ledger in a single query"""
+    return {(store_id, product_id): round(float(quantity or 0), 6)
+            for store_id, product_id, quantity in session.execute(_fold_query(at, store_ids, product_ids))}
+
+
+def stock_at(session, store_id, at, product_ids=None):
+    """{product_id: quantity} of a store at any point in time, from the ledger"""
+    quantities = stock_matrix(session, at, [int(store_id)], product_ids)
+    return {product_id: quantity for (_, product_id), quantity in quantities.items()}
+
+
+def checkpoint_before(session, at):
+    """Time of the checkpoint a point-in-time read at `at` starts from (None: the whole ledger)"""
+    return session.execute(select(_checkpoint_before(at))).scalar()
+
+
+def take_snapshot(session, at=None):
+    """Checkpoint every store and product at `at` (capped at now - SNAPSHOT_LAG); the caller commits.
+
+    Returns the number of rows written, 0 if a checkpoint already exists at that time.
+    """
+    at = min(at or datetime.utcnow(), datetime.utcnow() - SNAPSHOT_LAG)
+    if session.execute(select(StockLedgerSnapshot.id).where(StockLedgerSnapshot.taken_at == at).limit(1)).first():
+        return 0
+    rows = [{'store_id': store_id, 'product_id': product_id, 'taken_at': at, 'quantity': quantity}
+            for (store_id, product_id), quantity in stock_matrix(session, at).items()]
+    if rows:
+        session.execute(insert(StockLedgerSnapshot.__table__), rows)
+    return len(rows)
+
+
+def take_daily_checkpoints(session, until=None):
+    """Checkpoint every UTC midnight missing since the last checkpoint (or the first ledger day).
+
+    Each one folds only the day since the previous checkpoint. Returns the
+    number of checkpoints taken; the caller commits.
+    """
+    until = min(until or datetime.utcnow(), datetime.utcnow() - SNAPSHOT_LAG)
+    last = session.execute(select(func.max(StockLedgerSnapshot.taken_at))).scalar()
+    if last is None:
+        last = session.execute(select(func.min(StockHistory.timestamp))).scalar()
+        if last is None:
+            return 0
+    day = datetime.combine(last.date(), time.min) + timedelta(days=1)
+    taken = 0
+    while day <= until:
+        take_snapshot(session, at=day)
+        session.flush()
+        taken += 1
+        day += timedelta(days=1)
+    return taken
+
+
+# -- reconciliation --------------------------------------------------------
+
+def reconcile(session, store_id=None, repair=False):
+    """Compare every Stock row with the sum of its ledger, in one grouped query.
+
+    With repair=True the differences are appended to the ledger as
+    RECONCILIATION_REASON rows (the opening balance for stock that predates
+    the ledger), so both agree again; the caller commits.
+    """
+    ledger = select(
+        StockHistory.store_id, StockHistory.product_id, func.sum(StockHistory.quantity_change).label('total')
+    ).group_by(StockHistory.store_id, StockHistory.product_id).subquery()
+    query = select(
+        Stock.store_id, Stock.product_id, Stock.quantity, func.coalesce(ledger.c.total, 0).label('ledger')
+    ).outerjoin(ledger, (ledger.c.store_id == Stock.store_id) & (ledger.c.product_id == Stock.product_id))\
+     .where(func.abs(func.coalesce(Stock.quantity, 0) - func.coalesce(ledger.c.total, 0)) > TOLERANCE)
+    if store_id is not None:
+        query = query.where(Stock.store_id == store_id)
+
+    mismatches = [
+        Mismatch(row.store_id, row.product_id, float(row.quantity or 0), float(row.ledger),
+                 round(float(row.quantity or 0) - float(row.ledger), 6))
+        for row in session.execute(query)
+    ]
+    if repair and mismatches:
+        now = datetime.utcnow()
+        session.execute(insert(StockHistory.__table__), [{
+            'store_id': m.store_id,
+            'product_id': m.product_id,
+            'quantity_change': m.difference,
+            'reason': RECONCILIATION_REASON,
+            'timestamp': now
+        } for m in mismatches])
+    return mismatches
+
+
+def delete_store_ledger(session, store_id):
+    """Drop a store's ledger and snapshots (the store itself is being deleted)"""
+    session.execute(delete(StockLedgerSnapshot).where(StockLedgerSnapshot.store_id == store_id))
+    session.execute(delete(StockHistory).where(StockHistory.store_id == store_id)
+                    .execution_options(stock_ledger_handled=True))
+
+
+# -- keeping the ledger complete -------------------------------------------
+
+def _previous_quantity(session, stock):
+    history = sa_inspect(stock).attrs.quantity.history
+    if history.deleted:
+        return float(history.deleted[0] or 0)
+    # Assigned without being loaded first: the database still has the old value
+    return float(session.connection().scalar(select(Stock.quantity).where(Stock.id == stock.id)) or 0)
+
+
+@event.listens_for(Session, 'before_flush')
+def _append_missing_movements(session, flush_context, instances):
+    """Every ORM change to Stock.quantity gets its ledger row.
+
+    Callers that log a movement themselves (with a meaningful reason) add
+    their StockHistory in the same flush; only the part of the change they
+    didn't log is appended, as ADJUSTMENT_REASON.
+    """
+    for obj in session.dirty:
+        if isinstance(obj, StockHistory) and session.is_modified(obj):
+            raise LedgerError('stock_history es de solo inserción')
+
+    changes = {}
+    for obj in session.new:
+        if isinstance(obj, Stock) and obj.quantity:
+            key = (obj.store_id, obj.product_id)
+            changes[key] = changes.get(key, 0) + float(obj.quantity)
+    for obj in session.dirty:
+        if isinstance(obj, Stock) and sa_inspect(obj).attrs.quantity.history.has_changes():
+            key = (obj.store_id, obj.product_id)
+            changes[key] = changes.get(key, 0) + float(obj.quantity or 0) - _previous_quantity(session, obj)
+    for obj in session.deleted:
+        if isinstance(obj, Stock):
+            key = (obj.store_id, obj.product_id)
+            changes[key] = changes.get(key, 0) - _previous_quantity(session, obj)
+    if not changes:
+        return
+
+    for obj in session.new:
+        if isinstance(obj, StockHistory) and (obj.store_id, obj.product_id) in changes:
+            changes[(obj.store_id, obj.product_id)] -= float(obj.quantity_change or 0)
+    for (store_id, product_id), missing in changes.items():
+        if abs(missing) > TOLERANCE:
+            session.add(StockHistory(store_id=store_id, product_id=product_id, quantity_change=round(missing, 6),
+                                     reason=ADJUSTMENT_REASON))
+
+
+@event.listens_for(Session, 'after_flush')
+def _drop_outdated_snapshots(session, flush_context):
+    # A movement logged in the past changes the checkpoints taken after it
+    horizon = datetime.utcnow() - SNAPSHOT_LAG
+    backdated = [obj.timestamp for obj in session.new
+                 if isinstance(obj, StockHistory) and obj.timestamp is not None and obj.timestamp <= horizon]
+    if backdated:
+        session.connection().execute(delete(StockLedgerSnapshot.__table__).where(
+            StockLedgerSnapshot.__table__.c.taken_at >= min(backdated)
+        ))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _guard_bulk_history_writes(orm_execute_state):
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if table is None or getattr(table, 'name', None) != StockHistory.__tablename__:
+        return
+    if orm_execute_state.is_update:
+        raise LedgerError('stock_history es de solo inserción')
+    if orm_execute_state.is_delete and not orm_execute_state.execution_options.get('stock_ledger_handled'):
+        # Unknown rows are gone: no snapshot can be trusted any more
+        orm_execute_state.session.execute(delete(StockLedgerSnapshot))
@@ -0,0 +1,159 @@
+from datetime import datetime
+from sqlalchemy import bindparam, insert, update
+from extensions import db
+from models import Product, Stock, StockHistory, SaleItem
+from stock_snapshot import stage_deltas
+from flavor_affinity import record_sale_items
+
+
+class StockConflictError(Exception):
+    """Raised when stock changed between validation and the bulk decrement"""
+
+
+class ReservationResult:
+    def __init__(self, store_id, demand, rows):
+        self.store_id = store_id
+        self.demand = demand  # product_id -> total quantity requested
+        self.rows = rows  # product_id -> (stock_id, quantity, product_name)
+        self.shortfalls = []
+
+    @property
+    def ok(self):
+        return not self.shortfalls
+
+    @property
+    def product_names(self):
+        return {product_id: row[2] for product_id, row in self.rows.items()}
+
+    @property
+    def error_messages(self):
+        """Human readable messages, one per product with a shortfall"""
+        messages = []
+        for shortfall in self.shortfalls:
+            if shortfall['available'] is None:
+                messages.append(f"Product {shortfall['product_id']} not found in stock")
+            else:
+                messages.append(f"No hay stock suficiente de {shortfall['product_name']}")
+        return messages
+
+
+class StockReservationEngine:
+    """Validates and decrements the stock of a whole cart with set-based statements.
+
+    A sale touches the database with one locked SELECT over the cart's products,
+    one conditional bulk UPDATE and one bulk INSERT per child table, instead of
+    a lookup, an update and two inserts per cart line.
+    """
+
+    def __init__(self, session=None):
+        self.session = session or db.session
+
+    @staticmethod
+    def aggregate(lines):
+        """Sum the requested quantity per product, keeping the cart order"""
+        demand = {}
+        line_indexes = {}
+        for idx, line in enumerate(lines):
+            product_id = int(line['product_id'])
+            demand[product_id] = demand.get(product_id, 0) + float(line['quantity'])
+            line_indexes.setdefault(product_id, []).extend(line.get('cart_lines', [idx]))
+        return demand, line_indexes
+
+    def load(self, store_id, product_ids, lock=True):
+        """Fetch (and lock) the stock rows of every product in one query"""
+        if not product_ids:
+            return {}
+        query = self.session.query(
+            Stock.product_id, Stock.id, Stock.quantity, Product.name
+        ).join(
+            Product, Product.id == Stock.product_id
+        ).filter(
+            Stock.store_id == store_id,
+            Stock.product_id.in_(product_ids)
+        )
+        if lock:
+            query = query.with_for_update(of=Stock)
+        rows = query.all()
+        return {row.product_id: (row.id, row.quantity, row.name) for row in rows}
+
+    def check(self, store_id, lines, lock=True):
+        """Validate all lines against current stock without modifying it"""
+        demand, line_indexes = self.aggregate(lines)
+        result = ReservationResult(store_id, demand, self.load(store_id, list(demand), lock=lock))
+
+        for product_id, requested in demand.items():
+            row = result.rows.get(product_id)
+            available = row[1] if row else None
+            if row is None or available is None or available < requested:
+                result.shortfalls.append({
+                    'product_id': product_id,
+                    'product_name': row[2] if row else None,
+                    'requested': requested,
+                    'available': available if row else None,
+                    'missing': requested - (available or 0),
+                    'lines': line_indexes[product_id]
+                })
+        return result
+
+    def reserve(self, store_id, lines, reason):
+        """Validate and decrement the stock for all lines, writing history rows.
+
+        Returns a ReservationResult; when it has shortfalls nothing is written.
+        Raises StockConflictError if a concurrent sale consumed the stock after
+        validation, in which case the caller must roll back the transaction.
+        """
+        result = self.check(store_id, lines)
+        if not result.ok or not result.demand:
+            return result
+
+        now = datetime.utcnow()
+        stocks = Stock.__table__
+        decrement = update(stocks).where(
+            stocks.c.id == bindparam('stock_id'),
+            stocks.c.quantity >= bindparam('delta')
+        ).values(
+            quantity=stocks.c.quantity - bindparam('delta'),
+            updated_at=now
+        )
+        params = [
+            {'stock_id': result.rows[product_id][0], 'delta': quantity}
+            for product_id, quantity in result.demand.items()
+        ]
+        updated = self.session.execute(decrement.execution_options(stock_snapshot_staged=True), params)
+        if updated.rowcount != len(params):
+            raise StockConflictError('El stock cambió durante la venta, intente nuevamente')
+
+        self.session.execute(insert(StockHistory.__table__), [
+            {
+                'store_id': store_id,
+                'product_id': product_id,
+                'quantity_change': -quantity,
+                'reason': reason,
+                'timestamp': now
+            }
+            for product_id, quantity in result.demand.items()
+        ])
+        stage_deltas(self.session, store_id, {product_id: -quantity for product_id, quantity in result.demand.items()})
+        return result
+
+    def insert_sale_items(self, sale_id, cart):
+        """Bulk insert the sale items for a cart"""
+        rows = []
+        now = datetime.utcnow()
+        for item in cart:
+            flavors = item.get('flavors')
+            rows.append({
+                'sale_id': sale_id,
+                'product_id': int(item['product_id']),
+                'quantity': float(item['quantity']),
+                'unit_price': float(item['unit_price']),
+                'total_price': float(item['total_price']),
+                'flavors': SaleItem.encode_flavors(flavors),
+                'created_at': now
+            })
+        if rows:
+            self.session.execute(insert(SaleItem.__table__), rows)
+            record_sale_items(self.session, rows)
+
+
+stock_engine = StockReservationEngine()
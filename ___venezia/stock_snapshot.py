@@ -0,0 +1,232 @@
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+from sqlalchemy.sql.elements import ClauseElement
+from extensions import db
+from models import Stock
+from sqlite_profile import sqlite_profile
+
+MAX_AGE_SECONDS = 60  # reload a store after this long to pick up writes from other workers
+
+SHARED_CONNECTION_POOLS = (SingletonThreadPool, StaticPool)
+
+StockLevel = namedtuple('StockLevel', ['quantity', 'minimum', 'version'])
+
+
+class StockSnapshot:
+    """Process-wide cache of stock levels: store_id -> product_id -> StockLevel.
+
+    Each store is loaded with a single query on first read. Writes are applied
+    write-through when the transaction commits: ORM changes to Stock rows are
+    collected in after_flush, set-based updates are staged explicitly by
+    stock_reservation and batch_distribution, and any other bulk
+    INSERT/UPDATE/DELETE on stocks drops the cached stores so they reload. Every store carries a version that is bumped
+    on each applied change; a StockLevel remembers the version it was written
+    at, so callers can detect that a value they hold has gone stale.
+    """
+
+    def __init__(self, max_age=MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.stores = {}  # store_id -> {'levels': {...}, 'version': int, 'loaded_at': float}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+        # Bumped by every applied change, cached or not: a load that saw them move doesn't get cached
+        self.changes = {}  # store_id -> count
+        self.epoch = 0  # bulk writes of unknown stores
+
+    # -- reads -------------------------------------------------------------
+
+    def _load(self, store_id):
+        # Never cache what this session wrote but has not committed yet
+        own_writes = db.session.info.get('stock_snapshot') or any(
+            isinstance(obj, Stock) for obj in list(db.session.new) + list(db.session.dirty) + list(db.session.deleted)
+        )
+        if own_writes:
+            return self._install(store_id, db.session.execute(self._query(store_id)).all(), cache=False)
+        with self.lock:
+            seen = (self.epoch, self.changes.get(store_id, 0))
+        if isinstance(db.engine.pool, SHARED_CONNECTION_POOLS):
+            # One connection per thread (in-memory SQLite): a second one would end the session's transaction
+            rows = db.session.execute(self._query(store_id)).all()
+        else:
+            # A read transaction of its own: its snapshot starts after `seen` (the request's may have
+            # started earlier), and it reads the primary even inside an analytics replica request
+            with sqlite_profile.write_intent(False), db.engine.connect() as connection:
+                rows = connection.execute(self._query(store_id)).all()
+        with self.lock:
+            # A commit applied meanwhile may be missing from these rows
+            return self._install(store_id, rows, cache=(self.epoch, self.changes.get(store_id, 0)) == seen)
+
+    @staticmethod
+    def _query(store_id):
+        return select(Stock.product_id, Stock.quantity, Stock.minimum_quantity).where(Stock.store_id == store_id)
+
+    def _install(self, store_id, rows, cache):
+        with self.lock:
+            previous = self.stores.get(store_id)
+            version = previous['version'] + 1 if previous else 1
+            entry = {
+                'levels': {row.product_id: StockLevel(float(row.quantity or 0), float(row.minimum_quantity or 0), version)
+                           for row in rows},
+                'version': version,
+                'loaded_at': time.monotonic()
+            }
+            self.loads += 1
+            if cache:
+                self.stores[store_id] = entry
+            return entry
+
+    def _entry(self, store_id):
+        store_id = int(store_id)
+        with self.lock:
+            entry = self.stores.get(store_id)
+            if entry and time.monotonic() - entry['loaded_at'] <= self.max_age:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return self._load(store_id)
+
+    def store(self, store_id):
+        """All stock levels of a store as {product_id: StockLevel}"""
+        return self._entry(store_id)['levels']
+
+    def get(self, store_id, product_id):
+        """StockLevel for one product, or None if the store has no stock row for it"""
+        return self.store(store_id).get(int(product_id))
+
+    def quantity(self, store_id, product_id, default=0.0):
+        level = self.get(store_id, product_id)
+        return level.quantity if level else default
+
+    def version(self, store_id):
+        return self._entry(store_id)['version']
+
+    def is_stale(self, store_id, level):
+        """True if the store changed after `level` was read"""
+        with self.lock:
+            entry = self.stores.get(int(store_id))
+            return entry is None or entry['version'] != level.version
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'loads': self.loads,
+                'invalidations': self.invalidations,
+                'stores_cached': len(self.stores),
+                'versions': {store_id: entry['version'] for store_id, entry in self.stores.items()}
+            }
+
+    # -- writes ------------------------------------------------------------
+
+    def apply(self, changes):
+        """Apply committed changes: {'set': {...}, 'delta': {...}, 'drop': set(), 'drop_all': bool}"""
+        with self.lock:
+            touched = {key[0] for key in changes['set']} | {key[0] for key in changes['delta']}
+            for store_id in touched | changes['drop']:
+                self.changes[store_id] = self.changes.get(store_id, 0) + 1
+            if changes['drop_all']:
+                self.epoch += 1
+                self.invalidations += len(self.stores)
+                self.stores.clear()
+                return
+            for store_id in changes['drop']:
+                if self.stores.pop(store_id, None) is not None:
+                    self.invalidations += 1
+
+            for store_id in touched:
+                entry = self.stores.get(store_id)
+                if entry is None:
+                    continue  # not cached, will be loaded fresh on next read
+                entry['version'] += 1
+                version = entry['version']
+                levels = entry['levels']
+                for (s_id, product_id), value in changes['set'].items():
+                    if s_id != store_id:
+                        continue
+                    if value is None:
+                        levels.pop(product_id, None)
+                    else:
+                        levels[product_id] = StockLevel(value[0], value[1], version)
+                for (s_id, product_id), delta in changes['delta'].items():
+                    if s_id != store_id:
+                        continue
+                    level = levels.get(product_id)
+                    if level is None:
+                        # Row unknown to this snapshot: reload the store on next read
+                        self.stores.pop(store_id, None)
+                        self.invalidations += 1
+                        break
+                    levels[product_id] = StockLevel(round(level.quantity + delta, 4), level.minimum, version)
+
+    def clear(self):
+        with self.lock:
+            self.stores.clear()
+
+
+stock_snapshot = StockSnapshot()
+
+
+def _pending(session):
+    return session.info.setdefault('stock_snapshot', {'set': {}, 'delta': {}, 'drop': set(), 'drop_all': False})
+
+
+def stage_deltas(session, store_id, deltas):
+    """Stage quantity deltas applied with a set-based UPDATE, published on commit"""
+    pending = _pending(session)
+    for product_id, delta in deltas.items():
+        key = (int(store_id), int(product_id))
+        pending['delta'][key] = pending['delta'].get(key, 0) + delta
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_stock_changes(session, flush_context):
+    changed = [obj for obj in list(session.new) + list(session.dirty) if isinstance(obj, Stock)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Stock)]
+    if not changed and not deleted:
+        return
+    pending = _pending(session)
+    for obj in changed:
+        key = (obj.store_id, obj.product_id)
+        quantity, minimum = obj.quantity, obj.minimum_quantity
+        if isinstance(quantity, ClauseElement) or isinstance(minimum, ClauseElement):
+            pending['drop'].add(obj.store_id)
+            continue
+        pending['set'][key] = (float(quantity or 0), float(minimum or 0))
+        pending['delta'].pop(key, None)
+    for obj in deleted:
+        pending['set'][(obj.store_id, obj.product_id)] = None
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _watch_bulk_stock_writes(orm_execute_state):
+    # Bulk INSERT/UPDATE/DELETE on stocks outside the staged paths: drop the cached stores
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    if orm_execute_state.execution_options.get('stock_snapshot_staged'):
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if table is None or getattr(table, 'name', None) != Stock.__tablename__:
+        return
+    _pending(orm_execute_state.session)['drop_all'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_stock_changes(session):
+    changes = session.info.pop('stock_snapshot', None)
+    if changes:
+        stock_snapshot.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_stock_changes(session):
+    session.info.pop('stock_snapshot', None)
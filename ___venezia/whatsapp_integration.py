@@ -2,6 +2,7 @@ import requests
 import os
 from datetime import datetime
 from models import DeliveryOrder, db
+from metrics import metrics
 
 class WhatsAppIntegration:
     def __init__(self):
@@ -47,7 +48,8 @@ class WhatsAppIntegration:
                 'message': message
             }
             
-            response = requests.post(self.api_url, json=data, headers=headers)
+            with metrics.outbound('whatsapp'):
+                response = requests.post(self.api_url, json=data, headers=headers)
             
             if response.status_code == 200:
                 # Update delivery order
@@ -96,7 +98,8 @@ class WhatsAppIntegration:
                 'message': message
             }
             
-            response = requests.post(self.api_url, json=data, headers=headers)
+            with metrics.outbound('whatsapp'):
+                response = requests.post(self.api_url, json=data, headers=headers)
             
             return response.status_code == 200, response.text
             